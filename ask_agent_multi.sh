@@ -14,6 +14,10 @@ declare -A INSTANCES=(
     ["chat"]="5003:Conversations and creative writing"
 )
 
+# Replica gateway (llm_gateway.py) spreading each instance over several
+# containers; when set, requests go to $SIMPLEBRAIN_GATEWAY_URL/<instance>
+readonly GATEWAY_URL="${SIMPLEBRAIN_GATEWAY_URL:-}"
+
 # Colors
 readonly RED='\033[0;31m'
 readonly GREEN='\033[0;32m'
@@ -42,30 +46,36 @@ usage() {
     echo -e "  $0 \"Write a Python function\"  # Auto-selects coding instance"
 }
 
-# Function to auto-select instance based on question content
-auto_select_instance() {
-    local question="$1"
-    local question_lower=$(echo "$question" | tr '[:upper:]' '[:lower:]')
-    
-    # Keywords for different instance types
-    local coding_keywords="code|python|javascript|java|programming|function|algorithm|debug|api|database|sql|git|docker|terminal|command|script|bug|error|syntax"
-    local chat_keywords="story|creative|write|poem|essay|conversation|chat|tell me|imagine|what if|opinion|feel|think|personal|experience"
-    
-    if echo "$question_lower" | grep -qE "$coding_keywords"; then
-        echo "coding"
-    elif echo "$question_lower" | grep -qE "$chat_keywords"; then
-        echo "chat"
+# Function to get the base URL of an instance
+instance_url() {
+    local instance="$1"
+    IFS=':' read -r port description <<< "${INSTANCES[$instance]}"
+
+    if [[ -n "$GATEWAY_URL" ]]; then
+        echo "${GATEWAY_URL%/}/$instance"
     else
-        echo "general"
+        echo "http://localhost:$port"
     fi
 }
 
-# Function to check if instance is running
+# Function to check if instance is running; behind the gateway, whether
+# it has a healthy replica (its /health answers 503 while any instance has none)
 check_instance_running() {
     local instance="$1"
-    IFS=':' read -r port description <<< "${INSTANCES[$instance]}"
     
-    if curl -s --max-time 2 "http://localhost:$port" >/dev/null 2>&1; then
+    if [[ -n "$GATEWAY_URL" ]]; then
+        curl -s --max-time 2 "${GATEWAY_URL%/}/health" 2>/dev/null | python3 -c "
+import json, sys
+try:
+    state = json.load(sys.stdin)['backend']['models'][sys.argv[1]]['state']
+except (ValueError, KeyError, TypeError):
+    sys.exit(1)
+sys.exit(0 if state == 'ready' else 1)
+" "$instance"
+        return
+    fi
+    
+    if curl -s --max-time 2 "$(instance_url "$instance")" >/dev/null 2>&1; then
         return 0
     else
         return 1
@@ -93,7 +103,11 @@ ask_instance() {
     fi
     
     echo -e "${CYAN}🤖 Asking ${instance} instance:${NC} $question"
-    echo -e "${BLUE}📡 Connecting to port $port...${NC}"
+    if [[ -n "$GATEWAY_URL" ]]; then
+        echo -e "${BLUE}📡 Connecting to the gateway at $GATEWAY_URL...${NC}"
+    else
+        echo -e "${BLUE}📡 Connecting to port $port...${NC}"
+    fi
     echo
     
     # Send request to the instance
@@ -102,7 +116,7 @@ ask_instance() {
         -X POST \
         -H "Content-Type: application/json" \
         -d "{\"prompt\":\"$question\"}" \
-        "http://localhost:$port/api/agent")
+        "$(instance_url "$instance")/api/agent")
     
     if [[ $? -eq 0 ]] && [[ -n "$response" ]]; then
         # Parse JSON response
@@ -168,13 +182,11 @@ main() {
     fi
     
     if [[ $# -eq 1 ]]; then
-        # Auto-select instance based on question
-        local question="$1"
-        local selected_instance
-        selected_instance=$(auto_select_instance "$question")
-        
-        echo -e "${CYAN}🎯 Auto-selected instance:${NC} $selected_instance"
-        ask_instance "$selected_instance" "$question"
+        # Auto-select instance based on question: ask_llm.py routes it
+        # (see route() there) and asks in the same process
+        local router=()
+        [[ -z "$GATEWAY_URL" ]] || router=(--router "$GATEWAY_URL")
+        exec python3 "$SCRIPT_DIR/ask_llm.py" ${router[@]+"${router[@]}"} "$1"
         
     elif [[ $# -eq 2 ]]; then
         # Use specified instance
@@ -2,8 +2,17 @@
 
 import requests
 import json
+import math
+import os
+import re
 import sys
+import threading
+import time
+import uuid
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import llm_gateway
 
 # LLM Instance Configuration
 INSTANCES = {
@@ -24,6 +33,60 @@ INSTANCES = {
     }
 }
 
+# Single-process router (ROUTER_MODELS on the server) serving every instance
+# above; requests then name the instance in their "model" field
+ROUTER_URL = os.environ.get('SIMPLEBRAIN_ROUTER_URL')
+
+# Hedged requests (--hedge): when an instance has several replicas and the
+# first token is late, the question is also sent to a second replica and the
+# slower copy is cancelled (see llm_gateway.hedged_post)
+HEDGE = os.environ.get('SIMPLEBRAIN_HEDGE', '0') == '1'
+
+# Batch mode: prompts sent per /api/agent/batch request, and how often a
+# busy instance is retried before its prompts are left for the next run
+BATCH_SIZE = 32
+BATCH_RETRIES = 3
+
+# Kept-alive connections per host in the shared session
+POOL_SIZE = 16
+
+# Auto-selection (`ask_llm.py "question"`): the first rule with a keyword
+# starting a word of the question picks the instance, else DEFAULT_INSTANCE
+ROUTE_KEYWORDS = [
+    ('coding', ['code', 'python', 'javascript', 'java', 'programming', 'function', 'algorithm', 'debug',
+                'api', 'database', 'sql', 'git', 'docker', 'terminal', 'command', 'script', 'bug',
+                'error', 'syntax']),
+    ('chat', ['story', 'creative', 'write', 'poem', 'essay', 'conversation', 'chat', 'tell me',
+              'imagine', 'what if', 'opinion', 'feel', 'think', 'personal', 'experience']),
+]
+DEFAULT_INSTANCE = 'general'
+
+# Optional classifier trained with --train-router from labelled prompts. It
+# overrides the keyword rules when it is at least ROUTER_MIN_CONFIDENCE sure
+ROUTER_MODEL = os.environ.get('SIMPLEBRAIN_ROUTER_MODEL', os.path.expanduser('~/.simplebrain/router.json'))
+ROUTER_MIN_CONFIDENCE = float(os.environ.get('SIMPLEBRAIN_ROUTER_MIN_CONFIDENCE', '0.6'))
+
+# When set, questions asked with an explicitly chosen instance are appended
+# to this JSONL file as training data for --train-router
+ROUTE_LOG = os.environ.get('SIMPLEBRAIN_ROUTE_LOG')
+
+def new_session(pool_size=POOL_SIZE):
+    """HTTP session reusing keep-alive connections to the instances across requests and threads"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=len(INSTANCES) + 1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+session = new_session()
+
+# Several replicas of an instance, e.g. "coding=5002,5012,5022" (same format
+# as llm_gateway.py); each request goes to the least-loaded healthy one
+REPLICA_POOLS = {
+    name: llm_gateway.ReplicaPool(urls, session)
+    for name, urls in llm_gateway.parse_replicas(os.environ.get('SIMPLEBRAIN_REPLICAS', '')).items()
+}
+
 # Colors for terminal output
 class Colors:
     CYAN = '\033[0;36m'
@@ -33,34 +96,262 @@ class Colors:
     RED = '\033[0;31m'
     NC = '\033[0m'
 
+def keyword_pattern(keywords):
+    """One precompiled, case-insensitive regex matching any keyword at the start of a word"""
+    return re.compile(r'\b(?:' + '|'.join(re.escape(keyword) for keyword in keywords) + ')', re.IGNORECASE)
+
+KEYWORD_RULES = [(name, keyword_pattern(keywords)) for name, keywords in ROUTE_KEYWORDS]
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9_+#']+")
+
+def tokenize(text):
+    """Lower-cased words and word pairs of a prompt"""
+    words = TOKEN_PATTERN.findall(text.lower())
+    return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+class PromptClassifier:
+    """
+    Multinomial naive Bayes over the words and word pairs of a prompt.
+
+    Prediction is a few dictionary lookups per word; words never seen in
+    training are ignored. The confidence is the posterior probability of
+    the predicted instance.
+    """
+
+    def __init__(self, classes):
+        # {instance: {"prior": log P(instance), "unseen": log P(unknown word),
+        #             "tokens": {token: log P(token | instance)}}}
+        self.classes = classes
+        self.vocabulary = set()
+        for model in classes.values():
+            self.vocabulary.update(model['tokens'])
+
+    @classmethod
+    def train(cls, records):
+        """Fit on {"prompt", "instance"} records"""
+        counts = {}
+        for record in records:
+            counts.setdefault(record['instance'], []).append(tokenize(record['prompt']))
+        vocabulary = {token for prompts in counts.values() for tokens in prompts for token in tokens}
+        total = sum(len(prompts) for prompts in counts.values())
+
+        classes = {}
+        for name, prompts in counts.items():
+            frequencies = {}
+            for tokens in prompts:
+                for token in tokens:
+                    frequencies[token] = frequencies.get(token, 0) + 1
+            # Laplace smoothing over the shared vocabulary
+            denominator = sum(frequencies.values()) + len(vocabulary)
+            classes[name] = {
+                'prior': math.log(len(prompts) / total),
+                'unseen': math.log(1 / denominator),
+                'tokens': {token: math.log((count + 1) / denominator) for token, count in frequencies.items()},
+            }
+        return cls(classes)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f)['classes'])
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'classes': self.classes}, f)
+
+    def predict(self, text):
+        """(instance, confidence) for a prompt; (None, 0.0) when none of its words are known"""
+        tokens = [token for token in tokenize(text) if token in self.vocabulary]
+        if not tokens:
+            return None, 0.0
+        scores = {
+            name: model['prior'] + sum(model['tokens'].get(token, model['unseen']) for token in tokens)
+            for name, model in self.classes.items()
+        }
+        best = max(scores, key=scores.get)
+        total = sum(math.exp(score - scores[best]) for score in scores.values())
+        return best, 1 / total
+
+_classifier = None
+
+def load_classifier():
+    """The trained classifier at ROUTER_MODEL, loaded once; None if there is none"""
+    global _classifier
+    if _classifier is None:
+        _classifier = False
+        if os.path.exists(ROUTER_MODEL):
+            try:
+                _classifier = PromptClassifier.load(ROUTER_MODEL)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"{Colors.YELLOW}Warning: ignoring router model {ROUTER_MODEL}: {e}{Colors.NC}", file=sys.stderr)
+    return _classifier or None
+
+def route(question):
+    """
+    Pick an instance for a question: (instance, method, confidence).
+
+    The classifier's answer is used when it is confident enough; otherwise
+    the keyword rules decide. `confidence` is the classifier's (None
+    without a trained model) even when it was overruled.
+    """
+    confidence = None
+    classifier = load_classifier()
+    if classifier:
+        instance, confidence = classifier.predict(question)
+        if instance in INSTANCES and confidence >= ROUTER_MIN_CONFIDENCE:
+            return instance, 'classifier', confidence
+    for name, pattern in KEYWORD_RULES:
+        if pattern.search(question):
+            return name, 'keywords', confidence
+    return DEFAULT_INSTANCE, 'default', confidence
+
+def describe_route(instance, method, confidence):
+    if confidence is None:
+        return f"{instance} ({method})"
+    if method == 'classifier':
+        return f"{instance} (classifier, confidence {confidence:.2f})"
+    return f"{instance} ({method}; classifier confidence {confidence:.2f} too low)"
+
+def log_route(instance_name, question):
+    """Record an explicitly chosen instance as a training example (SIMPLEBRAIN_ROUTE_LOG)"""
+    if ROUTE_LOG and instance_name in INSTANCES:
+        with open(ROUTE_LOG, 'a') as f:
+            f.write(json.dumps({'prompt': question, 'instance': instance_name}) + '\n')
+
+def train_router(paths, model_path):
+    """Train the routing classifier from JSONL files of {"prompt", "instance"} records"""
+    records = [
+        record for path in paths for record in read_jsonl(path)
+        if isinstance(record, dict) and record.get('instance') in INSTANCES and record.get('prompt')
+    ]
+    if len({record['instance'] for record in records}) < 2:
+        print(f"{Colors.RED}Error: Training needs labelled prompts for at least two instances{Colors.NC}")
+        sys.exit(1)
+
+    classifier = PromptClassifier.train(records)
+    classifier.save(model_path)
+    correct = sum(classifier.predict(record['prompt'])[0] == record['instance'] for record in records)
+    print(f"{Colors.GREEN}Trained on {len(records)} prompts:{Colors.NC} " +
+          ", ".join(f"{name} {sum(r['instance'] == name for r in records)}" for name in classifier.classes))
+    print(f"Training accuracy {correct / len(records):.0%}, saved to {model_path}")
+
+def print_http_error(response):
+    """Print a non-200 API response, with a retry hint when the instance is busy"""
+    print(f"{Colors.RED}Error: HTTP {response.status_code}{Colors.NC}")
+    if response.status_code in (429, 503) and 'Retry-After' in response.headers:
+        print(f"{Colors.YELLOW}The instance is busy. Retry in {response.headers['Retry-After']}s.{Colors.NC}")
+    else:
+        print(response.text)
+
+def instance_url(instance_name, session_id=None):
+    """
+    Base URL of the API serving an instance: the least-loaded replica if it
+    has several, or always the same one for a conversation's `session_id`
+    """
+    if ROUTER_URL:
+        return ROUTER_URL
+    if instance_name in REPLICA_POOLS:
+        try:
+            return REPLICA_POOLS[instance_name].pick(affinity=session_id).url
+        except llm_gateway.NoReplica as e:
+            print(f"{Colors.YELLOW}Warning: {e}{Colors.NC}", file=sys.stderr)
+    return f"http://localhost:{INSTANCES[instance_name]['port']}"
+
+def request_body(instance_name, question, session_id=None):
+    # Someone is waiting at the terminal: schedule ahead of batch work
+    body = {'prompt': question, 'priority': 'interactive'}
+    if ROUTER_URL:
+        body['model'] = instance_name
+    if session_id:
+        body['session_id'] = session_id
+    return body
+
+def end_session(instance_name, session_id):
+    """Tell an instance a conversation is over so it frees its KV cache slot"""
+    try:
+        session.delete(f'{instance_url(instance_name, session_id)}/api/session/{session_id}', timeout=5)
+    except requests.exceptions.RequestException:
+        pass
+
+def check_router_health(instance_name=None):
+    """Check the router and which of its models are loaded"""
+    print(f"{Colors.CYAN}🔍 Checking SimpleBrain router at {ROUTER_URL}...{Colors.NC}\n")
+    try:
+        response = session.get(f'{ROUTER_URL}/health', timeout=5)
+        data = response.json()
+    except (requests.exceptions.RequestException, ValueError):
+        print(f"  Status: offline or error")
+        return
+
+    backend = data.get('backend', {})
+    print(f"  Status: {data.get('status', 'unknown')}, "
+          f"Memory: {backend.get('used_mb', '?')}/{backend.get('budget_mb', '?')} MB "
+          f"({backend.get('eviction_policy', '?')} eviction)\n")
+    models = backend.get('models', {})
+    for name in [instance_name] if instance_name else INSTANCES.keys():
+        state = models.get(name, {}).get('state', 'not configured')
+        print(f"{Colors.BLUE}{name.title()} ({INSTANCES.get(name, {}).get('model', name)}):{Colors.NC} {state}")
+
+def probe_health(name):
+    """An instance's /health as (HTTP status, body); (None, None) if it is unreachable"""
+    if name in REPLICA_POOLS:
+        REPLICA_POOLS[name].refresh(force=True)
+        return None, None
+    try:
+        response = session.get(f"http://localhost:{INSTANCES[name]['port']}/health", timeout=5)
+        return response.status_code, response.json() if response.status_code == 200 else None
+    except (requests.exceptions.RequestException, ValueError):
+        return None, None
+
+def print_replicas(name):
+    """Health and load of each replica of an instance"""
+    print(f"{Colors.BLUE}{name.title()} ({INSTANCES[name]['model']}) - {len(REPLICA_POOLS[name].replicas)} replicas:{Colors.NC}")
+    for replica in REPLICA_POOLS[name].status():
+        line = f"  {replica['url']}: {replica['status']}, load {replica['load']}/{replica['capacity']}"
+        if replica['retry_in']:
+            line += f" (ejected, retry in {replica['retry_in']}s)"
+        print(line)
+    print()
+
 def check_health(instance_name=None):
     """Check health of LLM instances"""
+    if ROUTER_URL:
+        check_router_health(instance_name)
+        return
+
     print(f"{Colors.CYAN}🔍 Checking LLM instance health...{Colors.NC}\n")
     
     instances_to_check = [instance_name] if instance_name else INSTANCES.keys()
-    
     for name in instances_to_check:
         if name not in INSTANCES:
             print(f"{Colors.RED}Error: Unknown instance '{name}'{Colors.NC}")
-            continue
-            
+    known = [name for name in instances_to_check if name in INSTANCES]
+
+    # Probe every instance at once: a full check costs one timeout, not one per instance
+    with ThreadPoolExecutor(max_workers=max(1, len(known))) as pool:
+        probes = list(pool.map(probe_health, known))
+
+    for name, (status_code, data) in zip(known, probes):
         config = INSTANCES[name]
         port = config['port']
         model = config['model']
         
-        try:
-            response = requests.get(f'http://localhost:{port}/health', timeout=5)
-            if response.status_code == 200:
-                data = response.json()
-                status = data.get('status', 'unknown')
-                model_type = data.get('environment', {}).get('model_type', 'unknown')
-                print(f"{Colors.BLUE}{name.title()} ({model}) - Port {port}:{Colors.NC}")
-                print(f"  Status: {status}, Model: {model_type}")
-            else:
-                print(f"{Colors.BLUE}{name.title()} ({model}) - Port {port}:{Colors.NC}")
-                print(f"  Status: HTTP {response.status_code}")
-        except requests.exceptions.RequestException:
-            print(f"{Colors.BLUE}{name.title()} ({model}) - Port {port}:{Colors.NC}")
+        if name in REPLICA_POOLS:
+            print_replicas(name)
+            continue
+
+        print(f"{Colors.BLUE}{name.title()} ({model}) - Port {port}:{Colors.NC}")
+        if data is not None:
+            status = data.get('status', 'unknown')
+            model_type = data.get('environment', {}).get('model_type', 'unknown')
+            queue = data.get('queue', {})
+            print(f"  Status: {status}, Model: {model_type}")
+            if queue:
+                print(f"  Queue: {queue.get('active', 0)} active, {queue.get('queue_depth', 0)} waiting")
+        elif status_code is not None:
+            print(f"  Status: HTTP {status_code}")
+        else:
             print(f"  Status: offline or error")
         print()
 
@@ -71,18 +362,17 @@ def ask_llm(instance_name, question):
         print(f"Available instances: {', '.join(INSTANCES.keys())}")
         sys.exit(1)
     
-    config = INSTANCES[instance_name]
-    port = config['port']
-    model = config['model']
+    model = INSTANCES[instance_name]['model']
     
     print(f"{Colors.CYAN}🤖 Asking {model} ({instance_name}):{Colors.NC} {question}")
-    print(f"{Colors.BLUE}📡 Connecting to port {port}...{Colors.NC}\n")
+    url = instance_url(instance_name)
+    print(f"{Colors.BLUE}📡 Connecting to {'the router' if ROUTER_URL else url}...{Colors.NC}\n")
     
     try:
-        response = requests.post(
-            f'http://localhost:{port}/api/agent',
+        response = session.post(
+            f'{url}/api/agent',
             headers={'Content-Type': 'application/json'},
-            json={'prompt': question},
+            json=request_body(instance_name, question),
             timeout=60  # Longer timeout for model processing
         )
         
@@ -103,8 +393,7 @@ def ask_llm(instance_name, question):
                     print(f"{Colors.BLUE}📋 Result:{Colors.NC}")
                     print(command_result)
         else:
-            print(f"{Colors.RED}Error: HTTP {response.status_code}{Colors.NC}")
-            print(response.text)
+            print_http_error(response)
             
     except requests.exceptions.Timeout:
         print(f"{Colors.RED}Error: Request timed out{Colors.NC}")
@@ -114,14 +403,200 @@ def ask_llm(instance_name, question):
     except json.JSONDecodeError as e:
         print(f"{Colors.RED}JSON error: {e}{Colors.NC}")
 
+def stream_llm(instance_name, question, session_id=None):
+    """
+    Send question to specific LLM instance and print tokens as they arrive.
+
+    With a `session_id` the question continues that conversation on the
+    instance, which keeps its history and KV cache between turns.
+    """
+    if instance_name not in INSTANCES:
+        print(f"{Colors.RED}Error: Invalid instance '{instance_name}'{Colors.NC}")
+        print(f"Available instances: {', '.join(INSTANCES.keys())}")
+        return
+    
+    try:
+        lines = None
+        # A conversation lives on one replica, so its turns are not hedged
+        if HEDGE and instance_name in REPLICA_POOLS and not ROUTER_URL and not session_id:
+            _, response, lines = llm_gateway.hedged_post(
+                REPLICA_POOLS[instance_name], '/api/agent/stream',
+                json.dumps(request_body(instance_name, question)),
+                headers={'Content-Type': 'application/json'}
+            )
+        else:
+            response = session.post(
+                f'{instance_url(instance_name, session_id)}/api/agent/stream',
+                headers={'Content-Type': 'application/json'},
+                json=request_body(instance_name, question, session_id),
+                stream=True,
+                timeout=60  # Applies to the wait for each chunk, not the whole answer
+            )
+        
+        # Instances running an older API without streaming support
+        if response.status_code == 404:
+            response.close()
+            ask_llm(instance_name, question)
+            return
+        
+        if response.status_code != 200:
+            print_http_error(response)
+            return
+        
+        print(f"{Colors.GREEN}🤖 Response:{Colors.NC}")
+        with response:
+            for line in lines or response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                if 'token' in event:
+                    print(event['token'], end='', flush=True)
+                elif 'error' in event:
+                    print(f"\n{Colors.RED}Error: {event['error']}{Colors.NC}")
+                elif event.get('done'):
+                    print()
+                    executed_command = event.get('executed_command')
+                    if executed_command and executed_command != 'None':
+                        print(f"\n{Colors.YELLOW}🔧 Command executed:{Colors.NC} {executed_command}")
+                        print(f"{Colors.BLUE}📋 Result:{Colors.NC}")
+                        print(event.get('command_result', ''))
+            
+    except requests.exceptions.Timeout:
+        print(f"\n{Colors.RED}Error: Request timed out{Colors.NC}")
+        print(f"{Colors.YELLOW}The model may be loading or processing. Try again in a moment.{Colors.NC}")
+    except (requests.exceptions.RequestException, llm_gateway.NoReplica) as e:
+        print(f"\n{Colors.RED}Connection error: {e}{Colors.NC}")
+    except json.JSONDecodeError as e:
+        print(f"\n{Colors.RED}JSON error: {e}{Colors.NC}")
+
+def read_jsonl(path):
+    """Records of a JSONL file, skipping blank lines"""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def load_batch(input_path, output_path, instances):
+    """
+    The prompts of a batch file that still need an answer.
+
+    Each line is a prompt string or an object with a "prompt" and optionally
+    an "id", an "instance" and generation settings (max_tokens, stop, ...).
+    Prompts without an id are identified by their position in the file. Ids that
+    already have an answer (not an error) in the output file are skipped,
+    so an interrupted run picks up where it stopped.
+    """
+    answered = set()
+    if os.path.exists(output_path):
+        answered = {str(r['id']) for r in read_jsonl(output_path) if 'error' not in r}
+
+    pending = []
+    for number, record in enumerate(read_jsonl(input_path), 1):
+        if not isinstance(record, dict):
+            record = {'prompt': record}
+        record.setdefault('id', number)
+        if str(record['id']) in answered:
+            continue
+        record['instance'] = record.get('instance') or instances[len(pending) % len(instances)]
+        pending.append(record)
+    return pending, len(answered)
+
+def batch_request(instance_name, records):
+    """POST records to an instance's /api/agent/batch; yields its result lines"""
+    prompts = []
+    for record in records:
+        item = {key: value for key, value in record.items() if key != 'instance'}
+        if ROUTER_URL:
+            item['model'] = instance_name
+        prompts.append(item)
+
+    for attempt in range(BATCH_RETRIES + 1):
+        response = session.post(
+            f'{instance_url(instance_name)}/api/agent/batch',
+            json={'prompts': prompts},
+            stream=True,
+            timeout=300  # Applies to the wait for each line, not the whole batch
+        )
+        if response.status_code in (429, 503) and attempt < BATCH_RETRIES:
+            response.close()
+            time.sleep(int(response.headers.get('Retry-After', 5)))
+            continue
+        break
+
+    if response.status_code != 200:
+        response.close()
+        raise requests.exceptions.HTTPError(f"HTTP {response.status_code}: {response.text[:200]}")
+    with response:
+        for line in response.iter_lines():
+            if line:
+                event = json.loads(line)
+                if not event.get('done'):
+                    yield event
+
+def run_batch_chunk(instance_name, records, write):
+    """Send one chunk of prompts to an instance and write each answer as it arrives"""
+    try:
+        for event in batch_request(instance_name, records):
+            result = {'id': records[event['index']]['id'], 'instance': instance_name}
+            if 'error' in event:
+                result['error'] = event['error']
+            else:
+                result.update(llm_response=event['llm_response'], usage=event.get('usage'), cached=event.get('cached'))
+            write(result)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"{Colors.RED}Error: {len(records)} prompts for {instance_name} not sent: {e}{Colors.NC}", file=sys.stderr)
+
+def run_batch(input_path, output_path, instances, concurrency=2, batch_size=BATCH_SIZE):
+    """
+    Answer every prompt of a JSONL file and append the results to another.
+
+    Prompts are spread round-robin over `instances` (unless a line names
+    its own) and sent in chunks of `batch_size`, with up to `concurrency`
+    chunks in flight at once. Failed prompts are written with an "error"
+    and retried by the next run.
+    """
+    unknown = [name for name in instances if name not in INSTANCES]
+    if unknown:
+        print(f"{Colors.RED}Error: Unknown instance(s): {', '.join(unknown)}{Colors.NC}")
+        sys.exit(1)
+
+    pending, skipped = load_batch(input_path, output_path, instances)
+    print(f"{Colors.CYAN}📦 {len(pending)} prompts to answer ({skipped} already done) → {output_path}{Colors.NC}")
+
+    chunks = []
+    for name in dict.fromkeys(record['instance'] for record in pending):
+        records = [record for record in pending if record['instance'] == name]
+        chunks += [(name, records[i:i + batch_size]) for i in range(0, len(records), batch_size)]
+
+    lock = threading.Lock()
+    counts = {'ok': 0, 'error': 0}
+    started = time.monotonic()
+    with open(output_path, 'a') as output:
+        def write(result):
+            with lock:
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+                counts['error' if 'error' in result else 'ok'] += 1
+                done = counts['ok'] + counts['error']
+                print(f"\r  {done}/{len(pending)} answered, {counts['error']} failed", end='', flush=True)
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            for name, records in chunks:
+                pool.submit(run_batch_chunk, name, records, write)
+
+    missing = len(pending) - counts['ok'] - counts['error']
+    print(f"\n{Colors.GREEN}Done in {time.monotonic() - started:.1f}s:{Colors.NC} "
+          f"{counts['ok']} answered, {counts['error'] + missing} left for the next run")
+
 def interactive_mode():
     """Start interactive chat with LLM selection"""
     print(f"{Colors.CYAN}🤖 SimpleBrain Multi-LLM Interactive Chat{Colors.NC}")
     print("Available instances: " + ", ".join(INSTANCES.keys()))
-    print("Type 'switch <instance>' to change LLM, 'health' to check status, or 'quit' to exit")
+    print("Type 'switch <instance>' to change LLM ('switch auto' to pick one per question), 'new' to start a new")
+    print("conversation, 'health' to check status, or 'quit' to exit")
     print("=" * 60)
     
     current_instance = 'general'  # Default instance
+    # One conversation per instance; each instance keeps its history server-side
+    conversations = {}
     
     try:
         while True:
@@ -136,9 +611,19 @@ def interactive_mode():
                     check_health()
                     continue
                 
+                if user_input.lower() == 'new':
+                    for name, session_id in conversations.items():
+                        end_session(name, session_id)
+                    conversations.clear()
+                    print(f"{Colors.GREEN}Started a new conversation{Colors.NC}")
+                    continue
+                
                 if user_input.lower().startswith('switch '):
                     new_instance = user_input[7:].strip()
-                    if new_instance in INSTANCES:
+                    if new_instance == 'auto':
+                        current_instance = new_instance
+                        print(f"{Colors.GREEN}Switched to automatic instance selection{Colors.NC}")
+                    elif new_instance in INSTANCES:
                         current_instance = new_instance
                         model = INSTANCES[current_instance]['model']
                         print(f"{Colors.GREEN}Switched to {current_instance} ({model}){Colors.NC}")
@@ -149,7 +634,14 @@ def interactive_mode():
                 if not user_input:
                     continue
                 
-                ask_llm(current_instance, user_input)
+                if current_instance == 'auto':
+                    instance, method, confidence = route(user_input)
+                    print(f"{Colors.CYAN}🎯 {describe_route(instance, method, confidence)}{Colors.NC}")
+                else:
+                    instance = current_instance
+                    log_route(instance, user_input)
+                conversation = conversations.setdefault(instance, uuid.uuid4().hex)
+                stream_llm(instance, user_input, conversation)
                 
             except KeyboardInterrupt:
                 print("\n👋 Goodbye!")
@@ -157,6 +649,9 @@ def interactive_mode():
                 
     except Exception as e:
         print(f"Error: {e}")
+    finally:
+        for name, session_id in conversations.items():
+            end_session(name, session_id)
 
 def show_help():
     """Show usage information"""
@@ -168,8 +663,14 @@ def show_help():
     
     print(f"\n{Colors.BLUE}Usage:{Colors.NC}")
     print(f"  python3 ask_llm.py <instance> \"question\"")
+    print(f"  python3 ask_llm.py \"question\"  # Auto-select the instance")
+    print(f"  python3 ask_llm.py --stream <instance> \"question\"")
     print(f"  python3 ask_llm.py --health [instance]")
     print(f"  python3 ask_llm.py --interactive")
+    print(f"  python3 ask_llm.py --router http://localhost:5010 <instance> \"question\"")
+    print(f"  SIMPLEBRAIN_REPLICAS=\"coding=5002,5012\" python3 ask_llm.py --hedge coding \"question\"")
+    print(f"  python3 ask_llm.py --batch prompts.jsonl --output results.jsonl [--instances general,coding]")
+    print(f"  python3 ask_llm.py --train-router prompts.jsonl [--router-model router.json]")
     
     print(f"\n{Colors.BLUE}Examples:{Colors.NC}")
     print(f"  python3 ask_llm.py general \"What is machine learning?\"")
@@ -182,13 +683,48 @@ def main():
     parser.add_argument('question', nargs='?', help='Question to ask')
     parser.add_argument('--health', nargs='?', const='all', help='Check health of instances')
     parser.add_argument('--interactive', '-i', action='store_true', help='Start interactive mode')
+    parser.add_argument('--stream', '-s', action='store_true', help='Print tokens as they are generated')
+    parser.add_argument('--hedge', action='store_true', help='Race a second replica when the first token is late (needs $SIMPLEBRAIN_REPLICAS)')
+    parser.add_argument('--router', metavar='URL', help='Send every instance to one router process (default: $SIMPLEBRAIN_ROUTER_URL)')
+    parser.add_argument('--batch', metavar='FILE', help='Answer every prompt of a JSONL file')
+    parser.add_argument('--output', '-o', metavar='FILE', help='Results JSONL for --batch (default: <FILE>.results.jsonl)')
+    parser.add_argument('--instances', default='general', help='Comma-separated instances --batch spreads prompts over')
+    parser.add_argument('--concurrency', type=int, default=2, help='Batch requests in flight at once')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Prompts per batch request')
+    parser.add_argument('--route', metavar='QUESTION', help='Print the instance auto-selection picks: "<instance> <method> <confidence>"')
+    parser.add_argument('--train-router', nargs='+', metavar='FILE', help='Train the auto-selection classifier from JSONL files of {"prompt", "instance"}')
+    parser.add_argument('--router-model', metavar='FILE', help='Classifier file (default: $SIMPLEBRAIN_ROUTER_MODEL or ~/.simplebrain/router.json)')
     parser.add_argument('--help', '-h', action='store_true', help='Show help')
     
     args = parser.parse_args()
+
+    global ROUTER_URL, HEDGE, ROUTER_MODEL
+    HEDGE = HEDGE or args.hedge
+    if args.router_model:
+        ROUTER_MODEL = args.router_model
+    if args.router:
+        ROUTER_URL = args.router
+    if ROUTER_URL:
+        ROUTER_URL = ROUTER_URL.rstrip('/')
     
-    if args.help or (not args.instance and not args.health and not args.interactive):
+    if args.help or not (args.instance or args.health or args.interactive or args.batch or args.route or args.train_router):
         show_help()
         return
+
+    if args.train_router:
+        train_router(args.train_router, ROUTER_MODEL)
+        return
+
+    if args.route:
+        instance, method, confidence = route(args.route)
+        print(instance, method, '-' if confidence is None else f"{confidence:.2f}")
+        return
+
+    if args.batch:
+        output = args.output or f"{os.path.splitext(args.batch)[0]}.results.jsonl"
+        instances = [name.strip() for name in args.instances.split(',') if name.strip()]
+        run_batch(args.batch, output, instances, args.concurrency, max(1, args.batch_size))
+        return
     
     if args.health:
         if args.health == 'all':
@@ -201,8 +737,21 @@ def main():
         interactive_mode()
         return
     
+    if args.instance and not args.question and args.instance not in INSTANCES:
+        # A lone argument is the question; pick the instance for it
+        instance, method, confidence = route(args.instance)
+        print(f"{Colors.CYAN}🎯 Auto-selected instance:{Colors.NC} {describe_route(instance, method, confidence)}")
+        args.instance, args.question = instance, args.instance
+    elif args.instance and args.question:
+        log_route(args.instance, args.question)
+
     if args.instance and args.question:
-        ask_llm(args.instance, args.question)
+        # Hedging needs a token stream to see when the first token is late
+        if args.stream or HEDGE:
+            print(f"{Colors.CYAN}🤖 Asking {INSTANCES.get(args.instance, {}).get('model', args.instance)} ({args.instance}):{Colors.NC} {args.question}\n")
+            stream_llm(args.instance, args.question)
+        else:
+            ask_llm(args.instance, args.question)
     else:
         print(f"{Colors.RED}Error: Both instance and question are required{Colors.NC}")
         show_help()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import itertools
+import json
+import statistics
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+DEFAULT_PROMPT = "Explain in three sentences what a hash table is."
+
+# Identical concurrent prompts share one generation (DEDUPLICATE_REQUESTS)
+# and repeated ones can come from the response cache, which would count the
+# same tokens once per client; every request gets its own prompt instead
+RUN_ID = f"{int(time.time()):x}"
+_request_numbers = itertools.count(1)
+
+def unique_prompt(prompt):
+    """The prompt tagged with a number no other request of this or an earlier run uses"""
+    return f"{prompt} (Request {RUN_ID}-{next(_request_numbers)}.)"
+
+def run_request(base_url, prompt, timeout):
+    """Send one streaming request and measure it"""
+    started = time.monotonic()
+    first_token = None
+    token_events = 0
+    usage = None
+
+    try:
+        response = requests.post(
+            f"{base_url}/api/agent/stream",
+            json={'prompt': prompt},
+            stream=True,
+            timeout=timeout
+        )
+        if response.status_code != 200:
+            return {'status': response.status_code}
+
+        with response:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                if 'token' in event:
+                    if first_token is None:
+                        first_token = time.monotonic()
+                    token_events += 1
+                elif 'error' in event:
+                    return {'status': 'error', 'error': event['error']}
+                elif event.get('done'):
+                    usage = event.get('usage')
+    except requests.exceptions.RequestException as e:
+        return {'status': 'error', 'error': str(e)}
+
+    finished = time.monotonic()
+    # Backends that do not report usage: fall back to the number of chunks
+    tokens = (usage or {}).get('completion_tokens') or token_events
+    return {
+        'status': 200,
+        'latency': finished - started,
+        'ttft': (first_token or finished) - started,
+        'tokens': tokens,
+    }
+
+def run_openai_request(base_url, prompt, timeout):
+    """Send one streaming /v1/completions request (OpenAI wire format) and measure it"""
+    started = time.monotonic()
+    first_token = None
+    token_events = 0
+    usage = None
+
+    try:
+        response = requests.post(
+            f"{base_url}/v1/completions",
+            json={'prompt': prompt, 'stream': True, 'stream_options': {'include_usage': True}},
+            stream=True,
+            timeout=timeout
+        )
+        if response.status_code != 200:
+            return {'status': response.status_code}
+
+        with response:
+            for line in response.iter_lines():
+                if not line.startswith(b'data: ') or line == b'data: [DONE]':
+                    continue
+                event = json.loads(line[len(b'data: '):])
+                if 'error' in event:
+                    return {'status': 'error', 'error': event['error'].get('message')}
+                if event.get('usage'):
+                    usage = event['usage']
+                if any(choice.get('text') for choice in event.get('choices', [])):
+                    if first_token is None:
+                        first_token = time.monotonic()
+                    token_events += 1
+    except requests.exceptions.RequestException as e:
+        return {'status': 'error', 'error': str(e)}
+
+    finished = time.monotonic()
+    tokens = (usage or {}).get('completion_tokens') or token_events
+    return {
+        'status': 200,
+        'latency': finished - started,
+        'ttft': (first_token or finished) - started,
+        'tokens': tokens,
+    }
+
+def run_level(base_url, clients, requests_per_client, prompt, timeout, api='agent'):
+    """Run `clients` concurrent clients, each sending requests back to back"""
+    results = []
+    lock = threading.Lock()
+    send = run_openai_request if api == 'openai' else run_request
+
+    def client():
+        for _ in range(requests_per_client):
+            result = send(base_url, unique_prompt(prompt), timeout)
+            with lock:
+                results.append(result)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.monotonic() - started
+
+    ok = [r for r in results if r['status'] == 200]
+    latencies = sorted(r['latency'] for r in ok)
+    tokens = sum(r['tokens'] for r in ok)
+    return {
+        'clients': clients,
+        'ok': len(ok),
+        'rejected': sum(1 for r in results if r['status'] in (429, 503)),
+        'errors': sum(1 for r in results if r['status'] == 'error'),
+        'wall_seconds': wall,
+        'tokens': tokens,
+        'tokens_per_second': tokens / wall if wall > 0 else 0.0,
+        'mean_latency': statistics.mean(latencies) if latencies else None,
+        'p95_latency': latencies[int(0.95 * (len(latencies) - 1))] if latencies else None,
+        'mean_ttft': statistics.mean(r['ttft'] for r in ok) if ok else None,
+    }
+
+async def hold_stream(host, port, prompt, hold_seconds, counts):
+    """Open one streaming request and keep the connection open without sending anything else"""
+    body = json.dumps({'prompt': prompt}).encode()
+    request = (f"POST /api/agent/stream HTTP/1.1\r\nHost: {host}:{port}\r\n"
+               f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+               f"Connection: close\r\n\r\n").encode() + body
+    writer = None
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(request)
+        await writer.drain()
+        status = await reader.readline()
+        if b" 200 " not in status:
+            counts['rejected'] += 1
+            return
+        counts['open'] += 1
+        # Drain whatever the server sends until the hold period is over
+        deadline = asyncio.get_running_loop().time() + hold_seconds
+        while True:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0 or not await asyncio.wait_for(reader.read(4096), remaining):
+                break
+    except asyncio.TimeoutError:
+        pass
+    except OSError:
+        counts['errors'] += 1
+    finally:
+        if writer is not None:
+            writer.close()
+
+def server_process(base_url):
+    """The API process's memory and thread count from /health, if it reports them"""
+    try:
+        return requests.get(f"{base_url}/health", timeout=30).json().get('process') or {}
+    except (requests.exceptions.RequestException, ValueError):
+        return {}
+
+def run_hold(base_url, connections, hold_seconds, prompt):
+    """
+    Hold `connections` concurrent streaming requests open and measure the
+    server's footprint while they wait. All use the same prompt, so with
+    request deduplication they share one slow generation.
+    """
+    url = urlsplit(base_url)
+    counts = {'open': 0, 'rejected': 0, 'errors': 0}
+    before = server_process(base_url)
+
+    async def run():
+        tasks = [asyncio.create_task(hold_stream(url.hostname, url.port or 80, prompt, hold_seconds, counts))
+                 for _ in range(connections)]
+        # Sample the server while the connections are being held
+        await asyncio.sleep(hold_seconds / 2)
+        during = await asyncio.to_thread(server_process, base_url)
+        await asyncio.gather(*tasks)
+        return during
+
+    started = time.monotonic()
+    during = asyncio.run(run())
+    return dict(counts, connections=connections, before=before, during=during,
+                wall_seconds=time.monotonic() - started)
+
+def format_seconds(value):
+    return f"{value:.2f}s" if value is not None else "-"
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure aggregate tokens/sec of SimpleBrain instances under concurrent load')
+    parser.add_argument('--target', action='append', metavar='LABEL=URL',
+                        help='Instance to benchmark, e.g. server=http://localhost:5002 (repeatable)')
+    parser.add_argument('--concurrency', default='1,2,4,8', help='Comma-separated client counts')
+    parser.add_argument('--requests-per-client', type=int, default=2)
+    parser.add_argument('--prompt', default=DEFAULT_PROMPT)
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--output', help='Also append the results table to this file')
+    parser.add_argument('--api', choices=['agent', 'openai'], default='agent',
+                        help='Endpoint to load: /api/agent/stream or the OpenAI-compatible /v1/completions')
+    parser.add_argument('--hold', type=int, metavar='N',
+                        help='Instead of measuring throughput, hold N idle streaming connections open '
+                             'and report the server\'s memory and threads (e.g. Flask vs ASGI)')
+    parser.add_argument('--hold-seconds', type=float, default=20)
+    args = parser.parse_args()
+
+    targets = []
+    for target in args.target or ['default=http://localhost:5001']:
+        label, _, url = target.partition('=')
+        if not url:
+            label = url = target
+        targets.append((label, url.rstrip('/')))
+
+    lines = []
+    def emit(line):
+        print(line, flush=True)
+        lines.append(line)
+
+    if args.hold:
+        emit(f"{'target':<12} {'conns':>6} {'open':>5} {'rej':>5} {'err':>5} "
+             f"{'rss before':>11} {'rss held':>9} {'threads':>8}")
+        for label, url in targets:
+            r = run_hold(url, args.hold, args.hold_seconds, args.prompt)
+            rss_before = f"{r['before']['rss_mb']}MB" if r['before'].get('rss_mb') is not None else '-'
+            rss_during = f"{r['during']['rss_mb']}MB" if r['during'].get('rss_mb') is not None else '-'
+            emit(f"{label:<12} {r['connections']:>6} {r['open']:>5} {r['rejected']:>5} {r['errors']:>5} "
+                 f"{rss_before:>11} {rss_during:>9} {r['during'].get('threads', '-'):>8}")
+    else:
+        levels = [int(n) for n in args.concurrency.split(',')]
+        emit(f"{'target':<12} {'clients':>7} {'ok':>4} {'rej':>4} {'err':>4} {'tokens':>7} "
+             f"{'tok/s':>8} {'mean lat':>9} {'p95 lat':>9} {'ttft':>8}")
+        for label, url in targets:
+            for clients in levels:
+                r = run_level(url, clients, args.requests_per_client, args.prompt, args.timeout, args.api)
+                emit(f"{label:<12} {r['clients']:>7} {r['ok']:>4} {r['rejected']:>4} {r['errors']:>4} "
+                     f"{r['tokens']:>7} {r['tokens_per_second']:>8.1f} {format_seconds(r['mean_latency']):>9} "
+                     f"{format_seconds(r['p95_latency']):>9} {format_seconds(r['mean_ttft']):>8}")
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.exit(130)
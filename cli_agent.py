@@ -3,15 +3,20 @@
 import requests
 import json
 import sys
+import uuid
 import readline  # For better input handling
 
+# One keep-alive connection to the agent, reused by every question
+session = requests.Session()
+
 def ask_agent(prompt):
     """Send prompt to local LLM agent and return response"""
     try:
-        response = requests.post(
+        response = session.post(
             'http://localhost:5001/api/agent',
             headers={'Content-Type': 'application/json'},
-            json={'prompt': prompt},
+            # The answer is no use once the request has timed out
+            json={'prompt': prompt, 'priority': 'interactive', 'deadline_ms': 30000},
             timeout=30
         )
         
@@ -26,9 +31,59 @@ def ask_agent(prompt):
     except json.JSONDecodeError as e:
         return f"JSON error: {e}", None, None
 
+def stream_agent(prompt, session_id=None):
+    """
+    Send prompt to local LLM agent and yield response tokens as they arrive.
+
+    With a `session_id` the prompt continues that conversation; the agent
+    keeps its history. Returns (executed_command, command_result) from the
+    final event.
+    """
+    body = {'prompt': prompt, 'priority': 'interactive'}
+    if session_id:
+        body['session_id'] = session_id
+    try:
+        response = session.post(
+            'http://localhost:5001/api/agent/stream',
+            headers={'Content-Type': 'application/json'},
+            json=body,
+            stream=True,
+            timeout=30
+        )
+        
+        if response.status_code != 200:
+            yield f"Error: HTTP {response.status_code}"
+            return None, None
+        
+        with response:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                if 'token' in event:
+                    yield event['token']
+                elif 'error' in event:
+                    yield f"\nError: {event['error']}"
+                elif event.get('done'):
+                    return event.get('executed_command'), event.get('command_result')
+        return None, None
+            
+    except requests.exceptions.RequestException as e:
+        yield f"Connection error: {e}"
+    except json.JSONDecodeError as e:
+        yield f"JSON error: {e}"
+    return None, None
+
+def end_session(session_id):
+    """Let the agent free a finished conversation's KV cache slot"""
+    try:
+        session.delete(f'http://localhost:5001/api/session/{session_id}', timeout=5)
+    except requests.exceptions.RequestException:
+        pass
+
 def main():
     print("🤖 Local LLM Agent CLI")
-    print("Type 'quit', 'exit', or press Ctrl+C to exit")
+    print("Type 'new' to start a new conversation; 'quit', 'exit', or press Ctrl+C to exit")
     print("=" * 50)
     
     if len(sys.argv) > 1:
@@ -42,7 +97,8 @@ def main():
             print(f"📋 Result: {result}")
         return
     
-    # Interactive mode
+    # Interactive mode: one conversation, remembered by the agent
+    session_id = uuid.uuid4().hex
     try:
         while True:
             try:
@@ -55,9 +111,20 @@ def main():
                 if not prompt:
                     continue
                 
+                if prompt.lower() == 'new':
+                    end_session(session_id)
+                    session_id = uuid.uuid4().hex
+                    print("🆕 Started a new conversation")
+                    continue
+                
                 print("🤖 Agent: ", end="", flush=True)
-                response, cmd, result = ask_agent(prompt)
-                print(response)
+                tokens = stream_agent(prompt, session_id)
+                try:
+                    while True:
+                        print(next(tokens), end="", flush=True)
+                except StopIteration as done:
+                    cmd, result = done.value
+                print()
                 
                 if cmd and cmd != "None":
                     print(f"🔧 Command executed: {cmd}")
@@ -70,6 +137,8 @@ def main():
                 
     except Exception as e:
         print(f"Error: {e}")
+    finally:
+        end_session(session_id)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,554 @@
+import asyncio
+import glob
+import hashlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+# Locations of the llama.cpp HTTP server binary (built alongside llama-cli)
+LLAMA_SERVER_PATHS = [
+    "/app/workspace/projects/llama.cpp/server",
+    "/app/workspace/llama.cpp/build/bin/llama-server",
+    "/usr/local/bin/llama-server",
+    "llama-server"
+]
+
+# The resident server only listens on loopback; Flask is the public entry point
+LLAMA_SERVER_HOST = os.environ.get("LLAMA_SERVER_HOST", "127.0.0.1")
+LLAMA_SERVER_PORT = int(os.environ.get("LLAMA_SERVER_PORT", "8081"))
+
+# Seconds to wait for the model to load before a start attempt counts as failed
+LOAD_TIMEOUT = int(os.environ.get("LLAMA_SERVER_LOAD_TIMEOUT", "300"))
+MAX_RESTART_BACKOFF = 30
+
+
+class SlotUnavailable(RuntimeError):
+    """Raised when no llama-server slot frees up for a request in time"""
+
+
+def abort_response(response):
+    """
+    Break off a streaming response from another thread.
+
+    Shutting the socket down wakes a reader blocked on it (a plain close
+    would not), which then fails with a connection error, and llama-server
+    sees the disconnect and frees the slot.
+    """
+    connection = getattr(response.raw, "_connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def session_filename(session_id, suffix="*"):
+    """Slot file a session's KV state is spilled to; `suffix` tells apart models and context sizes"""
+    return f"session-{hashlib.sha256(session_id.encode()).hexdigest()[:16]}-{suffix}.bin"
+
+
+def remove_session_files(slot_save_path, session_id):
+    """Delete every spilled KV state of a session"""
+    for path in glob.glob(os.path.join(slot_save_path, session_filename(session_id))):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def find_llama_server():
+    """Find the llama-server executable in common locations"""
+    for path in LLAMA_SERVER_PATHS:
+        if os.path.exists(path) and os.access(path, os.X_OK):
+            return path
+
+    try:
+        result = subprocess.run(["which", "llama-server"], capture_output=True, text=True)
+        if result.returncode == 0:
+            return result.stdout.strip()
+    except Exception:
+        pass
+
+    return None
+
+
+class LlamaServer:
+    """
+    Supervises one resident llama-server process.
+
+    The model is loaded once when the process starts; prompts are forwarded
+    to it over HTTP on the loopback interface. A monitor thread restarts the
+    process with exponential backoff if it exits unexpectedly.
+
+    With `session_slots`, that many extra slots are reserved for
+    conversations: a session's turns run in the slot pinned to it, so the
+    KV cache of the conversation so far is reused. When every session slot
+    is taken, the least recently used idle session is spilled to
+    `slot_save_path` (if set) and restored on its next turn.
+
+    `tune(model_path)`, if given, is called in the monitor thread before
+    the process is first started and returns the "threads", "batch_size"
+    and "ubatch_size" to use; it may run a calibration sweep.
+    """
+
+    def __init__(self, executable, model_path, port=LLAMA_SERVER_PORT,
+                 ctx_size=2048, threads=4, parallel=1, shared_prefix=None,
+                 slot_save_path=None, extra_args=None, session_slots=0,
+                 batch_size=None, ubatch_size=None, tune=None):
+        self.executable = executable
+        self.model_path = model_path
+        self.port = port
+        self.ctx_size = ctx_size
+        self.threads = threads
+        self.batch_size = batch_size
+        self.ubatch_size = ubatch_size
+        self.tune = tune
+        self.tuning = None
+        self.parallel = max(1, parallel)
+        self.session_slots = max(0, session_slots)
+        self.shared_prefix = shared_prefix
+        self.slot_save_path = slot_save_path
+        self.extra_args = list(extra_args or [])
+        self.base_url = f"http://{LLAMA_SERVER_HOST}:{port}"
+
+        self.state = "stopped"
+        self.prefix_slots = {"evaluated": 0, "restored": 0}
+        self.session_stats = {"spilled": 0, "restored": 0, "unpinned": 0}
+        self.restarts = 0
+        self.last_error = None
+        self.started_at = None
+        self.load_seconds = None
+
+        self._process = None
+        self._stopping = False
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._leases = 0
+        self._idle = threading.Condition()
+        self._monitor = None
+        self._http = requests.Session()
+
+        # Session slot pins, least recently used first, and the slots in use.
+        # Other requests take the first `parallel` slots so they never
+        # overwrite a session's KV cache.
+        self._pinned = OrderedDict()
+        self._busy_slots = set()
+        self._slot_lock = threading.Lock()
+        self._slot_released = threading.Condition(self._slot_lock)
+
+    @property
+    def slots(self):
+        return self.parallel + self.session_slots
+
+    def command(self):
+        """Build the llama-server command line"""
+        return [
+            self.executable,
+            "-m", self.model_path,
+            "--host", LLAMA_SERVER_HOST,
+            "--port", str(self.port),
+            # llama-server splits -c evenly between its slots
+            "-c", str(self.ctx_size * self.slots),
+            "-t", str(self.threads),
+            # Decode all active slots together in one batch per step
+            "-np", str(self.slots),
+            "--cont-batching",
+        ] + (["-b", str(self.batch_size)] if self.batch_size else []) + (
+            ["-ub", str(self.ubatch_size)] if self.ubatch_size else []) + (
+            ["--slot-save-path", self.slot_save_path] if self.slot_save_path else []) + self.extra_args
+
+    def start(self):
+        """Start the server process and its supervising monitor thread"""
+        with self._lock:
+            if self._monitor and self._monitor.is_alive():
+                return
+            self._stopping = False
+            self._monitor = threading.Thread(target=self._supervise, name=f"llama-server-{self.port}", daemon=True)
+            self._monitor.start()
+
+    def stop(self, timeout=10):
+        """Stop the server process and do not restart it"""
+        with self._lock:
+            self._stopping = True
+            process = self._process
+        self._ready.clear()
+        if process and process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        if self._monitor and self._monitor is not threading.current_thread():
+            self._monitor.join(timeout=timeout)
+        self.state = "stopped"
+
+    def wait_ready(self, timeout=None):
+        """Block until the model is loaded; returns False on timeout"""
+        return self._ready.wait(timeout)
+
+    def is_ready(self):
+        return self._ready.is_set()
+
+    def hold(self):
+        """Register a request that is about to use this server"""
+        with self._idle:
+            self._leases += 1
+
+    def unhold(self):
+        with self._idle:
+            self._leases -= 1
+            if self._leases == 0:
+                self._idle.notify_all()
+
+    def drain(self, timeout=None):
+        """Wait until no request holds this server; returns False on timeout"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._leases == 0, timeout)
+
+    @property
+    def active_requests(self):
+        return self._leases
+
+    def _spawn(self):
+        print(f"Starting llama-server: {' '.join(self.command())}", file=sys.stderr)
+        # Inherit stderr so llama-server diagnostics end up in the container log
+        return subprocess.Popen(self.command(), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+
+    def _wait_loaded(self, process):
+        """Poll the server's /health until the model is loaded or the process dies"""
+        deadline = time.monotonic() + LOAD_TIMEOUT
+        while time.monotonic() < deadline and not self._stopping:
+            if process.poll() is not None:
+                return False
+            try:
+                response = self._http.get(f"{self.base_url}/health", timeout=2)
+                if response.status_code == 200:
+                    return True
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(0.5)
+        return False
+
+    def _supervise(self):
+        if self.tune is not None and self.tuning is None:
+            self.state = "tuning"
+            self.tuning = self.tune(self.model_path)
+            self.threads = self.tuning.get("threads") or self.threads
+            self.batch_size = self.tuning.get("batch_size") or self.batch_size
+            self.ubatch_size = self.tuning.get("ubatch_size") or self.ubatch_size
+        backoff = 1
+        while not self._stopping:
+            self.state = "loading"
+            load_started = time.monotonic()
+            try:
+                process = self._spawn()
+            except OSError as e:
+                self.state = "failed"
+                self.last_error = f"Cannot start llama-server: {e}"
+                print(self.last_error, file=sys.stderr)
+                return
+
+            with self._lock:
+                self._process = process
+
+            error = None
+            if self._wait_loaded(process):
+                self._prime_prefix()
+                self.load_seconds = round(time.monotonic() - load_started, 3)
+                self.state = "ready"
+                self.started_at = time.time()
+                self.last_error = None
+                self._ready.set()
+                backoff = 1
+                print(f"llama-server ready on port {self.port} (loaded in {self.load_seconds}s)", file=sys.stderr)
+            elif process.poll() is None and not self._stopping:
+                error = f"Model did not load within {LOAD_TIMEOUT}s"
+                process.kill()
+
+            returncode = process.wait()
+            self._ready.clear()
+            if self._stopping:
+                break
+
+            self.restarts += 1
+            self.state = "restarting"
+            self.last_error = error or f"llama-server exited with code {returncode}"
+            print(f"{self.last_error}; restarting in {backoff}s", file=sys.stderr)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_RESTART_BACKOFF)
+
+    def _state_hash(self, extra=""):
+        """Digest of what a saved KV state is only valid for: this model file and context size"""
+        stat = os.stat(self.model_path)
+        material = f"{self.model_path}:{stat.st_size}:{stat.st_mtime_ns}:{self.ctx_size}:{extra}"
+        return hashlib.sha256(material.encode()).hexdigest()[:16]
+
+    def _prefix_filename(self):
+        """Slot file for the shared prefix, specific to this model file and context size"""
+        return f"prefix-{self._state_hash(self.shared_prefix)}.bin"
+
+    def _slot_action(self, slot, action, filename):
+        try:
+            response = self._http.post(f"{self.base_url}/slots/{slot}?action={action}",
+                                       json={"filename": filename}, timeout=LOAD_TIMEOUT)
+            return response.status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
+    def _prime_prefix(self):
+        """
+        Load the KV state of the shared prompt prefix into every slot.
+
+        With prompt caching each request then only evaluates the tokens after
+        the prefix. The state is restored from --slot-save-path when a saved
+        copy exists; otherwise it is evaluated once and saved for next time.
+        """
+        self.prefix_slots = {"evaluated": 0, "restored": 0}
+        # A (re)started server holds no session state; spilled copies stay valid
+        with self._slot_lock:
+            self._pinned.clear()
+        if not self.shared_prefix:
+            return
+
+        filename = self._prefix_filename() if self.slot_save_path else None
+        saved = filename is not None and os.path.exists(os.path.join(self.slot_save_path, filename))
+        for slot in range(self.slots):
+            if saved and self._slot_action(slot, "restore", filename):
+                self.prefix_slots["restored"] += 1
+                continue
+            try:
+                response = self._http.post(f"{self.base_url}/completion", json={
+                    "prompt": self.shared_prefix,
+                    "n_predict": 0,
+                    "id_slot": slot,
+                    "cache_prompt": True,
+                }, timeout=LOAD_TIMEOUT)
+            except requests.exceptions.RequestException as e:
+                print(f"Could not prime prompt prefix in slot {slot}: {e}", file=sys.stderr)
+                return
+            if response.status_code != 200:
+                print(f"Could not prime prompt prefix in slot {slot}: HTTP {response.status_code}", file=sys.stderr)
+                return
+            self.prefix_slots["evaluated"] += 1
+            if filename and not saved:
+                saved = self._slot_action(slot, "save", filename)
+
+        print(f"Prompt prefix resident in {self.slots} slot(s): "
+              f"{self.prefix_slots['restored']} restored, {self.prefix_slots['evaluated']} evaluated", file=sys.stderr)
+
+    def checkout_slot(self, session=None, timeout=60):
+        """
+        The slot a request should run in, or None (without session slots)
+        to let llama-server pick.
+
+        A session gets the slot pinned to it, pinning one first (spilling
+        the least recently used idle session, and restoring this session's
+        spilled state) if needed. Other requests, and sessions while every
+        session slot is running a turn, get a slot outside the session
+        slots, waiting up to `timeout` seconds for one: an explicit slot
+        keeps llama-server from putting them in a session's slot and
+        overwriting its KV cache. Raises SlotUnavailable. Pair with
+        release_slot(). Blocks on llama-server while spilling or restoring.
+        """
+        if not self.session_slots:
+            return None
+        with self._slot_lock:
+            if session is None:
+                return self._general_slot(timeout)
+
+            evicted = None
+            slot = self._pinned.get(session)
+            restore = slot is None
+            if slot is None:
+                pinned = set(self._pinned.values())
+                slot = next((s for s in range(self.parallel, self.slots) if s not in pinned), None)
+                if slot is None:
+                    evicted = next((other for other, s in self._pinned.items() if s not in self._busy_slots), None)
+                    if evicted is None:
+                        # Run this turn unpinned, re-evaluating the conversation
+                        self.session_stats["unpinned"] += 1
+                        return self._general_slot(timeout)
+                    slot = self._pinned.pop(evicted)
+            self._pinned[session] = slot
+            self._pinned.move_to_end(session)
+            self._busy_slots.add(slot)
+
+        if self.slot_save_path and evicted is not None:
+            if self._slot_action(slot, "save", session_filename(evicted, self._state_hash())):
+                self.session_stats["spilled"] += 1
+        if self.slot_save_path and restore:
+            filename = session_filename(session, self._state_hash())
+            path = os.path.join(self.slot_save_path, filename)
+            if os.path.exists(path) and self._slot_action(slot, "restore", filename):
+                self.session_stats["restored"] += 1
+                os.remove(path)
+        return slot
+
+    def _general_slot(self, timeout):
+        """Take a free slot outside the session slots (lock held), waiting for one to be released"""
+        deadline = time.monotonic() + timeout
+        while True:
+            slot = next((s for s in range(self.parallel) if s not in self._busy_slots), None)
+            if slot is not None:
+                self._busy_slots.add(slot)
+                return slot
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self._slot_released.wait(remaining):
+                raise SlotUnavailable(f"All {self.parallel} llama-server slot(s) outside the session slots "
+                                      f"stayed busy for {timeout}s")
+
+    def release_slot(self, slot):
+        if slot is not None:
+            with self._slot_lock:
+                self._busy_slots.discard(slot)
+                self._slot_released.notify()
+
+    def end_session(self, session):
+        """Unpin a finished session's slot (its KV state is overwritten by the next session)"""
+        with self._slot_lock:
+            slot = self._pinned.get(session)
+            if slot is not None and slot not in self._busy_slots:
+                del self._pinned[session]
+
+    def _payload(self, prompt, n_predict, temperature, stream=False, stop=None, slot=None):
+        if not self._ready.is_set():
+            raise RuntimeError(f"llama-server is not ready (state: {self.state})")
+        payload = {
+            "prompt": prompt,
+            "n_predict": n_predict,
+            "temperature": temperature,
+            "cache_prompt": True,
+            "stream": stream,
+        }
+        if stop:
+            # llama-server ends the generation itself and leaves the stop sequence out
+            payload["stop"] = list(stop)
+        if slot is not None:
+            payload["id_slot"] = slot
+        return payload
+
+    def complete(self, prompt, n_predict, temperature, timeout=60, stop=None, session=None):
+        """Run a completion on the resident model and return the server's JSON result"""
+        slot = self.checkout_slot(session, timeout)
+        try:
+            payload = self._payload(prompt, n_predict, temperature, stop=stop, slot=slot)
+            response = self._http.post(f"{self.base_url}/completion", json=payload, timeout=timeout)
+            response.raise_for_status()
+            return response.json()
+        finally:
+            self.release_slot(slot)
+
+    def stream(self, prompt, n_predict, temperature, timeout=60, stop=None, on_response=None, session=None):
+        """
+        Run a streaming completion and yield the server's JSON events.
+
+        Closing the generator closes the HTTP response, which makes
+        llama-server stop generating for this request. `on_response` is
+        called with the response as soon as it is open, e.g. to keep it
+        for abort_response(). `session` runs it in that session's slot.
+        """
+        slot = self.checkout_slot(session, timeout)
+        try:
+            payload = self._payload(prompt, n_predict, temperature, stream=True, stop=stop, slot=slot)
+            response = self._http.post(f"{self.base_url}/completion", json=payload, stream=True, timeout=timeout)
+        except BaseException:
+            self.release_slot(slot)
+            raise
+        if on_response is not None:
+            on_response(response)
+        try:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                # Server-Sent Events: one "data: {...}" line per token
+                if not line.startswith(b"data: "):
+                    continue
+                event = json.loads(line[len(b"data: "):])
+                yield event
+                if event.get("stop"):
+                    break
+        finally:
+            response.close()
+            self.release_slot(slot)
+
+    async def astream(self, client, prompt, n_predict, temperature, timeout=60, stop=None, session=None):
+        """
+        Asyncio variant of stream() using an httpx.AsyncClient.
+
+        Closing the async generator closes the response, which likewise stops
+        the generation in llama-server.
+        """
+        slot = None
+        if self.session_slots:
+            slot = await asyncio.to_thread(self.checkout_slot, session, timeout)
+        try:
+            payload = self._payload(prompt, n_predict, temperature, stream=True, stop=stop, slot=slot)
+            async with client.stream("POST", f"{self.base_url}/completion", json=payload, timeout=timeout) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: "):
+                        continue
+                    event = json.loads(line[len("data: "):])
+                    yield event
+                    if event.get("stop"):
+                        break
+        finally:
+            self.release_slot(slot)
+
+    def embed(self, texts, timeout=60):
+        """
+        Embed `texts` on a server started with --embeddings: one vector per
+        text. llama-server pools and L2-normalizes them unless the model has
+        no pooling, in which case the per-token vectors are averaged here.
+        """
+        if not self._ready.is_set():
+            raise RuntimeError(f"llama-server is not ready (state: {self.state})")
+        response = self._http.post(f"{self.base_url}/embedding", json={"content": list(texts)}, timeout=timeout)
+        if response.status_code >= 400:
+            try:
+                message = response.json()["error"]["message"]
+            except (ValueError, KeyError, TypeError):
+                message = response.text[:300]
+            raise RuntimeError(f"llama-server could not embed the input: {message}")
+        results = response.json()
+        if isinstance(results, dict):
+            results = [results]
+        vectors = [None] * len(texts)
+        for position, result in enumerate(results):
+            embedding = result["embedding"]
+            if embedding and isinstance(embedding[0], list):
+                embedding = embedding[0] if len(embedding) == 1 else [
+                    sum(column) / len(embedding) for column in zip(*embedding)]
+            vectors[result.get("index", position)] = embedding
+        return vectors
+
+    def status(self):
+        """Supervisor state for the /health endpoint"""
+        process = self._process
+        return {
+            "state": self.state,
+            "pid": process.pid if process and process.poll() is None else None,
+            "port": self.port,
+            "model_path": self.model_path,
+            "parallel_slots": self.parallel,
+            "threads": self.threads,
+            "batch_size": self.batch_size,
+            "ubatch_size": self.ubatch_size,
+            "tuning": self.tuning.get("source") if self.tuning else None,
+            "prefix_slots": self.prefix_slots,
+            "session_slots": self.session_slots,
+            "sessions": dict(self.session_stats, pinned=len(self._pinned)),
+            "active_requests": self._leases,
+            "restarts": self.restarts,
+            "load_seconds": self.load_seconds,
+            "uptime_seconds": round(time.time() - self.started_at, 1) if self.started_at and self.is_ready() else None,
+            "last_error": self.last_error,
+        }
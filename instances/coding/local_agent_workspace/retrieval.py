@@ -0,0 +1,134 @@
+import os
+import threading
+
+import llm_interface
+import vector_index
+
+# Retrieval-augmented answering: documents given to /api/index are split
+# into overlapping chunks, embedded by the embedding server and kept in the
+# vector index; a request with "retrieve": k gets the k chunks closest to
+# its prompt put in front of it.
+
+# Characters per chunk, and how many of them neighbouring chunks share. A
+# chunk has to fit in EMBED_CTX_SIZE tokens (about 4 characters each).
+CHUNK_SIZE = int(os.environ.get("RETRIEVAL_CHUNK_SIZE", "1000"))
+CHUNK_OVERLAP = int(os.environ.get("RETRIEVAL_CHUNK_OVERLAP", "150"))
+
+# Most chunks a request may retrieve, and most characters of them added
+# to its prompt; the model's context (LLM_CTX_SIZE) has to hold both
+MAX_RETRIEVE = int(os.environ.get("RETRIEVAL_MAX_K", "8"))
+MAX_CONTEXT_CHARS = int(os.environ.get("RETRIEVAL_MAX_CONTEXT", "4000"))
+
+# Chunks scoring at or below this cosine similarity are left out as unrelated
+MIN_SCORE = float(os.environ.get("RETRIEVAL_MIN_SCORE", "0"))
+
+CONTEXT_HEADER = "Use the following context to answer if it is relevant.\n\n"
+
+# Errors of the retrieval path: no embedding model or numpy (503), an
+# index built with another embedding model (409) or a failed embedding (502)
+ERRORS = (llm_interface.LLMError, RuntimeError, ValueError)
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def index():
+    """The vector index, opened on first use"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = vector_index.VectorIndex()
+        return _index
+
+
+def error_status(error):
+    """HTTP status for one of ERRORS"""
+    if isinstance(error, ValueError):
+        return 409
+    if isinstance(error, (llm_interface.EmbeddingsUnavailable, RuntimeError)):
+        return 503
+    return 502
+
+
+def chunk_text(text, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """
+    Split text into chunks of at most `size` characters, cut at a
+    paragraph, sentence or word boundary where there is one in the second
+    half, each starting `overlap` characters before the previous one ended.
+    """
+    text = text.strip()
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + size)
+        if end < len(text):
+            for separator in ("\n\n", ". ", " "):
+                cut = text.rfind(separator, start + size // 2, end)
+                if cut != -1:
+                    end = cut + len(separator)
+                    break
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end == len(text):
+            break
+        # Start the overlap on a word
+        start = max(end - overlap, start + 1)
+        space = text.find(" ", start, end)
+        if space != -1:
+            start = space + 1
+    return chunks
+
+
+def add_documents(documents):
+    """Chunk, embed and store (id, text) documents, replacing earlier versions; returns chunks per id"""
+    store = index()
+    model = llm_interface.embedding_model()
+    counts = {}
+    for doc, text in documents:
+        chunks = chunk_text(text)
+        vectors = llm_interface.embed(chunks) if chunks else []
+        counts[doc] = store.add(doc, chunks, vectors, model=model)
+    return counts
+
+
+def delete_document(doc):
+    """Remove a document's chunks; returns how many there were"""
+    return index().delete(doc)
+
+
+def search(query, k):
+    """The `k` stored chunks most similar to `query`, best first"""
+    vector = llm_interface.embed([query])[0]
+    return index().search(vector, k, model=llm_interface.embedding_model())
+
+
+def augment(prompt, k):
+    """
+    The prompt with up to `k` retrieved chunks in front of it (those above
+    MIN_SCORE, as many as fit in MAX_CONTEXT_CHARS), and where those
+    chunks came from.
+    """
+    context = []
+    length = 0
+    for hit in search(prompt, k):
+        if hit["score"] <= MIN_SCORE or (context and length + len(hit["text"]) > MAX_CONTEXT_CHARS):
+            break
+        context.append(hit)
+        length += len(hit["text"])
+    if not context:
+        return prompt, []
+    blocks = "\n\n".join(f"[{number}] {hit['text']}" for number, hit in enumerate(context, 1))
+    sources = [{"id": hit["doc"], "chunk": hit["chunk"], "score": hit["score"]} for hit in context]
+    return f"{CONTEXT_HEADER}{blocks}\n\nQuestion: {prompt}", sources
+
+
+def prompt_for(data):
+    """
+    The prompt of a valid /api/agent request body with the chunks its
+    "retrieve" asks for in front, and their sources (None when it asks for
+    none). Raises one of ERRORS.
+    """
+    if not data.get('retrieve'):
+        return data['prompt'], None
+    return augment(data['prompt'], data['retrieve'])
@@ -0,0 +1,350 @@
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+
+# Generations allowed to run at once (0 = one per backend slot); the rest
+# wait in a bounded queue ordered by priority, then earliest deadline
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("MAX_CONCURRENT_REQUESTS", "0"))
+MAX_QUEUE_SIZE = int(os.environ.get("MAX_QUEUE_SIZE", "8"))
+
+# Seconds a request may wait in the queue before it is turned away
+QUEUE_TIMEOUT = float(os.environ.get("QUEUE_TIMEOUT", "60"))
+
+# Weight of the newest sample in the moving averages used for estimates
+EWMA_ALPHA = 0.2
+
+# Request priority classes, most urgent first
+PRIORITIES = {"interactive": 0, "normal": 1, "batch": 2}
+INTERACTIVE, NORMAL, BATCH = 0, 1, 2
+
+# Let an interactive request that finds every slot busy abort a running
+# batch generation, which is queued again behind it
+PREEMPT_BATCH = os.environ.get("PREEMPT_BATCH", "1") != "0"
+
+_sequence = itertools.count()
+
+
+class QueueFull(Exception):
+    """Raised when the wait queue is full; carries a Retry-After estimate in seconds"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Server busy: request queue is full (retry after {retry_after}s)")
+        self.retry_after = retry_after
+
+
+class QueueTimeout(Exception):
+    """Raised when a request waited longer than the queue timeout"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Server busy: request was not scheduled in time (retry after {retry_after}s)")
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """Raised instead of running a request that cannot finish before its deadline"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Server busy: request cannot finish before its deadline (retry after {retry_after}s)")
+        self.retry_after = retry_after
+
+
+class Preempted(Exception):
+    """A batch generation was stopped to give its slot to an interactive request"""
+
+    def __init__(self):
+        super().__init__("Generation preempted by an interactive request")
+
+
+class Ticket:
+    """A granted generation slot; release it exactly once when the work is done"""
+
+    def __init__(self, scheduler, notify=None, priority=NORMAL, deadline=None):
+        self._scheduler = scheduler
+        self._event = threading.Event()
+        # Called (with the scheduler lock held) when the slot is granted, or
+        # when the request is turned away while queued (`error` is then set)
+        self._notify = notify or self._event.set
+        self.priority = priority
+        # time.monotonic() by which the generation must be finished, or None
+        self.deadline = deadline
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.released = False
+        self.error = None
+        # Set by the owner of a running generation: aborts it and returns
+        # True, or returns False if it can no longer be preempted
+        self.preempt = None
+        self._preempting = False
+        self._order = (priority, math.inf if deadline is None else deadline, next(_sequence))
+
+    def __lt__(self, other):
+        return self._order < other._order
+
+    @property
+    def wait_seconds(self):
+        return (self.started_at or time.monotonic()) - self.enqueued_at
+
+    def release(self):
+        self._scheduler.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class RequestScheduler:
+    """
+    Admission control in front of the LLM backend.
+
+    At most `max_concurrent` requests generate at a time and up to
+    `max_queue` more wait, served by priority class and then earliest
+    deadline. Anything beyond that is rejected immediately with a
+    Retry-After estimate instead of piling more threads (and llama.cpp
+    processes) onto the instance's CPUs.
+
+    A request whose deadline the average service time says it would miss
+    is rejected up front, or dropped from the queue once it can no longer
+    make it, rather than run anyway. Batch work is deferred: other requests
+    are served first and push queued batch requests out of a full queue,
+    and interactive ones may preempt a running batch generation.
+    """
+
+    def __init__(self, max_concurrent=1, max_queue=MAX_QUEUE_SIZE,
+                 queue_timeout=QUEUE_TIMEOUT, preempt_batch=PREEMPT_BATCH):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.preempt_batch = preempt_batch
+
+        self._lock = threading.Lock()
+        self._waiting = []
+        self._running = set()
+        self._active = 0
+
+        self._avg_wait = 0.0
+        self._avg_service = None
+        self._max_wait = 0.0
+        self._admitted = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._missed_deadline = 0
+        self._displaced = 0
+        self._preempted = 0
+
+    def acquire(self, timeout=None, priority=NORMAL, deadline=None):
+        """
+        Wait for a generation slot and return its Ticket.
+
+        Raises QueueFull when the queue is already full, QueueTimeout when
+        no slot frees up within the queue timeout and DeadlineExceeded when
+        the request could not finish before `deadline` (a time.monotonic()
+        value).
+        """
+        ticket = self._enqueue(Ticket(self, priority=priority, deadline=deadline))
+        if ticket.started_at is None and not ticket._event.wait(self._wait_timeout(ticket, timeout)):
+            return self._abandon(ticket)
+        return self._granted(ticket)
+
+    async def acquire_async(self, timeout=None, priority=NORMAL, deadline=None):
+        """
+        Asyncio variant of acquire(): waits without blocking the event loop.
+
+        If the awaiting task is cancelled while queued, the request leaves
+        the queue (or gives back a slot granted in the meantime).
+        """
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        ticket = self._enqueue(Ticket(self, notify, priority, deadline))
+        if ticket.started_at is not None:
+            return ticket
+        try:
+            await asyncio.wait_for(asyncio.shield(granted), self._wait_timeout(ticket, timeout))
+            return self._granted(ticket)
+        except asyncio.TimeoutError:
+            return self._abandon(ticket)
+        except asyncio.CancelledError:
+            with self._lock:
+                queued = ticket.started_at is None
+                if queued and ticket.error is None:
+                    self._dequeue(ticket)
+            if not queued:
+                ticket.release()
+            raise
+
+    def _enqueue(self, ticket):
+        """Grant the ticket right away if a slot is free, otherwise queue it"""
+        victim = None
+        with self._lock:
+            if ticket.deadline is not None and self._misses_deadline_locked(ticket):
+                self._missed_deadline += 1
+                raise DeadlineExceeded(self._retry_after_locked())
+            if self._active < self.max_concurrent and not self._waiting:
+                self._active += 1
+                self._grant(ticket)
+                return ticket
+            if len(self._waiting) >= self.max_queue:
+                # A full queue makes room for more urgent work by turning
+                # away its last batch request
+                last = max(self._waiting, default=None)
+                if last is None or last.priority != BATCH or ticket.priority == BATCH:
+                    self._rejected += 1
+                    raise QueueFull(self._retry_after_locked())
+                self._dequeue(last)
+                self._displaced += 1
+                self._turn_away(last, QueueFull(self._retry_after_locked()))
+            heapq.heappush(self._waiting, ticket)
+            if ticket.priority == INTERACTIVE and self.preempt_batch:
+                victim = self._preemption_victim_locked()
+        # Abort outside the lock; the victim's release() hands its slot to the
+        # most urgent waiter
+        if victim is not None:
+            preempted = victim.preempt()
+            with self._lock:
+                if preempted:
+                    self._preempted += 1
+                else:
+                    victim._preempting = False
+        return ticket
+
+    def _preemption_victim_locked(self):
+        """The most recently started preemptible batch generation, unless one is already being preempted"""
+        if any(t._preempting for t in self._running):
+            return None
+        candidates = [t for t in self._running if t.priority == BATCH and t.preempt is not None]
+        if not candidates:
+            return None
+        victim = max(candidates, key=lambda t: t.started_at)
+        victim._preempting = True
+        return victim
+
+    def _dequeue(self, ticket):
+        """Remove a waiting ticket from the heap (lock held)"""
+        self._waiting.remove(ticket)
+        heapq.heapify(self._waiting)
+
+    def _turn_away(self, ticket, error):
+        """Fail a queued ticket (lock held; it is already off the heap)"""
+        ticket.error = error
+        ticket._notify()
+
+    def _granted(self, ticket):
+        """Return a woken ticket, or raise the error it was turned away with"""
+        if ticket.error is not None:
+            raise ticket.error
+        return ticket
+
+    def _wait_timeout(self, ticket, timeout):
+        """Seconds to wait for a slot: the queue timeout, cut short by the deadline"""
+        timeout = self.queue_timeout if timeout is None else timeout
+        if ticket.deadline is None:
+            return timeout
+        latest_start = ticket.deadline - (self._avg_service or 0.0)
+        return max(0.0, min(timeout, latest_start - time.monotonic()))
+
+    def _misses_deadline_locked(self, ticket):
+        """
+        True if a new ticket is expected to finish after its deadline: the
+        requests ahead of it drain `max_concurrent` at a time, each taking
+        the average service time.
+        """
+        if self._avg_service is None:
+            return time.monotonic() >= ticket.deadline
+        wait = 0.0
+        if self._active >= self.max_concurrent or self._waiting:
+            ahead = sum(1 for t in self._waiting if t < ticket)
+            wait = (ahead // self.max_concurrent + 0.5) * self._avg_service
+        return time.monotonic() + wait + self._avg_service > ticket.deadline
+
+    def _abandon(self, ticket):
+        """Give up on a queued ticket whose wait timed out"""
+        with self._lock:
+            # A slot may have been granted (or the ticket turned away) between
+            # the timeout and taking the lock
+            if ticket.started_at is not None or ticket.error is not None:
+                return self._granted(ticket)
+            self._dequeue(ticket)
+            if ticket.deadline is not None and time.monotonic() + (self._avg_service or 0.0) >= ticket.deadline:
+                self._missed_deadline += 1
+                raise DeadlineExceeded(self._retry_after_locked())
+            self._timed_out += 1
+            raise QueueTimeout(self._retry_after_locked())
+
+    def release(self, ticket):
+        """Return a ticket's slot and hand it to the most urgent waiting request"""
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            self._running.discard(ticket)
+            now = time.monotonic()
+            # A preempted generation says nothing about how long work takes
+            if not ticket._preempting:
+                service = now - ticket.started_at
+                self._avg_service = service if self._avg_service is None else (
+                    EWMA_ALPHA * service + (1 - EWMA_ALPHA) * self._avg_service)
+
+            while self._waiting:
+                waiter = heapq.heappop(self._waiting)
+                if waiter.deadline is not None and now + (self._avg_service or 0.0) > waiter.deadline:
+                    self._missed_deadline += 1
+                    self._turn_away(waiter, DeadlineExceeded(self._retry_after_locked()))
+                    continue
+                self._grant(waiter)
+                return
+            self._active -= 1
+
+    def _grant(self, ticket):
+        # Called with the lock held; a slot released by one request is passed
+        # straight to the next waiter, so only the fast path bumps _active
+        ticket.started_at = time.monotonic()
+        wait = ticket.wait_seconds
+        self._avg_wait = EWMA_ALPHA * wait + (1 - EWMA_ALPHA) * self._avg_wait
+        self._max_wait = max(self._max_wait, wait)
+        self._admitted += 1
+        self._running.add(ticket)
+        ticket._notify()
+
+    def _retry_after_locked(self):
+        """Seconds until a newly queued request would likely start"""
+        service = self._avg_service or 30.0
+        return max(1, math.ceil(service * (len(self._waiting) + 1) / self.max_concurrent))
+
+    def retry_after(self):
+        with self._lock:
+            return self._retry_after_locked()
+
+    def stats(self):
+        """Queue state for the /health endpoint"""
+        with self._lock:
+            now = time.monotonic()
+            oldest_wait = now - min(t.enqueued_at for t in self._waiting) if self._waiting else 0.0
+            return {
+                "active": self._active,
+                "queue_depth": len(self._waiting),
+                "queued_by_priority": {name: sum(1 for t in self._waiting if t.priority == rank)
+                                       for name, rank in PRIORITIES.items()},
+                "running_by_priority": {name: sum(1 for t in self._running if t.priority == rank)
+                                        for name, rank in PRIORITIES.items()},
+                "max_concurrent": self.max_concurrent,
+                "max_queue": self.max_queue,
+                "oldest_wait_seconds": round(oldest_wait, 3),
+                "avg_wait_seconds": round(self._avg_wait, 3),
+                "max_wait_seconds": round(self._max_wait, 3),
+                "avg_service_seconds": round(self._avg_service, 3) if self._avg_service is not None else None,
+                "admitted_total": self._admitted,
+                "rejected_total": self._rejected,
+                "timed_out_total": self._timed_out,
+                "deadline_missed_total": self._missed_deadline,
+                "displaced_total": self._displaced,
+                "preempted_total": self._preempted,
+            }
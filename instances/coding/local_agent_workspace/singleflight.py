@@ -0,0 +1,230 @@
+import asyncio
+import threading
+
+# Seconds between checks of a subscriber's `cancelled` callback
+CANCEL_POLL_INTERVAL = 0.2
+
+
+class RequestCancelled(Exception):
+    """The subscriber's own request was cancelled or its client disconnected"""
+
+    def __init__(self):
+        super().__init__("Request cancelled")
+
+
+class FlightError(Exception):
+    """Raised to every subscriber when the shared generation fails; `cause` is the original error"""
+
+    def __init__(self, cause):
+        super().__init__(str(cause))
+        self.cause = cause
+
+
+class Flight:
+    """
+    One in-flight generation shared by every identical request.
+
+    The producer publishes tokens as they are generated; subscribers replay
+    the tokens produced so far and then follow live, so a request that joins
+    late still receives the complete response.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.tokens = []
+        self.done = False
+        self.result = None
+        self.error = None
+        self.subscribers = 0
+        # Called when the last subscriber leaves before the result is ready,
+        # to abort the generation in the backend right away
+        self.on_cancel = None
+        # Whether every subscriber would retry the generation if it were
+        # stopped for more urgent work, and whether it has been
+        self.preemptible = True
+        self.preempted = False
+        self._cond = threading.Condition()
+
+    @property
+    def cancelled(self):
+        """True once every subscriber has gone away before the result was ready"""
+        with self._cond:
+            return self.subscribers == 0 and not self.done
+
+    def publish(self, token):
+        with self._cond:
+            self.tokens.append(token)
+            self._cond.notify_all()
+
+    def finish(self, result):
+        with self._cond:
+            self.result = result
+            self.done = True
+            self._cond.notify_all()
+
+    def fail(self, error):
+        with self._cond:
+            self.error = error
+            self.done = True
+            self._cond.notify_all()
+
+    def leave(self):
+        """Drop one subscriber; the producer stops once none are left"""
+        with self._cond:
+            self.subscribers = max(0, self.subscribers - 1)
+            abandoned = self.subscribers == 0 and not self.done
+        if abandoned and self.on_cancel is not None:
+            self.on_cancel()
+
+    def _wait_changed(self, cancelled):
+        """Wait on the condition (held) for a change, or until `cancelled()` is true"""
+        if cancelled is None:
+            self._cond.wait()
+        elif cancelled():
+            raise FlightError(RequestCancelled())
+        else:
+            self._cond.wait(CANCEL_POLL_INTERVAL)
+
+    def stream(self, cancelled=None):
+        """
+        Yield every token of the generation, waiting for new ones as they arrive.
+
+        `cancelled` is polled while waiting; once it returns true the stream
+        ends with FlightError(RequestCancelled()).
+        """
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self.tokens) and not self.done:
+                    self._wait_changed(cancelled)
+                pending = self.tokens[index:]
+                finished = self.done
+            for token in pending:
+                yield token
+            index += len(pending)
+            if finished and index >= len(self.tokens):
+                break
+        if self.error is not None:
+            raise FlightError(self.error)
+
+    def wait(self, timeout=None, cancelled=None):
+        """Block until the generation finishes and return its result; `cancelled` is as for stream()"""
+        with self._cond:
+            if cancelled is not None:
+                while not self.done:
+                    self._wait_changed(cancelled)
+            elif not self._cond.wait_for(lambda: self.done, timeout):
+                raise FlightError(TimeoutError("Timed out waiting for the shared generation"))
+        if self.error is not None:
+            raise FlightError(self.error)
+        return self.result
+
+
+class AsyncFlight(Flight):
+    """
+    Flight for the asyncio server: the producer and every subscriber run on
+    the same event loop, so subscribers await a future instead of blocking
+    a thread on the condition variable.
+    """
+
+    def __init__(self, key):
+        super().__init__(key)
+        self._changed = None
+
+    def _notify(self):
+        changed, self._changed = self._changed, None
+        if changed is not None and not changed.done():
+            changed.set_result(None)
+
+    async def _until_changed(self, cancelled=None):
+        if self._changed is None:
+            self._changed = asyncio.get_running_loop().create_future()
+        changed = self._changed
+        if cancelled is None:
+            await asyncio.shield(changed)
+            return
+        while not changed.done():
+            if cancelled():
+                raise FlightError(RequestCancelled())
+            try:
+                await asyncio.wait_for(asyncio.shield(changed), CANCEL_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def publish(self, token):
+        super().publish(token)
+        self._notify()
+
+    def finish(self, result):
+        super().finish(result)
+        self._notify()
+
+    def fail(self, error):
+        super().fail(error)
+        self._notify()
+
+    async def stream(self, cancelled=None):
+        """Yield every token of the generation, awaiting new ones as they arrive"""
+        index = 0
+        while True:
+            while index < len(self.tokens):
+                token = self.tokens[index]
+                index += 1
+                yield token
+            if self.done:
+                break
+            await self._until_changed(cancelled)
+        if self.error is not None:
+            raise FlightError(self.error)
+
+    async def wait(self, timeout=None, cancelled=None):
+        """Wait until the generation finishes and return its result"""
+        async def finished():
+            while not self.done:
+                await self._until_changed(cancelled)
+        try:
+            await asyncio.wait_for(finished(), timeout)
+        except asyncio.TimeoutError:
+            raise FlightError(TimeoutError("Timed out waiting for the shared generation"))
+        if self.error is not None:
+            raise FlightError(self.error)
+        return self.result
+
+
+class SingleFlight:
+    """Coalesces identical concurrent requests onto one Flight per key"""
+
+    def __init__(self, flight_class=Flight):
+        self._flight_class = flight_class
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def join(self, key):
+        """
+        Subscribe to the flight for key, creating it if none is running.
+
+        Returns (flight, leader); the leader is responsible for producing
+        the result and calling forget() once it is done.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None or flight.done
+            if leader:
+                flight = self._flight_class(key)
+                self._flights[key] = flight
+            else:
+                self.coalesced += 1
+            with flight._cond:
+                flight.subscribers += 1
+            return flight, leader
+
+    def forget(self, flight):
+        """Stop routing new requests to a flight"""
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._flights), "coalesced_total": self.coalesced}
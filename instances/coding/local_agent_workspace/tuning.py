@@ -0,0 +1,274 @@
+import hashlib
+import json
+import math
+import os
+import subprocess
+import sys
+import threading
+import time
+
+# Thread count, batch and micro-batch size for llama.cpp, chosen per host:
+# the container's CPU quota and core count bound the thread count, and an
+# optional calibration sweep with llama-bench picks the fastest combination
+# for a model. Results are kept per (model, host) and reused on later starts.
+
+# "1" runs the calibration sweep when no result is stored for the model on
+# this host, "force" reruns it on every start, "0" only reuses stored results
+TUNE = os.environ.get("LLM_TUNE", "0").lower()
+
+# JSON file the calibrated settings are kept in; the workspace mount
+# survives container restarts
+TUNING_FILE = os.environ.get("LLM_TUNING_FILE") or (
+    "/app/workspace/cache/tuning.json" if os.path.isdir("/app/workspace")
+    else os.path.expanduser("~/.cache/simplebrain/tuning.json"))
+
+# Seconds the whole sweep may take before the defaults are used instead
+TUNE_TIMEOUT = int(os.environ.get("LLM_TUNE_TIMEOUT", "600"))
+
+# Workload each candidate is measured on: a prompt of this many tokens and
+# a generation of this many, repeated TUNE_REPETITIONS times
+TUNE_PROMPT_TOKENS = int(os.environ.get("LLM_TUNE_PROMPT_TOKENS", "256"))
+TUNE_GEN_TOKENS = int(os.environ.get("LLM_TUNE_GEN_TOKENS", "32"))
+TUNE_REPETITIONS = 2
+
+# Batch (-b) and micro-batch (-ub) sizes the sweep tries
+BATCH_SIZES = (64, 128, 256, 512)
+UBATCH_SIZES = (32, 128, 512)
+
+# Locations of llama.cpp's benchmark tool, built alongside llama-server
+LLAMA_BENCH_PATHS = [
+    "/app/workspace/projects/llama.cpp/llama-bench",
+    "/app/workspace/llama.cpp/build/bin/llama-bench",
+    "/usr/local/bin/llama-bench",
+    "llama-bench"
+]
+
+_file_lock = threading.Lock()
+
+
+def cpu_quota():
+    """CPUs the container's cgroup allows (e.g. 2.0 for cpus: '2.0'), or None when unlimited"""
+    try:
+        # cgroup v2: "<quota> <period>", or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    for base in ("/sys/fs/cgroup/cpu", "/sys/fs/cgroup/cpu,cpuacct"):
+        try:
+            with open(os.path.join(base, "cpu.cfs_quota_us")) as f:
+                quota = int(f.read())
+            with open(os.path.join(base, "cpu.cfs_period_us")) as f:
+                period = int(f.read())
+            return None if quota <= 0 else quota / period
+        except (OSError, ValueError):
+            continue
+    return None
+
+
+def host_topology():
+    """
+    The CPUs this process may run on: logical CPUs, the physical cores
+    behind them, the cgroup quota and the CPU model.
+    """
+    usable = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    cores = set()
+    model = None
+    try:
+        with open("/proc/cpuinfo") as f:
+            blocks = f.read().strip().split("\n\n")
+        for block in blocks:
+            fields = dict(line.split(":", 1) for line in block.splitlines() if ":" in line)
+            fields = {key.strip(): value.strip() for key, value in fields.items()}
+            model = model or fields.get("model name")
+            if int(fields.get("processor", -1)) in usable:
+                cores.add((fields.get("physical id", "0"), fields.get("core id", fields.get("processor"))))
+    except (OSError, ValueError):
+        pass
+    return {
+        "cpu_model": model,
+        "logical_cpus": os.cpu_count() or len(usable),
+        "usable_cpus": len(usable),
+        "physical_cores": len(cores) or len(usable),
+        "cpu_quota": cpu_quota(),
+    }
+
+
+def max_threads(topology):
+    """Most threads worth running: one per usable CPU, capped by the quota"""
+    limit = topology["usable_cpus"]
+    if topology["cpu_quota"]:
+        limit = min(limit, math.floor(topology["cpu_quota"]))
+    return max(1, limit)
+
+
+def default_threads(topology):
+    """Thread count without calibration: one per physical core within the quota"""
+    return max(1, min(topology["physical_cores"], max_threads(topology)))
+
+
+def host_key(topology):
+    """Identify the host (CPU model, cores and quota) the settings were measured on"""
+    return hashlib.sha256(json.dumps(topology, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def find_llama_bench(near=None):
+    """Find llama-bench, first next to the `near` executable (e.g. llama-server)"""
+    paths = list(LLAMA_BENCH_PATHS)
+    if near:
+        paths.insert(0, os.path.join(os.path.dirname(near), "llama-bench"))
+    for path in paths:
+        if os.path.exists(path) and os.access(path, os.X_OK):
+            return path
+
+    try:
+        result = subprocess.run(["which", "llama-bench"], capture_output=True, text=True)
+        if result.returncode == 0:
+            return result.stdout.strip()
+    except Exception:
+        pass
+
+    return None
+
+
+def load(model_key, topology):
+    """The stored settings for a model on this host, or None"""
+    try:
+        with open(TUNING_FILE) as f:
+            return json.load(f).get(f"{model_key}:{host_key(topology)}")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def save(model_key, topology, settings):
+    """Store a model's settings for this host, keeping the other entries"""
+    with _file_lock:
+        try:
+            with open(TUNING_FILE) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        entries[f"{model_key}:{host_key(topology)}"] = settings
+        try:
+            os.makedirs(os.path.dirname(TUNING_FILE) or ".", exist_ok=True)
+            temp = f"{TUNING_FILE}.tmp"
+            with open(temp, "w") as f:
+                json.dump(entries, f, indent=2, sort_keys=True)
+            os.replace(temp, TUNING_FILE)
+        except OSError as e:
+            print(f"Could not save tuning results to {TUNING_FILE}: {e}", file=sys.stderr)
+
+
+def thread_candidates(topology):
+    """Thread counts to try: powers of two up to max_threads(), the physical core count and the limit itself"""
+    limit = max_threads(topology)
+    candidates = {limit, default_threads(topology)}
+    candidates.update(2 ** i for i in range(limit.bit_length()) if 2 ** i <= limit)
+    return sorted(candidates)
+
+
+def _bench(bench, model_path, deadline, **lists):
+    """Run llama-bench over comma-separated parameter lists; returns its JSON results"""
+    command = [bench, "-m", model_path, "-r", str(TUNE_REPETITIONS), "-o", "json"]
+    for flag, values in lists.items():
+        command += [f"-{flag}", ",".join(str(v) for v in values)]
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True, text=True,
+                            timeout=max(1, deadline - time.monotonic()))
+    if result.returncode != 0:
+        raise RuntimeError(f"llama-bench exited with code {result.returncode}: {result.stderr.strip()[-300:]}")
+    return json.loads(result.stdout)
+
+
+def calibrate(bench, model_path, topology):
+    """
+    Sweep thread counts, then batch and micro-batch sizes, with llama-bench.
+
+    Threads are chosen for the shortest prompt-plus-generation time of the
+    TUNE_* workload; batch sizes only affect prompt evaluation, so they are
+    chosen for the fastest prompt throughput at that thread count. Returns
+    the settings, or None if the sweep failed.
+    """
+    deadline = time.monotonic() + TUNE_TIMEOUT
+    started = time.monotonic()
+    try:
+        runs = _bench(bench, model_path, deadline, t=thread_candidates(topology),
+                      p=[TUNE_PROMPT_TOKENS], n=[TUNE_GEN_TOKENS])
+        prompt_tps, gen_tps = {}, {}
+        for run in runs:
+            rates = prompt_tps if run["n_prompt"] else gen_tps
+            rates[run["n_threads"]] = run["avg_ts"]
+        threads = min((t for t in prompt_tps if gen_tps.get(t)),
+                      key=lambda t: TUNE_PROMPT_TOKENS / prompt_tps[t] + TUNE_GEN_TOKENS / gen_tps[t])
+
+        runs = _bench(bench, model_path, deadline, t=[threads], b=BATCH_SIZES, ub=UBATCH_SIZES,
+                      p=[TUNE_PROMPT_TOKENS], n=[0])
+        # A micro-batch larger than the batch is cut down to it by llama.cpp
+        best = max((run for run in runs if run["n_prompt"] and run["n_ubatch"] <= run["n_batch"]),
+                   key=lambda run: run["avg_ts"])
+    except (OSError, ValueError, KeyError, RuntimeError, subprocess.TimeoutExpired) as e:
+        print(f"Tuning sweep failed: {e}", file=sys.stderr)
+        return None
+
+    return {
+        "threads": threads,
+        "batch_size": best["n_batch"],
+        "ubatch_size": best["n_ubatch"],
+        "prompt_tokens_per_second": round(best["avg_ts"], 2),
+        "gen_tokens_per_second": round(gen_tps[threads], 2),
+        "sweep_seconds": round(time.monotonic() - started, 1),
+        "calibrated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "host": topology,
+    }
+
+
+def settings(model_path, model_key, executable=None, tune=TUNE):
+    """
+    threads/batch_size/ubatch_size for a model on this host, with a
+    "source": "stored" or "calibrated" results, or the topology "default"
+    (batch sizes None: llama.cpp's own).
+
+    With `tune` set to "1" the sweep runs when nothing is stored for the
+    (model, host) pair, with "force" every time.
+    """
+    topology = host_topology()
+    stored = load(model_key, topology) if tune != "force" else None
+    if stored:
+        return dict(stored, source="stored")
+
+    if tune in ("1", "force"):
+        bench = find_llama_bench(executable)
+        if not bench:
+            print("llama-bench not found, using the default thread count", file=sys.stderr)
+        else:
+            print(f"Calibrating llama.cpp settings for {model_path} (up to {TUNE_TIMEOUT}s)...", file=sys.stderr)
+            calibrated = calibrate(bench, model_path, topology)
+            if calibrated:
+                save(model_key, topology, calibrated)
+                print(f"Tuned: {calibrated['threads']} threads, batch {calibrated['batch_size']}, "
+                      f"ubatch {calibrated['ubatch_size']} ({calibrated['sweep_seconds']}s sweep)", file=sys.stderr)
+                return dict(calibrated, source="calibrated")
+
+    return {"threads": default_threads(topology), "batch_size": None, "ubatch_size": None,
+            "host": topology, "source": "default"}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Calibrate llama.cpp thread and batch sizes for a model on this host")
+    parser.add_argument('model', nargs='?', default=os.environ.get("MODEL_PATH"), help="GGUF model (default: MODEL_PATH)")
+    parser.add_argument('--force', action='store_true', help="Rerun the sweep even if a result is stored")
+    parser.add_argument('--show', action='store_true', help="Only print the host topology and stored result")
+    args = parser.parse_args()
+    if not args.model:
+        parser.error("no model given and MODEL_PATH is not set")
+
+    import llm_interface
+    model_key = llm_interface.model_fingerprint(args.model)
+    if args.show:
+        topology = host_topology()
+        print(json.dumps({"host": topology, "default_threads": default_threads(topology),
+                          "stored": load(model_key, topology)}, indent=2))
+    else:
+        print(json.dumps(settings(args.model, model_key, tune="force" if args.force else "1"), indent=2))
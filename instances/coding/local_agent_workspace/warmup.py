@@ -0,0 +1,180 @@
+import ctypes
+import ctypes.util
+import os
+import sys
+import threading
+import time
+
+import llm_interface
+
+# Warm up at startup: read the model into the page cache and run a tiny
+# generation before /health reports the instance as ready
+WARMUP = os.environ.get("WARMUP", "0") == "1"
+
+# Also lock the model's pages in memory so they are never evicted; needs
+# CAP_IPC_LOCK or a large enough `ulimit -l`, otherwise only the pre-read applies
+WARMUP_MLOCK = os.environ.get("WARMUP_MLOCK", "0") == "1"
+
+READ_CHUNK = 8 * 1024 * 1024
+
+PROT_READ = 0x1
+MAP_SHARED = 0x01
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc.mmap.restype = ctypes.c_void_p
+    _libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+    _libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    _libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_ubyte)]
+    _libc.mlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+except (OSError, AttributeError):
+    _libc = None
+
+MAP_FAILED = ctypes.c_void_p(-1).value
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# The locked mapping must stay alive for the lifetime of the process
+_locked = None
+
+
+def _map(path):
+    """Map a file read-only; returns (address, size) or None"""
+    size = os.path.getsize(path)
+    if _libc is None or size == 0:
+        return None
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        address = _libc.mmap(None, size, PROT_READ, MAP_SHARED, fd, 0)
+    finally:
+        os.close(fd)
+    if address in (None, MAP_FAILED):
+        return None
+    return address, size
+
+
+def resident_fraction(path):
+    """Fraction of the file's pages currently in the page cache (None if unknown)"""
+    mapping = _map(path)
+    if mapping is None:
+        return None
+    address, size = mapping
+    try:
+        pages = (size + PAGE_SIZE - 1) // PAGE_SIZE
+        vector = (ctypes.c_ubyte * pages)()
+        if _libc.mincore(address, size, vector) != 0:
+            return None
+        return sum(byte & 1 for byte in vector) / pages
+    finally:
+        _libc.munmap(address, size)
+
+
+def preload(path):
+    """Read the whole file once so later page faults are served from memory"""
+    with open(path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        buffer = bytearray(READ_CHUNK)
+        total = 0
+        while True:
+            read = f.readinto(buffer)
+            if not read:
+                return total
+            total += read
+
+
+def lock(path):
+    """Pin the file's pages in memory for as long as this process runs"""
+    global _locked
+    mapping = _map(path)
+    if mapping is None:
+        return False
+    if _libc.mlock(*mapping) != 0:
+        error = os.strerror(ctypes.get_errno())
+        _libc.munmap(*mapping)
+        print(f"Warm-up: could not mlock the model ({error}); relying on the page cache", file=sys.stderr)
+        return False
+    _locked = mapping
+    return True
+
+
+class Warmup:
+    """
+    Startup warm-up of the model, reported by /health.
+
+    Runs in a background thread: pre-reads (and optionally locks) the GGUF
+    file, waits for the backend, then runs a tiny generation so the first
+    real request does not pay for faulting the weights in from disk.
+    """
+
+    def __init__(self, model_path, use_mlock=WARMUP_MLOCK):
+        self.model_path = model_path
+        self.use_mlock = use_mlock
+        self.state = "pending"
+        self.seconds = None
+        self.resident_before = None
+        self.resident_after = None
+        self.locked = False
+        self.error = None
+        self._thread = None
+
+    def start(self):
+        self.state = "warming"
+        self._thread = threading.Thread(target=self._run, name="warmup", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        started = time.monotonic()
+        try:
+            self.resident_before = resident_fraction(self.model_path)
+            read = preload(self.model_path)
+            preloaded = time.monotonic() - started
+            if self.use_mlock:
+                self.locked = lock(self.model_path)
+
+            generation_started = time.monotonic()
+            error = llm_interface.warm_up()
+            if error:
+                raise RuntimeError(error)
+            generation = time.monotonic() - generation_started
+
+            self.resident_after = resident_fraction(self.model_path)
+            self.state = "done"
+            self.seconds = round(time.monotonic() - started, 2)
+            resident = f"{self.resident_after:.0%}" if self.resident_after is not None else "unknown"
+            print(f"Warm-up finished in {self.seconds}s: read {read / (1024 ** 3):.2f} GiB in {preloaded:.1f}s, "
+                  f"test generation {generation:.1f}s, model {resident} resident"
+                  f"{' (locked)' if self.locked else ''}", file=sys.stderr)
+        except Exception as e:
+            # A failed warm-up only costs latency; do not keep the instance out of rotation
+            self.state = "failed"
+            self.error = str(e)
+            self.seconds = round(time.monotonic() - started, 2)
+            print(f"Warm-up failed after {self.seconds}s: {e}", file=sys.stderr)
+
+    def status(self):
+        """Warm-up state for the /health endpoint"""
+        return {
+            "state": self.state,
+            "seconds": self.seconds,
+            "resident_before": round(self.resident_before, 3) if self.resident_before is not None else None,
+            "resident_after": round(self.resident_after, 3) if self.resident_after is not None else None,
+            "locked": self.locked,
+            "error": self.error,
+        }
+
+
+_warmup = None
+
+
+def start(model_path):
+    """Begin the warm-up if WARMUP=1; the backend should already be starting"""
+    global _warmup
+    if WARMUP and _warmup is None:
+        _warmup = Warmup(model_path)
+        _warmup.start()
+    return _warmup
+
+
+def status():
+    return _warmup.status() if _warmup else {"state": "disabled"}
@@ -0,0 +1,512 @@
+import hmac
+import os
+import re
+import threading
+import time
+import uuid
+
+import llm_interface
+import response_cache
+import retrieval
+import scheduler
+import warmup
+
+# Request handling shared by the Flask server (app.py) and the asyncio
+# server (asgi_app.py); nothing here depends on the web framework.
+
+MAX_PROMPT_LENGTH = 10000
+
+# Identical requests that arrive while a generation is running share it
+# instead of starting their own (DEDUPLICATE_REQUESTS=0 disables this)
+DEDUPLICATE_REQUESTS = os.environ.get("DEDUPLICATE_REQUESTS", "1") != "0"
+
+BUSY_ERRORS = (scheduler.QueueFull, scheduler.QueueTimeout, scheduler.DeadlineExceeded)
+
+# Instruction wrapper shared by every prompt; the backend keeps its KV state
+# resident so only the user's request has to be evaluated
+SYSTEM_PREAMBLE = (
+    "You are a helpful AI assistant. Your goal is to answer the user's question clearly and concisely. "
+    "User request:"
+)
+llm_interface.set_shared_prefix(SYSTEM_PREAMBLE)
+
+# Most prompts one /api/agent/batch request may carry
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "256"))
+
+# Request fields a batch applies to every prompt that does not set its own
+BATCH_DEFAULTS = ("model", "max_tokens", "temperature", "stop", "ctx_size", "priority", "deadline_ms")
+
+# Most inputs one /api/embed request may carry, and documents one /api/index request
+MAX_EMBED_INPUTS = int(os.environ.get("MAX_EMBED_INPUTS", "256"))
+MAX_INDEX_DOCUMENTS = int(os.environ.get("MAX_INDEX_DOCUMENTS", "64"))
+MAX_DOCUMENT_LENGTH = int(os.environ.get("MAX_DOCUMENT_LENGTH", "1000000"))
+
+# Client-chosen request IDs (X-Request-ID) that DELETE /api/agent/<id> accepts
+REQUEST_ID_PATTERN = re.compile(r"[A-Za-z0-9._:-]{1,128}")
+
+# The admin API (/admin/*) is disabled unless a token is configured
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+# Directory the admin API may load models from
+MODELS_DIR = os.environ.get("MODELS_DIR") or os.path.dirname(llm_interface.MODEL_PATH or "/app/models/")
+
+# For security, command execution is disabled
+COMMAND_DISABLED_RESULT = "Command execution disabled for security"
+
+class ActiveRequests:
+    """
+    Generation requests by ID, so DELETE /api/agent/<id> can cancel them.
+
+    Each request owns a threading.Event that is set when it is cancelled;
+    its handler polls the event (see Flight.wait()), stops listening and
+    leaves its flight, which aborts the backend job once no one else is
+    waiting for it.
+    """
+
+    def __init__(self):
+        self._requests = {}
+        self._lock = threading.Lock()
+        self.cancelled = 0
+
+    def register(self, request_id):
+        """The cancel event for a new request, or None if the ID is already in use"""
+        with self._lock:
+            if request_id in self._requests:
+                return None
+            event = self._requests[request_id] = threading.Event()
+            return event
+
+    def unregister(self, request_id):
+        with self._lock:
+            self._requests.pop(request_id, None)
+
+    def cancel(self, request_id):
+        """Cancel a running request; returns False if no request has that ID"""
+        with self._lock:
+            event = self._requests.get(request_id)
+            if event is None:
+                return False
+            self.cancelled += 1
+        event.set()
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {"active": len(self._requests), "cancelled_total": self.cancelled}
+
+def request_id(headers):
+    """The request's X-Request-ID if it is usable, else a new random ID"""
+    supplied = headers.get("X-Request-ID", "")
+    return supplied if REQUEST_ID_PATTERN.fullmatch(supplied) else uuid.uuid4().hex
+
+def new_scheduler():
+    """Admission control sized to the backend: by default one request per llama-server slot"""
+    return scheduler.RequestScheduler(
+        max_concurrent=scheduler.MAX_CONCURRENT_REQUESTS or llm_interface.PARALLEL_SLOTS
+    )
+
+def prompt_error(data):
+    """Validate an /api/agent request body; returns an error message or None"""
+    if not data or 'prompt' not in data:
+        return "Prompt not provided"
+
+    prompt = data['prompt']
+
+    # Input validation
+    if not isinstance(prompt, str) or not prompt.strip():
+        return "Empty prompt provided"
+
+    if len(prompt) > MAX_PROMPT_LENGTH:  # Reasonable limit
+        return f"Prompt too long (max {MAX_PROMPT_LENGTH} characters)"
+
+    # In router mode "model" picks one of ROUTER_MODELS; single-model instances ignore it
+    model = data.get('model')
+    models = llm_interface.model_names()
+    if models and model is not None and model not in models:
+        return f"Unknown model: {model} (available: {', '.join(models)})"
+
+    session_id = data.get('session_id')
+    if session_id is not None and (not isinstance(session_id, str) or not REQUEST_ID_PATTERN.fullmatch(session_id)):
+        return "session_id must be 1-128 letters, digits or ._:- characters"
+    if not isinstance(data.get('session', False), bool):
+        return "session must be true or false"
+
+    priority = data.get('priority')
+    if priority is not None and priority not in scheduler.PRIORITIES:
+        return f"priority must be one of: {', '.join(scheduler.PRIORITIES)}"
+    deadline_ms = data.get('deadline_ms')
+    if deadline_ms is not None and (not _is_number(deadline_ms) or deadline_ms <= 0):
+        return "deadline_ms must be a positive number"
+
+    retrieve = data.get('retrieve')
+    if retrieve is not None and (not isinstance(retrieve, int) or isinstance(retrieve, bool)
+                                 or not 0 <= retrieve <= retrieval.MAX_RETRIEVE):
+        return f"retrieve must be an integer from 0 to {retrieval.MAX_RETRIEVE}"
+
+    _, error = generation_params(data)
+    return error
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def generation_params(data):
+    """
+    Per-request generation settings of a request body; returns (params, error message).
+
+    Accepts "max_tokens", "temperature", "stop" (a string or a list of
+    strings) and a "ctx_size" hint. Values beyond the instance's LLM_MAX_*
+    limits are clamped later by llm_interface.sampling_params().
+    """
+    max_tokens = data.get('max_tokens')
+    if max_tokens is not None and (not isinstance(max_tokens, int) or isinstance(max_tokens, bool) or max_tokens < 1):
+        return None, "max_tokens must be a positive integer"
+
+    temperature = data.get('temperature')
+    if temperature is not None and (not _is_number(temperature) or temperature < 0):
+        return None, "temperature must be a non-negative number"
+
+    ctx_size = data.get('ctx_size')
+    if ctx_size is not None and (not isinstance(ctx_size, int) or isinstance(ctx_size, bool) or ctx_size < 1):
+        return None, "ctx_size must be a positive integer"
+
+    stop = data.get('stop')
+    if isinstance(stop, str):
+        stop = [stop]
+    if stop is not None:
+        if not isinstance(stop, list) or not all(isinstance(s, str) and s for s in stop):
+            return None, "stop must be a non-empty string or a list of them"
+        if len(stop) > llm_interface.MAX_STOP_SEQUENCES:
+            return None, f"At most {llm_interface.MAX_STOP_SEQUENCES} stop sequences are allowed"
+
+    return {
+        "n_predict": max_tokens,
+        "temperature": float(temperature) if temperature is not None else None,
+        "ctx_size": ctx_size,
+        "stop": stop,
+    }, None
+
+def urgency(data, default="normal"):
+    """
+    Scheduler arguments of a valid request body: its "priority" class and
+    the time.monotonic() deadline "deadline_ms" (counted from now) sets.
+    """
+    deadline_ms = data.get('deadline_ms')
+    return {
+        "priority": scheduler.PRIORITIES[data.get('priority') or default],
+        "deadline": time.monotonic() + deadline_ms / 1000 if deadline_ms is not None else None,
+    }
+
+def request_model(data):
+    """The routed model a valid request asked for, or None for the default"""
+    return data.get('model') if llm_interface.model_names() else None
+
+def parse_batch(data):
+    """
+    Validate an /api/agent/batch request body; returns (items, error message).
+
+    "prompts" holds strings or objects with a "prompt" and optionally an
+    "id" and their own generation settings; settings given next to
+    "prompts" apply to every item. Items default to the "batch" priority
+    and a "deadline_ms" counts from the arrival of the whole batch. Each
+    item carries what is needed to schedule it: the wrapped prompt, model,
+    params, request key and scheduler arguments.
+    """
+    prompts = data.get('prompts') if isinstance(data, dict) else None
+    if not isinstance(prompts, list) or not prompts:
+        return None, "prompts must be a non-empty list"
+    if len(prompts) > MAX_BATCH_SIZE:
+        return None, f"Too many prompts (max {MAX_BATCH_SIZE} per batch)"
+
+    defaults = {field: data[field] for field in BATCH_DEFAULTS if field in data}
+    items = []
+    for index, entry in enumerate(prompts):
+        entry = dict(defaults, **entry) if isinstance(entry, dict) else dict(defaults, prompt=entry)
+        error = prompt_error(entry)
+        if not error and entry.get('retrieve'):
+            error = "retrieve is not supported in batches"
+        if error:
+            return None, f"prompts[{index}]: {error}"
+        full_prompt = wrap_prompt(entry['prompt'])
+        model = request_model(entry)
+        params, _ = generation_params(entry)
+        items.append({
+            "index": index,
+            "id": entry.get('id', index),
+            "prompt": full_prompt,
+            "model": model,
+            "params": params,
+            "key": request_key(full_prompt, model, params),
+            "urgency": urgency(entry, default="batch"),
+        })
+    return items, None
+
+def embed_inputs(data):
+    """Validate an /api/embed request body; returns (texts, error message)"""
+    inputs = data.get('input') if isinstance(data, dict) else None
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    if not isinstance(inputs, list) or not inputs or not all(isinstance(text, str) and text.strip() for text in inputs):
+        return None, "input must be a non-empty string or a list of them"
+    if len(inputs) > MAX_EMBED_INPUTS:
+        return None, f"Too many inputs (max {MAX_EMBED_INPUTS} per request)"
+    if any(len(text) > MAX_PROMPT_LENGTH for text in inputs):
+        return None, f"Input too long (max {MAX_PROMPT_LENGTH} characters)"
+    return inputs, None
+
+def parse_documents(data):
+    """
+    Validate an /api/index request body; returns ([(id, text)], error message).
+
+    "documents" holds objects with an "id" and a "text"; a document stored
+    under the same ID before is replaced.
+    """
+    documents = data.get('documents') if isinstance(data, dict) else None
+    if not isinstance(documents, list) or not documents:
+        return None, "documents must be a non-empty list"
+    if len(documents) > MAX_INDEX_DOCUMENTS:
+        return None, f"Too many documents (max {MAX_INDEX_DOCUMENTS} per request)"
+    parsed = []
+    for index, document in enumerate(documents):
+        doc_id = document.get('id') if isinstance(document, dict) else None
+        text = document.get('text') if isinstance(document, dict) else None
+        if not isinstance(doc_id, str) or not REQUEST_ID_PATTERN.fullmatch(doc_id):
+            return None, f"documents[{index}]: id must be 1-128 letters, digits or ._:- characters"
+        if not isinstance(text, str) or not text.strip():
+            return None, f"documents[{index}]: text must be a non-empty string"
+        if len(text) > MAX_DOCUMENT_LENGTH:
+            return None, f"documents[{index}]: text too long (max {MAX_DOCUMENT_LENGTH} characters)"
+        parsed.append((doc_id, text))
+    return parsed, None
+
+def search_query(data):
+    """Validate an /api/index/search request body; returns (query, k, error message)"""
+    query = data.get('query') if isinstance(data, dict) else None
+    if not isinstance(query, str) or not query.strip():
+        return None, None, "query must be a non-empty string"
+    if len(query) > MAX_PROMPT_LENGTH:
+        return None, None, f"Query too long (max {MAX_PROMPT_LENGTH} characters)"
+    k = data.get('k', 5)
+    if not isinstance(k, int) or isinstance(k, bool) or not 1 <= k <= 100:
+        return None, None, "k must be an integer from 1 to 100"
+    return query, k, None
+
+def embed_response(vectors):
+    """Body of a successful /api/embed response"""
+    return {
+        "embeddings": vectors,
+        "dim": len(vectors[0]) if vectors else None,
+        "model": os.path.basename(llm_interface.EMBED_MODEL_PATH or ""),
+    }
+
+def batch_line(item, result=None, error=None, cached=False):
+    """One NDJSON line of an /api/agent/batch response: an item's result or its error"""
+    line = {"index": item["index"], "id": item["id"]}
+    if error is not None:
+        line["error"] = str(error)
+        if isinstance(error, BUSY_ERRORS):
+            line["retry_after"] = error.retry_after
+        return line
+    return dict(line, **agent_response(result["text"], result["usage"], cached=cached))
+
+def batch_summary(lines):
+    """Final line of an /api/agent/batch response"""
+    failed = sum(1 for line in lines if "error" in line)
+    return {"done": True, "total": len(lines), "failed": failed}
+
+def wrap_prompt(prompt, turns=()):
+    """
+    Add a simple instruction wrapper for the LLM, after a session's
+    earlier (prompt, answer) turns. Earlier turns are written the same way
+    every time, so the backend only evaluates the new one.
+    """
+    history = "".join(f"{earlier}\n\nAssistant: {answer}\n\nUser: " for earlier, answer in turns)
+    return f"{SYSTEM_PREAMBLE} {history}{prompt}\n\nAssistant:"
+
+def session_turns(conversations, session, prompt, params):
+    """
+    The earlier turns of a claimed session that fit in the context window
+    next to `prompt` and the answer (ctx_size minus n_predict of `params`);
+    older ones are dropped. Empty without a session.
+    """
+    if session is None:
+        return ()
+    settings = llm_interface.sampling_params(params)
+    conversations.fit(session, settings["ctx_size"] - settings["n_predict"], len(wrap_prompt(prompt)))
+    return session.turns
+
+def open_session(conversations, data):
+    """
+    The session an /api/agent request continues, claimed for this turn, or
+    None. "session_id" names it (created if unknown); "session": true
+    starts one with a new ID. Raises sessions.SessionBusy.
+    """
+    if data.get('session_id') is None and not data.get('session'):
+        return None
+    return conversations.begin(data.get('session_id'))
+
+def close_session(conversations, session, prompt, result=None):
+    """Give back a session claimed by open_session(), recording the turn if it produced a result"""
+    if session is None:
+        return
+    if result is not None:
+        conversations.finish(session, prompt, result["text"])
+    else:
+        conversations.release(session)
+
+def agent_response(llm_response, usage=None, cached=False, session=None, sources=None):
+    """Body of a successful /api/agent response; `sources` lists the chunks a "retrieve" request was given"""
+    response = {
+        "llm_response": llm_response,
+        "executed_command": None,
+        "command_result": COMMAND_DISABLED_RESULT,
+        "usage": usage,
+        "cached": cached
+    }
+    if session is not None:
+        response["session_id"] = session.id
+    if sources is not None:
+        response["sources"] = sources
+    return response
+
+def request_key(full_prompt, model=None, params=None, choice=0):
+    """
+    Identity of a generation: the cache key and the single-flight key.
+
+    `choice` tells apart the independent generations of one request that
+    asks for several completions of the same prompt.
+    """
+    settings = llm_interface.sampling_params(params)
+    if choice:
+        settings["choice"] = choice
+    return response_cache.cache_key(
+        os.environ.get("INSTANCE_NAME", "unknown"),
+        llm_interface.model_fingerprint(llm_interface.model_path_for(model)),
+        full_prompt,
+        settings
+    )
+
+def busy_status(error):
+    """429 when the queue is full, 503 when a request timed out or cannot meet its deadline"""
+    return 429 if isinstance(error, scheduler.QueueFull) else 503
+
+def admin_error(headers):
+    """None if the request carries the admin token, else (error message, HTTP status)"""
+    if not ADMIN_TOKEN:
+        return "Admin API disabled (set ADMIN_TOKEN to enable it)", 403
+    supplied = headers.get("X-Admin-Token") or headers.get("Authorization", "").removeprefix("Bearer ")
+    if not hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode()):
+        return "Invalid admin token", 401
+    return None
+
+def available_models():
+    try:
+        return sorted(name for name in os.listdir(MODELS_DIR) if name.endswith(".gguf"))
+    except OSError:
+        return []
+
+def resolve_model(data):
+    """Path of the model named in an /admin/model request; returns (path, error message)"""
+    name = data.get("model") if isinstance(data, dict) else None
+    if not isinstance(name, str) or not name.endswith(".gguf"):
+        return None, 'Request must name a .gguf file in the models directory, e.g. {"model": "mistral.gguf"}'
+    # Only plain file names: the admin API cannot load files outside MODELS_DIR
+    if os.path.basename(name) != name:
+        return None, "Model must be a file name inside the models directory"
+    path = os.path.join(MODELS_DIR, name)
+    if not os.path.isfile(path):
+        return None, f"Model not found: {name} (available: {', '.join(available_models()) or 'none'})"
+    return path, None
+
+def model_status():
+    """Body of GET /admin/model"""
+    return {
+        "model_path": llm_interface.MODEL_PATH,
+        "models_dir": MODELS_DIR,
+        "available": available_models(),
+        "swap": llm_interface.get_backend_status()["swap"],
+    }
+
+def process_stats():
+    """Memory and thread use of this API process"""
+    try:
+        with open("/proc/self/statm") as f:
+            rss_pages = int(f.read().split()[1])
+        rss_mb = round(rss_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 1)
+    except (OSError, ValueError):
+        rss_mb = None
+    return {"pid": os.getpid(), "rss_mb": rss_mb, "threads": threading.active_count()}
+
+def health_report(request_scheduler, responses, inflight, server="flask", active=None, conversations=None):
+    """
+    Body and HTTP status of the detailed /health endpoint. Served from
+    memory: executables and model files come from the backend descriptor
+    resolved at startup, not from the filesystem on every probe.
+    """
+    model_path = llm_interface.MODEL_PATH
+    descriptor = llm_interface.backend_descriptor()
+    model = descriptor.models.get(model_path)
+
+    health_status = {
+        "status": "healthy",
+        "service": "SimpleBrain LLM API",
+        "server": server,
+        "model_path": model_path,
+        "model_exists": llm_interface.model_available(model_path),
+        "model_size": model.size if model else None,
+        "model_fingerprint": model.fingerprint if model else None,
+        "llama_executable": descriptor.llama_path,
+        "llama_exists": descriptor.llama_path is not None,
+        "llama_version": descriptor.llama_version,
+        "backend": llm_interface.get_backend_status(),
+        "embeddings": llm_interface.embedding_status(),
+        "queue": request_scheduler.stats(),
+        "cache": responses.stats(),
+        "inflight": inflight.stats(),
+        "requests": active.stats() if active is not None else None,
+        "sessions": conversations.stats() if conversations is not None else None,
+        "warmup": warmup.status(),
+        "process": process_stats(),
+        "environment": {
+            "instance_name": os.environ.get("INSTANCE_NAME", "unknown"),
+            "model_type": os.environ.get("MODEL_TYPE", "unknown"),
+            "api_port": os.environ.get("API_PORT", "5000")
+        }
+    }
+
+    # Set overall status based on critical components
+    backend = health_status["backend"]
+    backend_state = backend.get("state")
+    if backend["mode"] == "router":
+        backend_ok = all(llm_interface.model_available(path) for path in llm_interface.ROUTER_MODELS.values())
+        # Loading the first model at startup; later loads happen per request
+        states = [model["state"] for model in backend["models"].values()]
+        if "ready" not in states and "tuning" in states:
+            backend_state = "tuning"
+        elif "ready" not in states and ("loading" in states or "stopped" in states):
+            backend_state = "loading"
+    elif backend["mode"] == "server":
+        backend_ok = health_status["model_exists"]
+    else:
+        backend_ok = health_status["model_exists"] and health_status["llama_exists"]
+
+    if not backend_ok or backend_state == "failed":
+        health_status["status"] = "unhealthy"
+        return health_status, 503
+
+    # The resident model is still loading (or being restarted after a crash)
+    if backend_state in ("loading", "restarting"):
+        health_status["status"] = "loading"
+        return health_status, 503
+
+    # llama-bench is calibrating threads and batch sizes before the first
+    # start (up to LLM_TUNE_TIMEOUT); requests would wait for it and fail
+    if backend_state == "tuning":
+        health_status["status"] = "tuning"
+        return health_status, 503
+
+    # Still pre-reading the model or running the test generation
+    if health_status["warmup"]["state"] == "warming":
+        health_status["status"] = "warming"
+        return health_status, 503
+
+    return health_status, 200
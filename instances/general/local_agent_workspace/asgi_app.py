@@ -0,0 +1,728 @@
+import asyncio
+import contextlib
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+# The asyncio server is optional; the Flask server (app.py) remains the default
+try:
+    import httpx  # noqa: F401  (llm_interface uses it to reach llama-server)
+    import uvicorn
+    from starlette.applications import Starlette
+    from starlette.background import BackgroundTask
+    from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+    from starlette.routing import Route
+except ImportError as e:
+    raise ImportError(
+        f"The async server needs starlette, uvicorn and httpx ({e}). "
+        "Install them with: pip install starlette uvicorn httpx"
+    ) from e
+
+import agent_api
+import llm_interface
+import metrics
+import openai_api
+import response_cache
+import retrieval
+import scheduler
+import sessions
+import singleflight
+import warmup
+
+# Same admission control, cache and request coalescing as app.py; waiting
+# requests are parked coroutines instead of blocked threads
+request_scheduler = agent_api.new_scheduler()
+responses = response_cache.ResponseCache()
+inflight = singleflight.SingleFlight(singleflight.AsyncFlight)
+active_requests = agent_api.ActiveRequests()
+conversations = sessions.SessionStore(on_end=llm_interface.end_session)
+
+metrics.bind(request_scheduler, responses, inflight, llm_interface.get_backend_status, server="asgi")
+
+# Keeps references to running generation tasks so they are not garbage collected
+_generations = set()
+
+async def health_check(request):
+    """Health check endpoint to verify the API is running"""
+    return JSONResponse({
+        "status": "healthy",
+        "service": "SimpleBrain LLM API",
+        "version": "1.0"
+    })
+
+async def detailed_health(request):
+    """Detailed health check including model availability"""
+    health_status, status = agent_api.health_report(request_scheduler, responses, inflight, server="asgi",
+                                                    active=active_requests, conversations=conversations)
+    return JSONResponse(health_status, status_code=status)
+
+async def prometheus_metrics(request):
+    """Request, queue, latency and backend metrics in Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+async def admin_model(request):
+    """Show the loaded model, or hot-swap it with POST {"model": "<file>.gguf"}"""
+    error = agent_api.admin_error(request.headers)
+    if error:
+        return JSONResponse({"error": error[0]}, status_code=error[1])
+    if request.method == 'GET':
+        return JSONResponse(agent_api.model_status())
+
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    model_path, error = agent_api.resolve_model(data)
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+    try:
+        # Loading takes a while; keep the event loop serving the current model
+        result = await asyncio.to_thread(llm_interface.swap_model, model_path)
+    except llm_interface.SwapInProgress as e:
+        return JSONResponse({"error": str(e)}, status_code=409)
+    except llm_interface.LLMError as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+    return JSONResponse(dict(status="switched", **result))
+
+async def admin_reload(request):
+    """Resolve the llama.cpp executables and model files again; /health serves the result from memory"""
+    error = agent_api.admin_error(request.headers)
+    if error:
+        return JSONResponse({"error": error[0]}, status_code=error[1])
+    await asyncio.to_thread(llm_interface.refresh_backend, "admin reload")
+    return JSONResponse(dict(status="reloaded", **llm_interface.descriptor_status()))
+
+async def read_prompt(request):
+    """Parse and validate an /api/agent request body; returns (data, error response)"""
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    error = agent_api.prompt_error(data if isinstance(data, dict) else None)
+    if error:
+        return None, JSONResponse({"error": error}, status_code=400)
+    return data, None
+
+def busy_response(error):
+    """429 when the queue is full, 503 when a request timed out or cannot meet its deadline"""
+    return JSONResponse(
+        {"error": str(error), "retry_after": error.retry_after},
+        status_code=agent_api.busy_status(error),
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
+async def run_generation(flight, full_prompt, ticket, cache_key, model=None, params=None, session_id=None):
+    """Produce a flight's tokens as a task; stops once every subscriber has left"""
+    info = {}
+    tokens = llm_interface.astream_llm_response(full_prompt, info, model=model, params=params, session=session_id)
+    outcome = "error"
+    first_token_at = None
+    try:
+        # The last subscriber leaving aborts the generation at once. Set
+        # only now: a task cancelled before its first step would never get
+        # here, so it would neither fail the flight nor release the ticket.
+        flight.on_cancel = asyncio.current_task().cancel
+        # Cancelled while waiting in the queue: hand the slot straight on
+        if flight.cancelled:
+            outcome = "cancelled"
+            flight.fail(llm_interface.LLMError("Generation cancelled: all clients disconnected"))
+            return
+        async for token in tokens:
+            if flight.preempted:
+                raise scheduler.Preempted()
+            if flight.cancelled:
+                outcome = "cancelled"
+                flight.fail(llm_interface.LLMError("Generation cancelled: all clients disconnected"))
+                return
+            if first_token_at is None:
+                first_token_at = time.monotonic()
+            flight.publish(token)
+
+        result = {"text": "".join(flight.tokens).strip(), "usage": info.get("usage")}
+        responses.put(cache_key, result)
+        flight.finish(result)
+        outcome = "ok"
+    except (asyncio.CancelledError, scheduler.Preempted):
+        # Flight.on_cancel: the last subscriber left, or the generation was
+        # preempted; the stream's cleanup has killed llama.cpp or closed the
+        # llama-server connection
+        if flight.preempted:
+            # Subscribers queue up again behind the interactive request
+            outcome = "preempted"
+            flight.fail(scheduler.Preempted())
+        else:
+            outcome = "cancelled"
+            flight.fail(llm_interface.LLMError("Generation cancelled: all clients disconnected"))
+    except llm_interface.LLMError as e:
+        flight.fail(e)
+    except Exception as e:
+        print(f"LLM streaming error: {e}", file=sys.stderr)
+        flight.fail(llm_interface.LLMError(f"LLM processing failed: {str(e)}"))
+    finally:
+        # Closing the stream stops the backend generation if it is still running
+        await tokens.aclose()
+        metrics.observe_generation(outcome, ticket, first_token_at, time.monotonic(),
+                                   info.get("usage"), info.get("timings"))
+        ticket.release()
+        inflight.forget(flight)
+
+def preempt_generation(flight):
+    """Ticket.preempt of a batch generation: abort it unless a subscriber could not retry it"""
+    if not flight.preemptible or flight.on_cancel is None:
+        return False
+    flight.preempted = True
+    flight.on_cancel()
+    return True
+
+async def start_generation(full_prompt, key, model=None, params=None, session=None, urgency=None, preemptible=False):
+    """
+    Subscribe to the generation for a wrapped prompt on a (routed) model.
+
+    Joins an identical generation that is already running, or schedules a
+    new one (in the slot of `session`, if given) with the priority and
+    deadline in `urgency`. A `preemptible` caller retries when the flight
+    fails with Preempted. The caller must call flight.leave() when it stops
+    listening. Raises QueueFull/QueueTimeout/DeadlineExceeded when a new
+    generation cannot be scheduled.
+    """
+    flight, leader = inflight.join(key if agent_api.DEDUPLICATE_REQUESTS else object())
+    if not preemptible:
+        flight.preemptible = False
+    if not leader:
+        return flight
+
+    try:
+        ticket = await request_scheduler.acquire_async(**(urgency or {}))
+    except (*agent_api.BUSY_ERRORS, asyncio.CancelledError) as e:
+        # Requests that joined while this one was queued get the same answer
+        if isinstance(e, asyncio.CancelledError):
+            e = llm_interface.LLMError("Request cancelled while queued")
+        flight.fail(e)
+        inflight.forget(flight)
+        flight.leave()
+        raise
+
+    session_id = session.id if session is not None else None
+    task = asyncio.create_task(run_generation(flight, full_prompt, ticket, key, model, params, session_id))
+    _generations.add(task)
+    task.add_done_callback(_generations.discard)
+    if preemptible:
+        ticket.preempt = lambda: preempt_generation(flight)
+    return flight
+
+def register_request(request):
+    """Register a request for cancellation under its X-Request-ID; returns (ID, cancel event, error response)"""
+    request_id = agent_api.request_id(request.headers)
+    cancel_event = active_requests.register(request_id)
+    if cancel_event is None:
+        return request_id, None, JSONResponse({"error": f"Request ID already in use: {request_id}"}, status_code=409)
+    return request_id, cancel_event, None
+
+async def watch_disconnect(request, cancel_event):
+    """Cancel a request whose client disconnects while it waits for a full response"""
+    while not cancel_event.is_set():
+        if await request.is_disconnected():
+            cancel_event.set()
+            return
+        await asyncio.sleep(singleflight.CANCEL_POLL_INTERVAL)
+
+async def cancel_agent_request(request):
+    """Cancel a running /api/agent, /api/agent/stream or /api/agent/batch request by its X-Request-ID"""
+    request_id = request.path_params["request_id"]
+    if not active_requests.cancel(request_id):
+        return JSONResponse({"error": f"No running request with ID {request_id}"}, status_code=404)
+    return JSONResponse({"status": "cancelled", "request_id": request_id})
+
+async def end_agent_session(request):
+    """End a conversation, freeing its llama-server slot and spilled KV state"""
+    session_id = request.path_params["session_id"]
+    if not conversations.end(session_id):
+        return JSONResponse({"error": f"No idle session with ID {session_id}"}, status_code=404)
+    return JSONResponse({"status": "ended", "session_id": session_id})
+
+async def handle_agent_prompt(request):
+    try:
+        data, error = await read_prompt(request)
+        if error:
+            return error
+
+        try:
+            session = agent_api.open_session(conversations, data)
+        except sessions.SessionBusy as e:
+            return JSONResponse({"error": str(e)}, status_code=409)
+        result = None
+        try:
+            try:
+                # Embedding and searching block; keep the event loop free meanwhile
+                prompt, sources = await asyncio.to_thread(retrieval.prompt_for, data)
+            except retrieval.ERRORS as e:
+                return JSONResponse({"error": str(e)}, status_code=retrieval.error_status(e))
+            params, _ = agent_api.generation_params(data)
+            full_prompt = agent_api.wrap_prompt(prompt, agent_api.session_turns(conversations, session, prompt, params))
+            model = agent_api.request_model(data)
+            key = agent_api.request_key(full_prompt, model, params)
+
+            cached = responses.get(key)
+            if cached is not None:
+                result = cached
+                return JSONResponse(agent_api.agent_response(cached["text"], cached["usage"], cached=True, session=session,
+                                                             sources=sources))
+
+            request_id, cancel_event, error = register_request(request)
+            if error:
+                return error
+            watcher = asyncio.create_task(watch_disconnect(request, cancel_event))
+            try:
+                try:
+                    flight = await start_generation(full_prompt, key, model, params, session,
+                                                    agent_api.urgency(data))
+                except agent_api.BUSY_ERRORS as e:
+                    return busy_response(e)
+
+                try:
+                    result = await flight.wait(cancelled=cancel_event.is_set)
+                except singleflight.FlightError as e:
+                    if isinstance(e.cause, agent_api.BUSY_ERRORS):
+                        return busy_response(e.cause)
+                    return JSONResponse(agent_api.agent_response(f"Error: {e}", session=session),
+                                        headers={"X-Request-ID": request_id})
+                finally:
+                    flight.leave()
+            finally:
+                watcher.cancel()
+                active_requests.unregister(request_id)
+
+            return JSONResponse(agent_api.agent_response(result["text"], result["usage"], session=session,
+                                                         sources=sources),
+                                headers={"X-Request-ID": request_id})
+        finally:
+            # Only completed turns become part of the conversation
+            agent_api.close_session(conversations, session, data['prompt'], result)
+
+    except Exception as e:
+        print(f"Unexpected error in handle_agent_prompt: {e}", file=sys.stderr)
+        return JSONResponse({"error": "Internal server error"}, status_code=500)
+
+async def handle_agent_stream(request):
+    """
+    Stream the LLM response as newline-delimited JSON.
+
+    Same events as the Flask endpoint. An idle stream costs one parked
+    coroutine, so many clients can wait on slow generations at once.
+    """
+    data, error = await read_prompt(request)
+    if error:
+        return error
+
+    try:
+        session = agent_api.open_session(conversations, data)
+    except sessions.SessionBusy as e:
+        return JSONResponse({"error": str(e)}, status_code=409)
+    try:
+        prompt, sources = await asyncio.to_thread(retrieval.prompt_for, data)
+    except retrieval.ERRORS as e:
+        agent_api.close_session(conversations, session, data['prompt'])
+        return JSONResponse({"error": str(e)}, status_code=retrieval.error_status(e))
+    params, _ = agent_api.generation_params(data)
+    full_prompt = agent_api.wrap_prompt(prompt, agent_api.session_turns(conversations, session, prompt, params))
+    model = agent_api.request_model(data)
+    key = agent_api.request_key(full_prompt, model, params)
+
+    cached = responses.get(key)
+    if cached is not None:
+        agent_api.close_session(conversations, session, data['prompt'], cached)
+        events = [{"token": cached["text"]},
+                  dict(done=True, **agent_api.agent_response(cached["text"], cached["usage"], cached=True, session=session,
+                                                             sources=sources))]
+        return StreamingResponse(iter([json.dumps(event) + "\n" for event in events]), media_type='application/x-ndjson')
+
+    request_id, cancel_event, error = register_request(request)
+    if error:
+        agent_api.close_session(conversations, session, data['prompt'])
+        return error
+
+    # Wait for a slot before committing to a 200 streaming response
+    try:
+        flight = await start_generation(full_prompt, key, model, params, session, agent_api.urgency(data))
+    except agent_api.BUSY_ERRORS as e:
+        active_requests.unregister(request_id)
+        agent_api.close_session(conversations, session, data['prompt'])
+        return busy_response(e)
+
+    # Leave from whichever runs first: the stream ending (including a client
+    # disconnect cancelling it) or the response's background task
+    left = []
+    completed = []
+    def leave():
+        if not left:
+            left.append(True)
+            flight.leave()
+            active_requests.unregister(request_id)
+            agent_api.close_session(conversations, session, data['prompt'], completed[0] if completed else None)
+
+    async def generate():
+        try:
+            async for token in flight.stream(cancel_event.is_set):
+                yield json.dumps({"token": token}) + "\n"
+            completed.append(flight.result)
+            yield json.dumps(dict(done=True, **agent_api.agent_response(flight.result["text"], flight.result["usage"],
+                                                                        session=session, sources=sources))) + "\n"
+        except singleflight.FlightError as e:
+            yield json.dumps({"error": str(e)}) + "\n"
+        finally:
+            leave()
+
+    return StreamingResponse(
+        generate(),
+        media_type='application/x-ndjson',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Request-ID": request_id},
+        background=BackgroundTask(leave)
+    )
+
+async def batch_item(item, cancelled):
+    """Generate one /api/agent/batch item and return its result line"""
+    cached = responses.get(item["key"])
+    if cached is not None:
+        return agent_api.batch_line(item, cached, cached=True)
+    while True:
+        try:
+            flight = await start_generation(item["prompt"], item["key"], item["model"], item["params"],
+                                            urgency=item["urgency"], preemptible=True)
+        except agent_api.BUSY_ERRORS as e:
+            return agent_api.batch_line(item, error=e)
+        try:
+            return agent_api.batch_line(item, await flight.wait(cancelled=cancelled))
+        except singleflight.FlightError as e:
+            # Stopped for an interactive request: queue up again behind it
+            if isinstance(e.cause, scheduler.Preempted):
+                continue
+            return agent_api.batch_line(item, error=e.cause if isinstance(e.cause, agent_api.BUSY_ERRORS) else e)
+        finally:
+            flight.leave()
+
+async def run_batch(pending, lines, cancel_event):
+    """Batch worker: take items until none are left; once cancelled they are answered as such"""
+    while pending:
+        item = pending.pop(0)
+        if cancel_event.is_set():
+            await lines.put(agent_api.batch_line(item, error=singleflight.RequestCancelled()))
+        else:
+            await lines.put(await batch_item(item, cancel_event.is_set))
+
+async def handle_agent_batch(request):
+    """
+    Answer many prompts in one request, as newline-delimited JSON.
+
+    Same lines as the Flask endpoint, in completion order; the workers are
+    tasks instead of threads.
+    """
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    items, error = agent_api.parse_batch(data)
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+    request_id, cancel_event, error = register_request(request)
+    if error:
+        return error
+
+    pending = list(items)
+    lines = asyncio.Queue()
+    for _ in range(min(len(items), request_scheduler.max_concurrent)):
+        task = asyncio.create_task(run_batch(pending, lines, cancel_event))
+        _generations.add(task)
+        task.add_done_callback(_generations.discard)
+
+    async def generate():
+        done = []
+        try:
+            for _ in items:
+                line = await lines.get()
+                done.append(line)
+                yield json.dumps(line) + "\n"
+            yield json.dumps(agent_api.batch_summary(done)) + "\n"
+        finally:
+            finish()
+
+    # A disconnect or DELETE aborts the running prompts and answers the
+    # remaining ones as cancelled
+    def finish():
+        cancel_event.set()
+        active_requests.unregister(request_id)
+
+    return StreamingResponse(
+        generate(),
+        media_type='application/x-ndjson',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Request-ID": request_id},
+        background=BackgroundTask(finish)
+    )
+
+async def read_json(request):
+    """The request's JSON body, or None if it has none"""
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+async def handle_embed(request):
+    """Embedding vectors of {"input": "text"} or {"input": ["text", ...]}"""
+    texts, error = agent_api.embed_inputs(await read_json(request))
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+    try:
+        vectors = await asyncio.to_thread(llm_interface.embed, texts)
+    except llm_interface.LLMError as e:
+        return JSONResponse({"error": str(e)}, status_code=retrieval.error_status(e))
+    return JSONResponse(agent_api.embed_response(vectors))
+
+async def handle_index(request):
+    """Show the vector index, or add {"documents": [{"id": ..., "text": ...}]} to it"""
+    try:
+        if request.method == 'GET':
+            return JSONResponse(await asyncio.to_thread(lambda: retrieval.index().stats()))
+        documents, error = agent_api.parse_documents(await read_json(request))
+        if error:
+            return JSONResponse({"error": error}, status_code=400)
+        counts = await asyncio.to_thread(retrieval.add_documents, documents)
+    except retrieval.ERRORS as e:
+        return JSONResponse({"error": str(e)}, status_code=retrieval.error_status(e))
+    return JSONResponse({"status": "indexed", "chunks": counts})
+
+async def search_index(request):
+    """The {"k": 5} chunks most similar to {"query": "..."}, best first"""
+    query, k, error = agent_api.search_query(await read_json(request))
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+    try:
+        return JSONResponse({"results": await asyncio.to_thread(retrieval.search, query, k)})
+    except retrieval.ERRORS as e:
+        return JSONResponse({"error": str(e)}, status_code=retrieval.error_status(e))
+
+async def delete_indexed_document(request):
+    """Remove a document's chunks from the vector index"""
+    doc_id = request.path_params["doc_id"]
+    try:
+        removed = await asyncio.to_thread(retrieval.delete_document, doc_id)
+    except retrieval.ERRORS as e:
+        return JSONResponse({"error": str(e)}, status_code=retrieval.error_status(e))
+    if not removed:
+        return JSONResponse({"error": f"No indexed document with ID {doc_id}"}, status_code=404)
+    return JSONResponse({"status": "deleted", "id": doc_id, "chunks": removed})
+
+async def start_choices(req):
+    """
+    The `n` choices of an OpenAI-style request: cached results, or flights
+    the caller must leave. Each choice is its own generation. Raises
+    QueueFull/QueueTimeout after leaving any flights already joined.
+    """
+    choices = []
+    try:
+        for index in range(req["n"]):
+            key = agent_api.request_key(req["prompt"], req["model"], req["params"], choice=index)
+            cached = responses.get(key)
+            choices.append(cached if cached is not None else
+                           await start_generation(req["prompt"], key, req["model"], req["params"]))
+    except (*agent_api.BUSY_ERRORS, asyncio.CancelledError):
+        leave_choices(choices)
+        raise
+    return choices
+
+def leave_choices(choices):
+    for choice in choices:
+        if isinstance(choice, singleflight.Flight):
+            choice.leave()
+
+def openai_busy_response(error):
+    return JSONResponse(
+        openai_api.busy_error_body(error),
+        status_code=agent_api.busy_status(error),
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
+async def openai_stream(req, choices):
+    """Server-Sent Events for the choices, one after another; each runs concurrently in the backend"""
+    results = []
+    for index, choice in enumerate(choices):
+        if req["kind"] == "chat":
+            yield openai_api.chunk(req, index, role=True)
+        if isinstance(choice, singleflight.Flight):
+            try:
+                async for token in choice.stream():
+                    yield openai_api.chunk(req, index, token)
+            except singleflight.FlightError as e:
+                yield openai_api.sse(openai_api.error_body(str(e), "server_error"))
+                return
+            choice = choice.result
+        else:
+            yield openai_api.chunk(req, index, choice["text"])
+        results.append(choice)
+        yield openai_api.chunk(req, index, finish=openai_api.finish_reason(req, choice))
+    if req["include_usage"]:
+        yield openai_api.usage_chunk(req, results)
+    yield openai_api.SSE_DONE
+
+async def handle_openai_request(request, kind):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    req, error = openai_api.parse_request(kind, data)
+    if error:
+        return JSONResponse(error, status_code=400)
+
+    try:
+        choices = await start_choices(req)
+    except agent_api.BUSY_ERRORS as e:
+        return openai_busy_response(e)
+
+    if req["stream"]:
+        # Leave once, from the stream ending or the background task (see handle_agent_stream)
+        left = []
+        def leave():
+            if not left:
+                left.append(True)
+                leave_choices(choices)
+
+        async def generate():
+            try:
+                async for event in openai_stream(req, choices):
+                    yield event
+            finally:
+                leave()
+
+        return StreamingResponse(
+            generate(),
+            media_type='text/event-stream',
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            background=BackgroundTask(leave)
+        )
+
+    results = []
+    failure = None
+    try:
+        for choice in choices:
+            if isinstance(choice, singleflight.Flight):
+                try:
+                    choice = await choice.wait()
+                except singleflight.FlightError as e:
+                    failure = failure or e
+                    continue
+            results.append(choice)
+    finally:
+        leave_choices(choices)
+
+    if failure is not None:
+        if isinstance(failure.cause, agent_api.BUSY_ERRORS):
+            return openai_busy_response(failure.cause)
+        return JSONResponse(openai_api.error_body(str(failure), "server_error"), status_code=500)
+    return JSONResponse(openai_api.response_body(req, results))
+
+async def openai_completions(request):
+    """OpenAI-compatible text completion (prompt, max_tokens, temperature, n, stream)"""
+    return await handle_openai_request(request, "completion")
+
+async def openai_chat_completions(request):
+    """OpenAI-compatible chat completion (messages, max_tokens, temperature, n, stream)"""
+    return await handle_openai_request(request, "chat")
+
+async def openai_models(request):
+    return JSONResponse(openai_api.model_list())
+
+async def not_found(request, exc):
+    return JSONResponse({"error": "Endpoint not found"}, status_code=404)
+
+async def internal_error(request, exc):
+    return JSONResponse({"error": "Internal server error"}, status_code=500)
+
+class RequestMetrics:
+    """ASGI middleware counting each request once its body has been sent"""
+
+    def __init__(self, app):
+        self.app = app
+        self.paths = {route.path for route in app.routes}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.monotonic()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            endpoint = scope["path"] if scope["path"] in self.paths else "unmatched"
+            metrics.observe_request(endpoint, status, time.monotonic() - started)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    yield
+    await llm_interface.aclose()
+
+api = Starlette(
+    routes=[
+        Route('/', health_check, methods=['GET']),
+        Route('/health', detailed_health, methods=['GET']),
+        Route('/metrics', prometheus_metrics, methods=['GET']),
+        Route('/admin/model', admin_model, methods=['GET', 'POST']),
+        Route('/admin/reload', admin_reload, methods=['POST']),
+        Route('/api/agent', handle_agent_prompt, methods=['POST']),
+        Route('/api/agent/stream', handle_agent_stream, methods=['POST']),
+        Route('/api/agent/batch', handle_agent_batch, methods=['POST']),
+        Route('/api/agent/{request_id}', cancel_agent_request, methods=['DELETE']),
+        Route('/api/session/{session_id}', end_agent_session, methods=['DELETE']),
+        Route('/api/embed', handle_embed, methods=['POST']),
+        Route('/api/index', handle_index, methods=['GET', 'POST']),
+        Route('/api/index/search', search_index, methods=['POST']),
+        Route('/api/index/{doc_id}', delete_indexed_document, methods=['DELETE']),
+        Route('/v1/completions', openai_completions, methods=['POST']),
+        Route('/v1/chat/completions', openai_chat_completions, methods=['POST']),
+        Route('/v1/models', openai_models, methods=['GET']),
+    ],
+    exception_handlers={404: not_found, 500: internal_error},
+    lifespan=lifespan
+)
+app = RequestMetrics(api)
+
+if __name__ == '__main__':
+    # Check critical environment variables
+    # In router mode MODEL_PATH defaults to the first of ROUTER_MODELS
+    model_path = llm_interface.MODEL_PATH
+    if not model_path:
+        print("ERROR: MODEL_PATH (or ROUTER_MODELS) environment variable not set", file=sys.stderr)
+        sys.exit(1)
+
+    if not os.path.exists(model_path):
+        print(f"ERROR: Model file not found at {model_path}", file=sys.stderr)
+        sys.exit(1)
+
+    # Load the model once, before accepting traffic; uvicorn handles SIGTERM
+    # and the backend is stopped by llm_interface's exit handler
+    llm_interface.start_backend()
+    # The embedding model (EMBED_MODEL_PATH) for /api/embed and retrieval
+    llm_interface.start_embedding_backend()
+    # Optional (WARMUP=1): /health reports "warming" until the model is resident
+    warmup.start(model_path)
+    # SIGHUP re-resolves the executables and model files, like POST /admin/reload
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+        target=llm_interface.refresh_backend, args=("SIGHUP",), daemon=True).start())
+
+    uvicorn.run(
+        app,
+        host='0.0.0.0',
+        port=int(os.environ.get('API_PORT', 5000)),
+        # Connections beyond this get 503 instead of exhausting file descriptors
+        limit_concurrency=int(os.environ.get('ASGI_MAX_CONNECTIONS', 4096)),
+        timeout_keep_alive=5,
+        log_level='warning'
+    )
@@ -1,35 +1,1250 @@
+import asyncio
+import atexit
+import codecs
+import hashlib
 import os
+import re
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import namedtuple
+
+import requests
+
+# Only needed by the asyncio server (asgi_app.py)
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+import llama_server
+import model_router
+import tuning
+
+# Configuration paths - made more flexible
+LLAMA_PATHS = [
+    "/app/workspace/projects/llama.cpp/main",
+    "/app/workspace/llama.cpp/main", 
+    "/app/workspace/llama.cpp/build/bin/main",
+    "/usr/local/bin/llama-main",
+    "llama-main"
+]
 
-# IMPORTANT: The path to the llama.cpp executable and the model file.
-# The user MUST set the MODEL_PATH environment variable inside the container.
-LLAMA_PATH = "/app/workspace/projects/llama.cpp/main"
 MODEL_PATH = os.environ.get("MODEL_PATH")
 
+# Router mode (ROUTER_MODELS): one process serves every listed model and
+# MODEL_PATH is the default model's file
+ROUTER_MODELS = model_router.parse_models(model_router.ROUTER_MODELS)
+if ROUTER_MODELS:
+    MODEL_PATH = ROUTER_MODELS.get(model_router.ROUTER_DEFAULT_MODEL) or next(iter(ROUTER_MODELS.values()))
+
+# "server" keeps one llama-server process resident with the model loaded;
+# "subprocess" runs llama.cpp once per request (the original behaviour)
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "server").lower()
+
+# Generation defaults shared by both backends
+N_PREDICT = int(os.environ.get("LLM_N_PREDICT", "512"))
+TEMPERATURE = float(os.environ.get("LLM_TEMPERATURE", "0.7"))
+CTX_SIZE = int(os.environ.get("LLM_CTX_SIZE", "2048"))
+REQUEST_TIMEOUT = 60
+
+# llama.cpp threads, batch (-b) and micro-batch (-ub) sizes; 0 leaves them to
+# tuning.py: threads from the CPU quota and cores, or all three from a
+# calibration sweep (LLM_TUNE=1) stored per model and host
+THREADS = int(os.environ.get("LLM_THREADS", "0"))
+BATCH_SIZE = int(os.environ.get("LLM_BATCH_SIZE", "0"))
+UBATCH_SIZE = int(os.environ.get("LLM_UBATCH_SIZE", "0"))
+
+# Limits on per-request overrides (max_tokens, temperature, ctx_size, stop);
+# larger values are clamped. The resident llama-server's context is fixed
+# at LLM_CTX_SIZE per slot, so there a ctx_size hint can only lower it.
+MAX_N_PREDICT = int(os.environ.get("LLM_MAX_N_PREDICT", str(N_PREDICT)))
+MAX_TEMPERATURE = float(os.environ.get("LLM_MAX_TEMPERATURE", "2.0"))
+MAX_CTX_SIZE = int(os.environ.get("LLM_MAX_CTX_SIZE", str(CTX_SIZE)))
+MIN_CTX_SIZE = 256
+MAX_STOP_SEQUENCES = int(os.environ.get("LLM_MAX_STOP_SEQUENCES", "4"))
+
+# Sequences llama-server decodes together; concurrent requests share each
+# decode step instead of waiting for one another (continuous batching)
+PARALLEL_SLOTS = int(os.environ.get("LLM_PARALLEL", "1"))
+
+# Directory for saved KV state of the shared prompt prefix (llama-server
+# slot files, or llama.cpp --prompt-cache files in subprocess mode)
+PREFIX_CACHE_DIR = os.environ.get("PREFIX_CACHE_DIR")
+
+# Extra llama-server slots reserved for conversation sessions: the most
+# sessions whose KV cache stays live between turns. Idle sessions beyond it
+# are spilled to PREFIX_CACHE_DIR (when set) and restored on their next turn.
+SESSION_SLOTS = int(os.environ.get("SESSION_SLOTS", "0"))
+
+# Seconds between checks of the model files and executables for changes;
+# otherwise the backend descriptor is only rebuilt by a model swap, POST
+# /admin/reload or SIGHUP (0 disables the check)
+BACKEND_WATCH_INTERVAL = float(os.environ.get("BACKEND_WATCH_INTERVAL", "60"))
+
+# GGUF embedding model for /api/embed and retrieval; it gets its own
+# resident llama-server (with --embeddings) on EMBED_SERVER_PORT
+EMBED_MODEL_PATH = os.environ.get("EMBED_MODEL_PATH")
+EMBED_SERVER_PORT = int(os.environ.get("EMBED_SERVER_PORT", str(llama_server.LLAMA_SERVER_PORT + 100)))
+
+# Most tokens one embedding input may have, and inputs embedded at once
+EMBED_CTX_SIZE = int(os.environ.get("EMBED_CTX_SIZE", "512"))
+EMBED_PARALLEL = int(os.environ.get("EMBED_PARALLEL", "2"))
+
+# Inputs sent to the embedding server per HTTP request
+EMBED_BATCH = 32
+
+# What the instance runs, resolved once instead of on every request or
+# health probe: the llama.cpp executables and their version, and per model
+# file its size, mtime and fingerprint
+BackendDescriptor = namedtuple("BackendDescriptor",
+                               "llama_path llama_server_path llama_version models resolved_at")
+ModelInfo = namedtuple("ModelInfo", "path exists size mtime_ns fingerprint")
+
+class LLMError(Exception):
+    """Raised by the streaming interface when generation cannot proceed"""
+
+class SwapInProgress(LLMError):
+    """Raised when a model swap is requested while another one is still running"""
+
+class EmbeddingsUnavailable(LLMError):
+    """Raised when no embedding model is configured or its server is not up"""
+
+_server = None
+_router = None
+_server_checked = False
+_server_lock = threading.Lock()
+
+_shared_prefix = None
+_prompt_cache_lock = threading.Lock()
+
+_async_client = None
+
+_embed_server = None
+_embed_checked = False
+
+_descriptor = None
+_descriptor_lock = threading.Lock()
+_watcher = None
+
+# tuning.settings() per model path, with the LLM_* overrides applied
+_tuned = {}
+_tuning_lock = threading.Lock()
+
+# Seconds a model hot-swap lets requests on the old model finish before stopping it
+SWAP_DRAIN_TIMEOUT = int(os.environ.get("MODEL_SWAP_DRAIN_TIMEOUT", "300"))
+_swap_lock = threading.Lock()
+_swap_status = {"state": "idle", "model_path": None, "last_error": None, "last_seconds": None}
+
+def find_llama_executable():
+    """Find the llama.cpp executable in common locations"""
+    for path in LLAMA_PATHS:
+        if os.path.exists(path) and os.access(path, os.X_OK):
+            return path
+    
+    # Try to find in PATH
+    try:
+        result = subprocess.run(["which", "llama-main"], capture_output=True, text=True)
+        if result.returncode == 0:
+            return result.stdout.strip()
+    except:
+        pass
+        
+    return None
+
+def sampling_params(overrides=None):
+    """
+    Generation settings that determine a response, e.g. for cache keys.
+
+    `overrides` holds per-request "n_predict", "temperature", "ctx_size"
+    and "stop" values, clamped to the LLM_MAX_* limits; the instance
+    defaults fill the rest.
+    """
+    overrides = {name: value for name, value in (overrides or {}).items() if value is not None}
+    ctx_size = max(MIN_CTX_SIZE, min(overrides.get("ctx_size", CTX_SIZE), MAX_CTX_SIZE))
+    params = {
+        "n_predict": max(1, min(overrides.get("n_predict", N_PREDICT), MAX_N_PREDICT, ctx_size)),
+        "temperature": max(0.0, min(overrides.get("temperature", TEMPERATURE), MAX_TEMPERATURE)),
+        "ctx_size": ctx_size,
+    }
+    # Only present when set, so keys of requests without stop sequences stay the same
+    if overrides.get("stop"):
+        params["stop"] = list(overrides["stop"])
+    return params
+
+class StopMatcher:
+    """
+    Finds stop sequences in generated text as it streams in.
+
+    Text that could be the beginning of a stop sequence is held back until
+    the next chunk shows whether it is, so a stop sequence is never emitted.
+    """
+
+    def __init__(self, stops):
+        self.stops = [stop for stop in stops or [] if stop]
+        self._pending = ""
+
+    def feed(self, text):
+        """Returns (text that is safe to emit, True once a stop sequence was generated)"""
+        if not self.stops:
+            return text, False
+        self._pending += text
+        found = [index for index in (self._pending.find(stop) for stop in self.stops) if index != -1]
+        if found:
+            text, self._pending = self._pending[:min(found)], ""
+            return text, True
+
+        hold = 0
+        for stop in self.stops:
+            for length in range(min(len(stop) - 1, len(self._pending)), hold, -1):
+                if self._pending.endswith(stop[:length]):
+                    hold = length
+                    break
+        text = self._pending[:len(self._pending) - hold]
+        self._pending = self._pending[len(text):]
+        return text, False
+
+    def flush(self):
+        text, self._pending = self._pending, ""
+        return text
+
+_fingerprints = {}
+
+def model_fingerprint(path=None):
+    """
+    Identify a model file without reading all of it.
+
+    Served from the backend descriptor, so requests do not stat the file;
+    a file replaced in place gets a new fingerprint once the descriptor is
+    refreshed. Models outside the descriptor (e.g. one being swapped in)
+    are fingerprinted directly.
+    """
+    path = path or MODEL_PATH
+    if not path:
+        return None
+    info = backend_descriptor().models.get(path)
+    return info.fingerprint if info is not None else _model_info(path).fingerprint
+
+def _model_info(path):
+    """
+    Stat and fingerprint a model file. The fingerprint hashes the size and
+    mtime together with the first and last MiB of the GGUF, which covers
+    the header and tensor layout; it is memoized per (path, size, mtime).
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return ModelInfo(path, False, None, None, None)
+
+    memo_key = (path, stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _fingerprints:
+        digest = hashlib.sha256(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+        with open(path, "rb") as f:
+            digest.update(f.read(1 << 20))
+            if stat.st_size > 2 << 20:
+                f.seek(-(1 << 20), os.SEEK_END)
+                digest.update(f.read(1 << 20))
+        _fingerprints[memo_key] = digest.hexdigest()[:16]
+    return ModelInfo(path, True, stat.st_size, stat.st_mtime_ns, _fingerprints[memo_key])
+
+def _llama_version(executable):
+    """The version `<executable> --version` reports, e.g. "4585 (a1b2c3d)", or None"""
+    try:
+        result = subprocess.run([executable, "--version"], stdin=subprocess.DEVNULL, capture_output=True,
+                                text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    for line in (result.stderr + result.stdout).splitlines():
+        if line.startswith("version:"):
+            return line.split(":", 1)[1].strip()
+    return None
+
+def _resolve_backend():
+    """Look up the executables and stat and fingerprint every model file"""
+    llama_path = find_llama_executable()
+    server_path = llama_server.find_llama_server()
+    paths = dict.fromkeys(path for path in [MODEL_PATH, *ROUTER_MODELS.values(), EMBED_MODEL_PATH] if path)
+    version_of = server_path if LLM_BACKEND == "server" and server_path else llama_path
+    return BackendDescriptor(
+        llama_path=llama_path,
+        llama_server_path=server_path,
+        llama_version=_llama_version(version_of) if version_of else None,
+        models=types.MappingProxyType({path: _model_info(path) for path in paths}),
+        resolved_at=time.time(),
+    )
+
+def backend_descriptor():
+    """The resolved backend, resolving it (and starting the file watcher) on first use"""
+    global _descriptor, _watcher
+    descriptor = _descriptor
+    if descriptor is not None:
+        return descriptor
+    with _descriptor_lock:
+        if _descriptor is None:
+            _descriptor = _resolve_backend()
+        if _watcher is None and BACKEND_WATCH_INTERVAL > 0:
+            _watcher = threading.Thread(target=_watch_backend, name="backend-watcher", daemon=True)
+            _watcher.start()
+        return _descriptor
+
+def refresh_backend(reason="reload"):
+    """Resolve the executables and model files again; returns the new descriptor"""
+    global _descriptor
+    with _descriptor_lock:
+        _descriptor = _resolve_backend()
+    print(f"Backend descriptor refreshed ({reason})", file=sys.stderr)
+    return _descriptor
+
+def _backend_changed(descriptor):
+    """True if an executable or model file was added, removed or replaced since `descriptor`"""
+    if (find_llama_executable(), llama_server.find_llama_server()) != (descriptor.llama_path,
+                                                                      descriptor.llama_server_path):
+        return True
+    for info in descriptor.models.values():
+        try:
+            stat = os.stat(info.path)
+        except OSError:
+            if info.exists:
+                return True
+            continue
+        if (stat.st_size, stat.st_mtime_ns) != (info.size, info.mtime_ns):
+            return True
+    return False
+
+def _watch_backend():
+    """Refresh the descriptor when a model file or executable changes on disk"""
+    while True:
+        time.sleep(BACKEND_WATCH_INTERVAL)
+        if _backend_changed(backend_descriptor()):
+            refresh_backend("file change")
+
+def descriptor_status():
+    """The backend descriptor for /health and /admin/reload"""
+    descriptor = backend_descriptor()
+    return {
+        "llama_executable": descriptor.llama_path,
+        "llama_server_executable": descriptor.llama_server_path,
+        "llama_version": descriptor.llama_version,
+        "models": {path: {"exists": info.exists, "size": info.size, "fingerprint": info.fingerprint}
+                   for path, info in descriptor.models.items()},
+        "resolved_at": round(descriptor.resolved_at, 3),
+    }
+
+def model_available(path=None):
+    """Whether a model file existed when the descriptor was last resolved"""
+    path = path or MODEL_PATH
+    info = backend_descriptor().models.get(path) if path else None
+    return info.exists if info is not None else bool(path) and os.path.exists(path)
+
+def model_names():
+    """Models a request may choose with its "model" field (empty unless in router mode)"""
+    return list(ROUTER_MODELS)
+
+def model_path_for(model=None):
+    """File of a routed model; MODEL_PATH when no model (or no router) is given"""
+    if model and ROUTER_MODELS:
+        return ROUTER_MODELS[model]
+    return MODEL_PATH
+
+def set_shared_prefix(prefix):
+    """
+    Register the instruction preamble every prompt starts with.
+
+    Its KV state is kept resident in each llama-server slot (and saved under
+    PREFIX_CACHE_DIR when set) so requests only evaluate their own suffix.
+    Call before the backend starts.
+    """
+    global _shared_prefix
+    _shared_prefix = prefix
+
+def start_backend():
+    """
+    Start the resident llama-server for this instance.
+
+    Returns the supervisor, or None when the subprocess backend is in use
+    (configured, or because no llama-server binary could be found). In
+    router mode the default model is loaded and the others on demand.
+    """
+    global _server, _server_checked
+    if ROUTER_MODELS:
+        return _start_router()
+    with _server_lock:
+        if _server is not None or _server_checked:
+            return _server
+        _server_checked = True
+        if not MODEL_PATH:
+            return None
+
+        executable = backend_descriptor().llama_server_path if LLM_BACKEND == "server" else None
+        if not executable:
+            if LLM_BACKEND == "server":
+                print("llama-server not found, falling back to one llama.cpp process per request", file=sys.stderr)
+            # Calibrate (if enabled) before the first request runs llama.cpp
+            tuned_settings(MODEL_PATH, calibrate=True, executable=backend_descriptor().llama_path)
+            return None
+
+        if PREFIX_CACHE_DIR:
+            os.makedirs(PREFIX_CACHE_DIR, exist_ok=True)
+        _server = _new_server(executable, MODEL_PATH)
+        return _server
+
+def tuned_settings(model_path=None, calibrate=False, executable=None):
+    """
+    llama.cpp "threads", "batch_size" and "ubatch_size" for a model on this
+    host: LLM_THREADS/LLM_BATCH_SIZE/LLM_UBATCH_SIZE where set, else what
+    tuning.py stored or derives from the CPUs. With `calibrate` a missing
+    result is measured first (as LLM_TUNE says). Memoized per model.
+    """
+    model_path = model_path or MODEL_PATH
+    with _tuning_lock:
+        settings = _tuned.get(model_path)
+        if settings is None or (calibrate and settings["source"] == "default"):
+            settings = tuning.settings(model_path, model_fingerprint(model_path), executable,
+                                       tune=tuning.TUNE if calibrate and not THREADS else "0")
+            settings = dict(settings, threads=THREADS or settings["threads"],
+                            batch_size=BATCH_SIZE or settings["batch_size"],
+                            ubatch_size=UBATCH_SIZE or settings["ubatch_size"])
+            _tuned[model_path] = settings
+        return settings
+
+def _new_server(executable, model_path, port=llama_server.LLAMA_SERVER_PORT, start=True):
+    # Tuning (which may run a calibration sweep) happens in the server's
+    # monitor thread, before its first start
+    server = llama_server.LlamaServer(executable, model_path, port=port, ctx_size=CTX_SIZE,
+                                      parallel=PARALLEL_SLOTS, shared_prefix=_shared_prefix,
+                                      slot_save_path=PREFIX_CACHE_DIR, session_slots=SESSION_SLOTS,
+                                      tune=lambda path: tuned_settings(path, calibrate=True, executable=executable))
+    if start:
+        server.start()
+        atexit.register(server.stop)
+    return server
+
+def start_embedding_backend():
+    """
+    Start the resident embedding server (once). Returns it, or None when
+    EMBED_MODEL_PATH is not set or no llama-server binary could be found.
+    """
+    global _embed_server, _embed_checked
+    with _server_lock:
+        if _embed_server is not None or _embed_checked:
+            return _embed_server
+        _embed_checked = True
+        if not EMBED_MODEL_PATH:
+            return None
+
+        executable = backend_descriptor().llama_server_path
+        if not executable:
+            print("llama-server not found, embeddings are unavailable", file=sys.stderr)
+            return None
+
+        # Embedding models read each input whole, so it must fit in one micro-batch
+        _embed_server = llama_server.LlamaServer(executable, EMBED_MODEL_PATH, port=EMBED_SERVER_PORT,
+                                                 ctx_size=EMBED_CTX_SIZE, parallel=EMBED_PARALLEL,
+                                                 threads=tuned_settings(EMBED_MODEL_PATH)["threads"],
+                                                 batch_size=EMBED_CTX_SIZE, ubatch_size=EMBED_CTX_SIZE,
+                                                 extra_args=["--embeddings"])
+        _embed_server.start()
+        atexit.register(_embed_server.stop)
+        return _embed_server
+
+def embed(texts):
+    """
+    Embedding vectors of `texts`, one list of floats per text, from the
+    resident embedding server. Raises EmbeddingsUnavailable when there is
+    no embedding model, LLMError when the server rejects the input.
+    """
+    server = start_embedding_backend()
+    if server is None:
+        raise EmbeddingsUnavailable("Embeddings are not available (set EMBED_MODEL_PATH to an embedding model)"
+                                    if not EMBED_MODEL_PATH else "Embeddings are not available: llama-server not found")
+    if not server.wait_ready(REQUEST_TIMEOUT):
+        raise EmbeddingsUnavailable(f"Embedding model is not ready (state: {server.state})")
+    vectors = []
+    try:
+        for start in range(0, len(texts), EMBED_BATCH):
+            vectors += server.embed(texts[start:start + EMBED_BATCH], timeout=REQUEST_TIMEOUT)
+    except (requests.RequestException, RuntimeError, ValueError, KeyError, IndexError) as e:
+        raise LLMError(f"Embedding failed: {e}")
+    return vectors
+
+def embedding_model():
+    """Fingerprint of the embedding model, which stored vectors are only comparable under"""
+    return model_fingerprint(EMBED_MODEL_PATH) if EMBED_MODEL_PATH else None
+
+def embedding_status():
+    """The embedding server for the /health endpoint, or None without an embedding model"""
+    if not EMBED_MODEL_PATH:
+        return None
+    if _embed_server is None:
+        return {"state": "stopped", "model_path": EMBED_MODEL_PATH}
+    return _embed_server.status()
+
+def _start_router():
+    """Create the model router (once) and start loading the default model"""
+    global _router, _server_checked
+    with _server_lock:
+        if _router is not None or _server_checked:
+            return _router
+        _server_checked = True
+        if LLM_BACKEND != "server":
+            return None
+
+        executable = backend_descriptor().llama_server_path
+        if not executable:
+            print("llama-server not found, falling back to one llama.cpp process per request", file=sys.stderr)
+            return None
+
+        if PREFIX_CACHE_DIR:
+            os.makedirs(PREFIX_CACHE_DIR, exist_ok=True)
+        names = list(ROUTER_MODELS)
+        # Each model has its own loopback port so an evicted one can be reloaded at any time
+        _router = model_router.ModelRouter(
+            ROUTER_MODELS,
+            lambda name, path: _new_server(executable, path, llama_server.LLAMA_SERVER_PORT + names.index(name),
+                                           start=False),
+            _wait_loaded)
+        atexit.register(_router.stop)
+        _router.load()
+    return _router
+
+def _checkout_server(model=None):
+    """
+    The current resident server with this request registered on it, or
+    None in subprocess mode. Pair with server.unhold() so a model swap can
+    wait for the request before stopping the server.
+    """
+    start_backend()
+    if _router is not None:
+        try:
+            return _router.checkout(model)
+        except model_router.RouterBusy as e:
+            raise LLMError(f"Model '{model or _router.default}' cannot be loaded right now: {e}")
+        except RuntimeError as e:
+            raise LLMError(str(e))
+    with _server_lock:
+        if _server is not None:
+            _server.hold()
+        return _server
+
+def end_session(session_id):
+    """Drop a finished conversation's pinned slot and spilled KV state"""
+    with _server_lock:
+        servers = _router.servers() if _router is not None else [_server] if _server is not None else []
+    for server in servers:
+        server.end_session(session_id)
+    if PREFIX_CACHE_DIR:
+        llama_server.remove_session_files(PREFIX_CACHE_DIR, session_id)
+
+def get_backend_status():
+    """Describe the active backend for the /health endpoint"""
+    if _router is not None:
+        status = _router.status()
+        status["mode"] = "router"
+    elif _server is None:
+        status = {"mode": "subprocess", "model_path": MODEL_PATH}
+        tuned = _tuned.get(MODEL_PATH)
+        if tuned:
+            status.update(threads=tuned["threads"], batch_size=tuned["batch_size"],
+                          ubatch_size=tuned["ubatch_size"], tuning=tuned["source"])
+        if ROUTER_MODELS:
+            status["models"] = {name: {"model_path": path} for name, path in ROUTER_MODELS.items()}
+    else:
+        status = _server.status()
+        status["mode"] = "server"
+    status["swap"] = dict(_swap_status)
+    return status
+
+def _wait_loaded(server):
+    """Wait for a new server's model to load; returns an error message or None"""
+    deadline = time.monotonic() + llama_server.LOAD_TIMEOUT
+    while not server.wait_ready(timeout=1):
+        # A calibration sweep before the first start does not count against the load timeout
+        if server.state == "tuning":
+            deadline = time.monotonic() + llama_server.LOAD_TIMEOUT
+        # Give up on the first crash instead of waiting through restart backoff
+        if server.restarts or server.state == "failed":
+            return server.last_error or "llama-server exited while loading the model"
+        if time.monotonic() > deadline:
+            return f"Model did not load within {llama_server.LOAD_TIMEOUT}s"
+    return None
+
+def _retire(server):
+    """Stop a replaced server once the requests still using it have finished"""
+    try:
+        _swap_status["state"] = "draining"
+        if not server.drain(SWAP_DRAIN_TIMEOUT):
+            print(f"{server.active_requests} request(s) still running on {server.model_path} after "
+                  f"{SWAP_DRAIN_TIMEOUT}s; stopping it anyway", file=sys.stderr)
+        server.stop()
+        print(f"Stopped previous llama-server ({server.model_path})", file=sys.stderr)
+    finally:
+        _swap_status["state"] = "idle"
+        _swap_lock.release()
+
+def swap_model(model_path):
+    """
+    Switch this instance to another GGUF file without downtime.
+
+    Loads model_path into a second llama-server, warms it up and then routes
+    new requests to it. The old server finishes the requests it already has
+    and is stopped in the background. In subprocess mode the new file is
+    warmed up and used from the next request on. Raises LLMError (leaving
+    the current model in service) if the new one cannot be loaded.
+    """
+    global MODEL_PATH, _server
+    if ROUTER_MODELS:
+        raise LLMError("Model hot-swap is not available in router mode; edit ROUTER_MODELS instead")
+    if not os.path.isfile(model_path):
+        raise LLMError(f"Model file not found at {model_path}")
+    if not _swap_lock.acquire(blocking=False):
+        raise SwapInProgress(f"A model swap is already in progress ({_swap_status['state']})")
+
+    started = time.monotonic()
+    previous = MODEL_PATH
+    retiring = None
+    _swap_status.update(state="loading", model_path=model_path, last_error=None)
+    try:
+        old = start_backend()
+        if old is None:
+            error = _warm_subprocess(model_path)
+            if error:
+                raise LLMError(f"New model failed its test generation: {error}")
+            MODEL_PATH = model_path
+        else:
+            # Alternate between two loopback ports so both servers can run side by side
+            if old.port == llama_server.LLAMA_SERVER_PORT:
+                port = llama_server.LLAMA_SERVER_PORT + 1
+            else:
+                port = llama_server.LLAMA_SERVER_PORT
+            new = _new_server(old.executable, model_path, port)
+            error = _wait_loaded(new) or _warm_server(new)
+            if error:
+                new.stop()
+                raise LLMError(f"New model failed to load: {error}")
+            with _server_lock:
+                _server = new
+                MODEL_PATH = model_path
+            retiring = old
+    except LLMError as e:
+        _swap_status.update(state="idle", last_error=str(e))
+        _swap_lock.release()
+        raise
+
+    refresh_backend("model swap")
+    seconds = round(time.monotonic() - started, 2)
+    _swap_status["last_seconds"] = seconds
+    print(f"Switched model from {previous} to {model_path} in {seconds}s", file=sys.stderr)
+    draining = retiring.active_requests if retiring else 0
+    if retiring:
+        # The swap lock is released once the old server has been stopped
+        threading.Thread(target=_retire, args=(retiring,), name="retire-llama-server", daemon=True).start()
+    else:
+        _swap_status["state"] = "idle"
+        _swap_lock.release()
+    return {"model_path": model_path, "previous_model_path": previous, "seconds": seconds,
+            "draining_requests": draining}
+
+def _usage(result):
+    """Token counts reported by llama-server for one completion"""
+    return {
+        "prompt_tokens": result.get("tokens_evaluated"),
+        "completion_tokens": result.get("tokens_predicted"),
+    }
+
+# llama.cpp's perf summary on stderr, e.g.
+#   llama_perf_context_print: prompt eval time =  120.50 ms /    21 tokens (...)
+#   llama_perf_context_print:        eval time = 3456.78 ms /   127 runs   (...)
+# (older builds prefix the lines with llama_print_timings)
+_TIMING_LINE = re.compile(r"\b(load|prompt eval|eval) time\s*=\s*([\d.]+) ms(?:\s*/\s*(\d+) (?:tokens|runs))?")
+
+def parse_llama_timings(text):
+    """Timings from llama.cpp's stderr, in the shape of llama-server's `timings`"""
+    timings = {}
+    for stage, ms, count in _TIMING_LINE.findall(text):
+        if stage == "load":
+            timings["load_ms"] = float(ms)
+        elif stage == "prompt eval":
+            timings["prompt_ms"] = float(ms)
+            timings["prompt_n"] = int(count) if count else None
+        else:
+            timings["predicted_ms"] = float(ms)
+            timings["predicted_n"] = int(count) if count else None
+    if timings.get("predicted_ms") and timings.get("predicted_n"):
+        timings["predicted_per_second"] = timings["predicted_n"] * 1000 / timings["predicted_ms"]
+    return timings or None
+
+def _subprocess_info(info, stderr_text):
+    """Fill usage and timings of a llama.cpp run from its stderr"""
+    timings = parse_llama_timings(stderr_text)
+    info["timings"] = timings
+    if timings:
+        info["usage"] = {
+            "prompt_tokens": timings.get("prompt_n"),
+            "completion_tokens": timings.get("predicted_n"),
+        }
+
+def _read_tail(f, limit=16384):
+    """The last `limit` bytes of a file, decoded"""
+    f.seek(0, os.SEEK_END)
+    f.seek(max(0, f.tell() - limit))
+    return f.read().decode("utf-8", errors="replace")
+
+def _completion(text, result=None, error=False):
+    return {
+        "text": text,
+        "error": error,
+        "usage": _usage(result) if result else None,
+        "timings": result.get("timings") if result else None,
+    }
+
+def _get_server_response(server, prompt, params):
+    """Forward a prompt to the resident llama-server"""
+    if not server.wait_ready(timeout=REQUEST_TIMEOUT):
+        return _completion(f"Error: LLM backend is not ready (state: {server.state}). The model may still be loading.", error=True)
+
+    try:
+        result = server.complete(prompt, params["n_predict"], params["temperature"], timeout=REQUEST_TIMEOUT,
+                                 stop=params.get("stop"))
+    except requests.exceptions.Timeout:
+        return _completion("Error: LLM request timed out. The model might be too large or the request too complex.", error=True)
+    except Exception as e:
+        return _completion(f"Error communicating with llama-server: {str(e)}", error=True)
+
+    response = result.get("content", "").strip()
+    if not response:
+        return _completion("Error: LLM produced no output.", result, error=True)
+    return _completion(response, result)
+
+def _check_subprocess_backend(model_path=None):
+    """Validate the environment for the subprocess backend; returns (llama_path, error)"""
+    model_path = model_path or MODEL_PATH
+    if not model_path:
+        return None, "MODEL_PATH environment variable not set. Please configure the model path."
+
+    if not model_available(model_path):
+        return None, f"Model file not found at {model_path}. Please check the model path and ensure the model file exists."
+
+    # The llama.cpp executable, as found at startup
+    llama_path = backend_descriptor().llama_path
+    if not llama_path:
+        return None, f"llama.cpp executable not found. Searched paths: {', '.join(LLAMA_PATHS)}"
+
+    return llama_path, None
+
+def _prompt_cache_args(llama_path, prompt, model_path=None):
+    """
+    llama.cpp arguments that load the shared prefix's saved KV state.
+
+    The cache file is created on first use by evaluating just the prefix,
+    then opened read-only so each run only evaluates its own suffix.
+    """
+    if not PREFIX_CACHE_DIR or not _shared_prefix or not prompt.startswith(_shared_prefix):
+        return []
+
+    model_path = model_path or MODEL_PATH
+    prefix_hash = hashlib.sha256(_shared_prefix.encode("utf-8")).hexdigest()[:12]
+    path = os.path.join(PREFIX_CACHE_DIR, f"prefix-{model_fingerprint(model_path)}-{CTX_SIZE}-{prefix_hash}.bin")
+    with _prompt_cache_lock:
+        if not os.path.exists(path):
+            try:
+                os.makedirs(PREFIX_CACHE_DIR, exist_ok=True)
+                subprocess.run([
+                    llama_path, "-m", model_path, "-p", _shared_prefix, "-n", "1",
+                    "-c", str(CTX_SIZE), "-t", str(tuned_settings(model_path)["threads"]), "--prompt-cache", path
+                ], stdin=subprocess.DEVNULL, capture_output=True, timeout=REQUEST_TIMEOUT)
+            except (OSError, subprocess.TimeoutExpired) as e:
+                print(f"Could not create prompt cache {path}: {e}", file=sys.stderr)
+    if not os.path.exists(path):
+        return []
+    return ["--prompt-cache", path, "--prompt-cache-ro"]
+
+def _build_llama_command(llama_path, prompt, params=None, model_path=None):
+    """Build the llama.cpp command line for a single generation"""
+    params = params or sampling_params()
+    tuned = tuned_settings(model_path)
+    return [
+        llama_path,
+        "-m", model_path or MODEL_PATH,
+        "-p", prompt,
+        "-n", str(params["n_predict"]),
+        "--temp", str(params["temperature"]),
+        "-c", str(params["ctx_size"]),  # Context size
+        "--no-display-prompt",  # Don't echo the prompt back
+        "-t", str(tuned["threads"]),  # Number of threads
+        "--silent-prompt"  # Reduce output noise
+    # Batch sizes are llama.cpp's defaults unless tuned
+    ] + (["-b", str(tuned["batch_size"])] if tuned["batch_size"] else []) + (
+        ["-ub", str(tuned["ubatch_size"])] if tuned["ubatch_size"] else []) + (
+    # The saved prefix state is only valid for the context size it was made with
+        _prompt_cache_args(llama_path, prompt, model_path) if params["ctx_size"] == CTX_SIZE else [])
+
+def _warm_prompt():
+    return f"{_shared_prefix} Hello" if _shared_prefix else "Hello"
+
+def _warm_server(server, n_predict=4):
+    try:
+        server.complete(_warm_prompt(), n_predict, TEMPERATURE, timeout=REQUEST_TIMEOUT)
+    except Exception as e:
+        return f"Error communicating with llama-server: {str(e)}"
+    return None
+
+def _warm_subprocess(model_path, n_predict=4):
+    llama_path = backend_descriptor().llama_path
+    if not llama_path:
+        return f"llama.cpp executable not found. Searched paths: {', '.join(LLAMA_PATHS)}"
+    try:
+        result = subprocess.run(_build_llama_command(llama_path, _warm_prompt(), sampling_params({"n_predict": n_predict}),
+                                                     model_path),
+                                stdin=subprocess.DEVNULL, capture_output=True, timeout=REQUEST_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        return f"Cannot run llama.cpp: {e}"
+    return None if result.returncode == 0 else f"llama.cpp exited with code {result.returncode}"
+
+def warm_up(n_predict=4):
+    """
+    Run a tiny generation so the backend has touched all of its weights.
+
+    Waits for the resident server to finish loading. Returns an error
+    message, or None on success.
+    """
+    if start_backend() is None:
+        _, error = _check_subprocess_backend()
+        return error or _warm_subprocess(MODEL_PATH, n_predict)
+    try:
+        server = _checkout_server()
+    except LLMError as e:
+        return str(e)
+    try:
+        if not server.wait_ready(timeout=llama_server.LOAD_TIMEOUT):
+            return f"LLM backend is not ready (state: {server.state})"
+        return _warm_server(server, n_predict)
+    finally:
+        server.unhold()
+
 def get_llm_response(prompt):
     """
     Gets a response from the local LLM using llama.cpp.
     """
-    if not MODEL_PATH:
-        raise ValueError("MODEL_PATH environment variable not set. Please set it to the path of your .gguf model file.")
+    return complete(prompt)["text"]
+
+def complete(prompt, model=None, params=None):
+    """
+    Gets a response from the local LLM along with what the backend reports about it.
+
+    Returns a dict with the response "text" (an "Error: ..." message on
+    failure, flagged by "error") plus "usage" token counts and llama.cpp
+    "timings" when the backend provides them, otherwise None. `model`
+    selects one of the ROUTER_MODELS in router mode; `params` overrides
+    sampling settings (see sampling_params()).
+    """
+    params = sampling_params(params)
+    try:
+        server = _checkout_server(model)
+    except LLMError as e:
+        return _completion(f"Error: {e}", error=True)
+    if server is not None:
+        try:
+            return _get_server_response(server, prompt, params)
+        finally:
+            server.unhold()
+    info = {}
+    if params.get("stop"):
+        # Read the output as it is produced so llama.cpp can be stopped at a stop sequence
+        try:
+            text = "".join(_stream_subprocess_response(prompt, info, model_path_for(model), params))
+        except LLMError as e:
+            text = f"Error: {e}"
+    else:
+        text = _get_subprocess_response(prompt, info, model_path_for(model), params)
+    completion = _completion(text, error=text.startswith(("Error", "Unexpected error")))
+    completion.update(usage=info.get("usage"), timings=info.get("timings"))
+    return completion
 
-    if not os.path.exists(MODEL_PATH):
-        return f"Error: Model file not found at {MODEL_PATH}"
+def _get_subprocess_response(prompt, info=None, model_path=None, params=None):
+    model_path = model_path or MODEL_PATH
+    llama_path, error = _check_subprocess_backend(model_path)
+    if error:
+        return f"Error: {error}"
 
-    command = [
-        LLAMA_PATH,
-        "-m", MODEL_PATH,
-        "-p", prompt,
-        "-n", "256", # Increased token limit to allow complete responses
-        "--temp", "0.7",
-        "-c", "2048" # Context size
-    ]
+    # Build command with safer parameters
+    command = _build_llama_command(llama_path, prompt, params, model_path)
 
     try:
-        print(f"Running command: {' '.join(command)}")
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
-        return result.stdout.strip()
+        print(f"Running llama.cpp: {llama_path} with model {model_path}", file=sys.stderr)
+        
+        # Run with timeout to prevent hanging
+        result = subprocess.run(
+            command, 
+            capture_output=True, 
+            text=True, 
+            check=False,  # Don't raise exception on non-zero exit
+            timeout=REQUEST_TIMEOUT
+        )
+        
+        if info is not None and result.stderr:
+            _subprocess_info(info, result.stderr[-16384:])
+
+        # Check for successful execution
+        if result.returncode == 0:
+            response = result.stdout.strip()
+            if response:
+                return response
+            else:
+                return "Error: LLM produced no output. This might indicate a model loading issue."
+        else:
+            error_msg = result.stderr.strip() if result.stderr else "Unknown error"
+            return f"Error running llama.cpp (exit code {result.returncode}): {error_msg}"
+            
+    except subprocess.TimeoutExpired:
+        return "Error: LLM request timed out. The model might be too large or the request too complex."
     except subprocess.CalledProcessError as e:
-        return f"Error running llama.cpp: {e.stderr}"
+        error_msg = e.stderr.strip() if e.stderr else str(e)
+        return f"Error running llama.cpp: {error_msg}"
     except FileNotFoundError:
-        return f"Error: llama.cpp executable not found at {LLAMA_PATH}"
+        return f"Error: llama.cpp executable not found at {llama_path}"
+    except Exception as e:
+        return f"Unexpected error in LLM interface: {str(e)}"
+
+def cancel(info):
+    """
+    Abort the generation whose `info` dict this is, from any thread.
+
+    Kills the llama.cpp process or breaks off the llama-server stream
+    right away, so the generating thread fails instead of waiting for
+    the next token; used when every client has left.
+    """
+    info["cancelled"] = True
+    abort = info.get("abort")
+    if abort is not None:
+        abort()
+
+def _set_abort(info, abort):
+    """Register how to abort a running generation (see cancel())"""
+    info["abort"] = abort
+    # A cancel() that came before registration did not see the abort
+    if info.get("cancelled"):
+        abort()
+
+def _stream_server_response(server, prompt, info, params, session=None):
+    if not server.wait_ready(timeout=REQUEST_TIMEOUT):
+        raise LLMError(f"LLM backend is not ready (state: {server.state}). The model may still be loading.")
+
+    produced = False
+    try:
+        for event in server.stream(prompt, params["n_predict"], params["temperature"], timeout=REQUEST_TIMEOUT,
+                                   stop=params.get("stop"), session=session,
+                                   on_response=lambda response: _set_abort(info, lambda: llama_server.abort_response(response))):
+            if event.get("stop"):
+                info["usage"] = _usage(event)
+                info["timings"] = event.get("timings")
+            text = event.get("content", "")
+            if not produced:
+                text = text.lstrip()
+            if text:
+                produced = True
+                yield text
+    except requests.exceptions.Timeout:
+        raise LLMError("LLM request timed out. The model might be too large or the request too complex.")
+    except requests.exceptions.RequestException as e:
+        raise LLMError(f"Error communicating with llama-server: {str(e)}")
+    except llama_server.SlotUnavailable as e:
+        raise LLMError(str(e))
+
+    if not produced:
+        raise LLMError("LLM produced no output.")
+
+def _stream_subprocess_response(prompt, info, model_path=None, params=None):
+    model_path = model_path or MODEL_PATH
+    llama_path, error = _check_subprocess_backend(model_path)
+    if error:
+        raise LLMError(error)
+
+    command = _build_llama_command(llama_path, prompt, params, model_path)
+    print(f"Running llama.cpp (streaming): {llama_path} with model {model_path}", file=sys.stderr)
+
+    # stderr goes to a file: llama.cpp logs enough to fill a pipe and stall
+    stderr_log = tempfile.TemporaryFile()
+    try:
+        process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=stderr_log)
+    except OSError as e:
+        stderr_log.close()
+        raise LLMError(f"Cannot run llama.cpp: {e}")
+
+    timed_out = threading.Event()
+    def on_timeout():
+        timed_out.set()
+        process.kill()
+    timer = threading.Timer(REQUEST_TIMEOUT, on_timeout)
+    timer.start()
+    _set_abort(info, process.kill)
+
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    stops = StopMatcher(params.get("stop") if params else None)
+    produced = False
+    stopped = False
+    try:
+        while not stopped:
+            chunk = process.stdout.read1(4096)
+            text, stopped = stops.feed(decoder.decode(chunk, final=not chunk))
+            if not chunk:
+                text += stops.flush()
+            if not produced:
+                text = text.lstrip()
+            if text:
+                produced = True
+                yield text
+            if not chunk:
+                break
+
+        if stopped:
+            # llama.cpp only honours stop sequences in interactive mode; the
+            # finally block below ends the run instead
+            if not produced:
+                raise LLMError("LLM produced no output before a stop sequence.")
+            return
+
+        returncode = process.wait()
+        if timed_out.is_set():
+            raise LLMError("LLM request timed out. The model might be too large or the request too complex.")
+        if info.get("cancelled"):
+            raise LLMError("Generation cancelled")
+        stderr_text = _read_tail(stderr_log)
+        if returncode != 0:
+            error_msg = stderr_text.strip()[-2000:] or "Unknown error"
+            raise LLMError(f"llama.cpp exited with code {returncode}: {error_msg}")
+        _subprocess_info(info, stderr_text)
+        if not produced:
+            raise LLMError("LLM produced no output. This might indicate a model loading issue.")
+    finally:
+        # Also reached when the client disconnects and the generator is closed
+        timer.cancel()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        stderr_log.close()
+
+def stream_llm_response(prompt, info=None, model=None, params=None, session=None):
+    """
+    Yields the LLM response incrementally, as text chunks.
+
+    If `info` is a dict it receives "usage" and "timings" (see complete())
+    once generation has finished. Raises LLMError when the backend is
+    unavailable or generation fails. `model` and `params` are as for complete().
+    `session` names the conversation the prompt continues; llama-server then
+    runs it in the slot holding that conversation's KV cache.
+    """
+    if info is None:
+        info = {}
+    info.update(usage=None, timings=None)
+    params = sampling_params(params)
+
+    server = _checkout_server(model)
+    if server is not None:
+        try:
+            yield from _stream_server_response(server, prompt, info, params, session)
+        finally:
+            server.unhold()
+    else:
+        yield from _stream_subprocess_response(prompt, info, model_path_for(model), params)
+
+async def _astream_server_response(server, prompt, info, params, session=None):
+    if not server.is_ready():
+        # The supervisor signals readiness through a threading.Event
+        if not await asyncio.to_thread(server.wait_ready, REQUEST_TIMEOUT):
+            raise LLMError(f"LLM backend is not ready (state: {server.state}). The model may still be loading.")
+
+    global _async_client
+    if _async_client is None:
+        _async_client = httpx.AsyncClient()
+
+    produced = False
+    try:
+        async for event in server.astream(_async_client, prompt, params["n_predict"], params["temperature"],
+                                          timeout=REQUEST_TIMEOUT, stop=params.get("stop"), session=session):
+            if event.get("stop"):
+                info["usage"] = _usage(event)
+                info["timings"] = event.get("timings")
+            text = event.get("content", "")
+            if not produced:
+                text = text.lstrip()
+            if text:
+                produced = True
+                yield text
+    except httpx.TimeoutException:
+        raise LLMError("LLM request timed out. The model might be too large or the request too complex.")
+    except httpx.HTTPError as e:
+        raise LLMError(f"Error communicating with llama-server: {str(e)}")
+    except llama_server.SlotUnavailable as e:
+        raise LLMError(str(e))
+
+    if not produced:
+        raise LLMError("LLM produced no output.")
+
+async def _astream_subprocess_response(prompt, info, model_path=None, params=None):
+    model_path = model_path or MODEL_PATH
+    llama_path, error = _check_subprocess_backend(model_path)
+    if error:
+        raise LLMError(error)
+
+    # The first call may build the prefix cache file by running llama.cpp once
+    command = await asyncio.to_thread(_build_llama_command, llama_path, prompt, params, model_path)
+    print(f"Running llama.cpp (streaming): {llama_path} with model {model_path}", file=sys.stderr)
+
+    stderr_log = tempfile.TemporaryFile()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=stderr_log)
+    except OSError as e:
+        stderr_log.close()
+        raise LLMError(f"Cannot run llama.cpp: {e}")
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + REQUEST_TIMEOUT
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    stops = StopMatcher(params.get("stop") if params else None)
+    produced = False
+    stopped = False
+    try:
+        while not stopped:
+            try:
+                chunk = await asyncio.wait_for(process.stdout.read(4096), max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                raise LLMError("LLM request timed out. The model might be too large or the request too complex.")
+            text, stopped = stops.feed(decoder.decode(chunk, final=not chunk))
+            if not chunk:
+                text += stops.flush()
+            if not produced:
+                text = text.lstrip()
+            if text:
+                produced = True
+                yield text
+            if not chunk:
+                break
+
+        if stopped:
+            # llama.cpp only honours stop sequences in interactive mode; the
+            # finally block below ends the run instead
+            if not produced:
+                raise LLMError("LLM produced no output before a stop sequence.")
+            return
+
+        returncode = await process.wait()
+        stderr_text = _read_tail(stderr_log)
+        if returncode != 0:
+            error_msg = stderr_text.strip()[-2000:] or "Unknown error"
+            raise LLMError(f"llama.cpp exited with code {returncode}: {error_msg}")
+        _subprocess_info(info, stderr_text)
+        if not produced:
+            raise LLMError("LLM produced no output. This might indicate a model loading issue.")
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        stderr_log.close()
+
+def _release_checkout(done):
+    """Done-callback giving back a server checked out for a task that was cancelled meanwhile"""
+    server = None if done.cancelled() or done.exception() else done.result()
+    if server is not None:
+        server.unhold()
+
+async def astream_llm_response(prompt, info=None, model=None, params=None, session=None):
+    """
+    Asyncio variant of stream_llm_response() for the ASGI server.
+
+    Talks to llama-server through httpx and runs llama.cpp as an asyncio
+    subprocess, so no thread is blocked while tokens are generated.
+    """
+    if info is None:
+        info = {}
+    info.update(usage=None, timings=None)
+    params = sampling_params(params)
+
+    if httpx is None and start_backend() is not None:
+        raise LLMError("The async server needs httpx to reach llama-server (pip install httpx)")
+
+    if _router is not None:
+        # Loading a routed model on demand blocks until it is ready. If this
+        # task is cancelled meanwhile, the server is released once checked out.
+        checkout = asyncio.ensure_future(asyncio.to_thread(_checkout_server, model))
+        try:
+            server = await asyncio.shield(checkout)
+        except asyncio.CancelledError:
+            checkout.add_done_callback(_release_checkout)
+            raise
+    else:
+        server = _checkout_server(model)
+    if server is not None:
+        try:
+            async for text in _astream_server_response(server, prompt, info, params, session):
+                yield text
+        finally:
+            server.unhold()
+    else:
+        async for text in _astream_subprocess_response(prompt, info, model_path_for(model), params):
+            yield text
+
+async def aclose():
+    """Close the shared async HTTP client; call before the event loop stops"""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+def test_llm_setup():
+    """Test function to validate LLM setup"""
+    issues = []
+    
+    # Check MODEL_PATH
+    if not MODEL_PATH:
+        issues.append("MODEL_PATH environment variable not set")
+    elif not os.path.exists(MODEL_PATH):
+        issues.append(f"Model file not found: {MODEL_PATH}")
+    else:
+        # Check file size (models should be at least 100MB)
+        try:
+            size = os.path.getsize(MODEL_PATH)
+            if size < 100 * 1024 * 1024:  # 100MB
+                issues.append(f"Model file seems too small: {size} bytes")
+        except OSError as e:
+            issues.append(f"Cannot access model file: {e}")
+    
+    # Check llama.cpp executable
+    llama_path = find_llama_executable()
+    if not llama_path:
+        issues.append("llama.cpp executable not found")
+    else:
+        # Test if executable runs
+        try:
+            result = subprocess.run([llama_path, "--help"], 
+                                  capture_output=True, timeout=5)
+            if result.returncode != 0:
+                issues.append("llama.cpp executable doesn't run properly")
+        except Exception as e:
+            issues.append(f"Cannot execute llama.cpp: {e}")
+
+    if LLM_BACKEND == "server" and not llama_server.find_llama_server():
+        issues.append("llama-server executable not found (requests will fall back to llama.cpp subprocesses)")
+    
+    return issues
+
+if __name__ == "__main__":
+    # Test setup when run directly
+    print("Testing LLM setup...")
+    issues = test_llm_setup()
+    
+    if issues:
+        print("Issues found:")
+        for issue in issues:
+            print(f"  - {issue}")
+    else:
+        print("LLM setup looks good!")
+        
+        # Test a simple prompt
+        print("\nTesting simple prompt...")
+        response = get_llm_response("Hello, please say hi back.")
+        print(f"Response: {response}")
\ No newline at end of file
@@ -0,0 +1,241 @@
+import bisect
+import math
+import os
+import threading
+
+# Minimal Prometheus text-format metrics; no client library needed
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+STAGE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escape = lambda v: str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    """Base class: a named family of samples keyed by label values"""
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._function = None
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def set_function(self, function):
+        """Read the (unlabelled) value from `function` at scrape time"""
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            value = self._function()
+            return [] if value is None else [(self.name, "", value)]
+        with self._lock:
+            return [(self.name, _format_labels(self.labelnames, key), value)
+                    for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                    samples.append((f"{self.name}_bucket", labels, cumulative))
+                labels = _format_labels(self.labelnames, key)
+                samples.append((f"{self.name}_sum", labels, total))
+                samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+
+REGISTRY = []
+
+INFO = Gauge("simplebrain_info", "Constant 1, labelled with the instance's identity",
+             ["instance_name", "model_type", "server"])
+
+REQUESTS = Counter("simplebrain_requests_total", "HTTP requests by endpoint and response status",
+                   ["endpoint", "status"])
+REQUEST_LATENCY = Histogram("simplebrain_request_duration_seconds",
+                            "End-to-end request latency, until the response body is fully sent", ["endpoint"])
+
+QUEUE_DEPTH = Gauge("simplebrain_queue_depth", "Requests waiting for a generation slot")
+QUEUE_ACTIVE = Gauge("simplebrain_queue_active", "Generations currently running")
+QUEUE_REJECTED = Counter("simplebrain_queue_rejected_total", "Requests turned away because the queue was full")
+QUEUE_TIMED_OUT = Counter("simplebrain_queue_timed_out_total", "Requests that waited longer than the queue timeout")
+QUEUE_DEADLINE_MISSED = Counter("simplebrain_queue_deadline_missed_total",
+                                "Requests turned away because they could not finish before their deadline")
+QUEUE_PREEMPTED = Counter("simplebrain_queue_preempted_total",
+                          "Batch generations stopped to make room for interactive requests")
+
+GENERATIONS = Counter("simplebrain_generations_total", "Backend generations by outcome (ok, error, cancelled, preempted)",
+                      ["outcome"])
+QUEUE_WAIT = Histogram("simplebrain_queue_wait_seconds", "Time a generation waited for a slot",
+                       buckets=STAGE_BUCKETS)
+TIME_TO_FIRST_TOKEN = Histogram("simplebrain_time_to_first_token_seconds",
+                                "Time from queueing a generation to its first token")
+TOKENS_PER_SECOND = Histogram("simplebrain_tokens_per_second", "Generation speed of each completion",
+                              buckets=RATE_BUCKETS)
+PROMPT_EVAL = Histogram("simplebrain_prompt_eval_seconds", "Prompt evaluation time reported by llama.cpp",
+                        buckets=STAGE_BUCKETS)
+EVAL = Histogram("simplebrain_eval_seconds", "Token generation time reported by llama.cpp")
+MODEL_LOAD = Histogram("simplebrain_model_load_seconds",
+                       "Model load time reported by llama.cpp for each subprocess run", buckets=STAGE_BUCKETS)
+PROMPT_TOKENS = Counter("simplebrain_prompt_tokens_total", "Prompt tokens evaluated")
+COMPLETION_TOKENS = Counter("simplebrain_completion_tokens_total", "Tokens generated")
+
+BACKEND_READY = Gauge("simplebrain_backend_ready", "1 when the resident llama-server has its model loaded")
+BACKEND_RESTARTS = Counter("simplebrain_backend_restarts_total", "Times the resident llama-server was restarted")
+BACKEND_LOAD = Gauge("simplebrain_backend_load_seconds", "Time the resident llama-server took to load the model")
+
+ROUTER_RESIDENT = Gauge("simplebrain_router_resident_models", "Models currently loaded (router mode)")
+ROUTER_MEMORY = Gauge("simplebrain_router_memory_used_mb", "Estimated memory of the loaded models (router mode)")
+ROUTER_LOADS = Counter("simplebrain_router_loads_total", "Models loaded on demand (router mode)")
+ROUTER_EVICTIONS = Counter("simplebrain_router_evictions_total",
+                           "Models unloaded to fit another one in the memory budget (router mode)")
+
+CACHE_HITS = Counter("simplebrain_cache_hits_total", "Response cache hits")
+CACHE_MISSES = Counter("simplebrain_cache_misses_total", "Response cache misses")
+CACHE_HIT_RATIO = Gauge("simplebrain_cache_hit_ratio", "Response cache hits / lookups since startup")
+COALESCED = Counter("simplebrain_coalesced_requests_total", "Requests served by joining an identical generation")
+
+
+def bind(request_scheduler, responses, inflight, backend_status, server="flask"):
+    """Point the state-derived metrics at one app's scheduler, cache and backend"""
+    INFO.set(1, instance_name=os.environ.get("INSTANCE_NAME", "unknown"),
+             model_type=os.environ.get("MODEL_TYPE", "unknown"), server=server)
+
+    QUEUE_DEPTH.set_function(lambda: request_scheduler.stats()["queue_depth"])
+    QUEUE_ACTIVE.set_function(lambda: request_scheduler.stats()["active"])
+    QUEUE_REJECTED.set_function(lambda: request_scheduler.stats()["rejected_total"])
+    QUEUE_TIMED_OUT.set_function(lambda: request_scheduler.stats()["timed_out_total"])
+    QUEUE_DEADLINE_MISSED.set_function(lambda: request_scheduler.stats()["deadline_missed_total"])
+    QUEUE_PREEMPTED.set_function(lambda: request_scheduler.stats()["preempted_total"])
+
+    def backend_ready():
+        state = backend_status().get("state")  # None in subprocess mode
+        return None if state is None else int(state == "ready")
+
+    BACKEND_READY.set_function(backend_ready)
+    BACKEND_RESTARTS.set_function(lambda: backend_status().get("restarts"))
+    BACKEND_LOAD.set_function(lambda: backend_status().get("load_seconds"))
+
+    # Only present in router mode
+    ROUTER_RESIDENT.set_function(lambda: len(backend_status()["resident"]) if "resident" in backend_status() else None)
+    ROUTER_MEMORY.set_function(lambda: backend_status().get("used_mb"))
+    ROUTER_LOADS.set_function(lambda: backend_status().get("loads"))
+    ROUTER_EVICTIONS.set_function(lambda: backend_status().get("evictions"))
+
+    CACHE_HITS.set_function(lambda: responses.stats().get("hits"))
+    CACHE_MISSES.set_function(lambda: responses.stats().get("misses"))
+    CACHE_HIT_RATIO.set_function(lambda: responses.stats().get("hit_ratio"))
+    COALESCED.set_function(lambda: inflight.stats()["coalesced_total"])
+
+
+def observe_request(endpoint, status, seconds):
+    REQUESTS.inc(endpoint=endpoint, status=status)
+    REQUEST_LATENCY.observe(seconds, endpoint=endpoint)
+
+
+def observe_generation(outcome, ticket, first_token_at=None, finished_at=None, usage=None, timings=None):
+    """
+    Record one backend generation.
+
+    Stage times come from llama.cpp's own timings when the backend reports
+    them; tokens/sec falls back to wall clock from the first token.
+    """
+    GENERATIONS.inc(outcome=outcome)
+    QUEUE_WAIT.observe(ticket.wait_seconds)
+    if first_token_at is not None:
+        TIME_TO_FIRST_TOKEN.observe(first_token_at - ticket.enqueued_at)
+    if outcome != "ok":
+        return
+
+    timings = timings or {}
+    usage = usage or {}
+    if timings.get("prompt_ms") is not None:
+        PROMPT_EVAL.observe(timings["prompt_ms"] / 1000)
+    if timings.get("predicted_ms") is not None:
+        EVAL.observe(timings["predicted_ms"] / 1000)
+    if timings.get("load_ms") is not None:
+        MODEL_LOAD.observe(timings["load_ms"] / 1000)
+    if usage.get("prompt_tokens"):
+        PROMPT_TOKENS.inc(usage["prompt_tokens"])
+
+    completion_tokens = usage.get("completion_tokens") or timings.get("predicted_n")
+    if completion_tokens:
+        COMPLETION_TOKENS.inc(completion_tokens)
+
+    rate = timings.get("predicted_per_second")
+    if rate is None and completion_tokens and first_token_at is not None and finished_at is not None:
+        elapsed = finished_at - first_token_at
+        rate = completion_tokens / elapsed if elapsed > 0 else None
+    if rate:
+        TOKENS_PER_SECOND.observe(rate)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
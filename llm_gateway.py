@@ -0,0 +1,562 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+# Replicas of each instance type, e.g. "general=5001;coding=5002,5012,5022".
+# Members are localhost ports or base URLs.
+REPLICAS = os.environ.get('SIMPLEBRAIN_REPLICAS', '')
+
+# Port the gateway listens on
+GATEWAY_PORT = int(os.environ.get('GATEWAY_PORT', '5020'))
+
+# Seconds between /health probes of a replica
+PROBE_INTERVAL = float(os.environ.get('GATEWAY_PROBE_INTERVAL', '2'))
+PROBE_TIMEOUT = 2
+
+# An ejected replica is probed again after 1, 2, 4, ... seconds, at most BACKOFF_MAX
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+# Hedging (opt-in): a streaming request whose first token is later than this
+# percentile of recent first-token latencies is also sent to a second replica
+GATEWAY_HEDGE = os.environ.get('GATEWAY_HEDGE', '0') == '1'
+HEDGE_PERCENTILE = float(os.environ.get('GATEWAY_HEDGE_PERCENTILE', '95'))
+
+# Hedging delay in seconds until HEDGE_MIN_SAMPLES latencies have been seen
+HEDGE_DELAY = float(os.environ.get('GATEWAY_HEDGE_DELAY', '2'))
+HEDGE_MIN_SAMPLES = 20
+
+# Requests the gateway forwards; anything else is answered by the gateway itself
+PROXY_PATHS = ('/api/agent', '/api/agent/stream', '/api/agent/batch', '/v1/completions', '/v1/chat/completions')
+
+# Response headers passed through from the replica
+FORWARD_HEADERS = ('Content-Type', 'Retry-After', 'Cache-Control', 'X-Accel-Buffering')
+
+def parse_replicas(spec):
+    """Parse a SIMPLEBRAIN_REPLICAS value into an ordered {instance: [base URLs]} dict"""
+    replicas = {}
+    for group in spec.split(';'):
+        name, sep, members = group.partition('=')
+        urls = [member.strip() if '://' in member else f'http://localhost:{member.strip()}'
+                for member in members.split(',') if member.strip()]
+        if sep and name.strip() and urls:
+            replicas[name.strip()] = [url.rstrip('/') for url in urls]
+    return replicas
+
+class NoReplica(Exception):
+    """Raised when no replica of an instance type is healthy"""
+
+class Replica:
+    def __init__(self, url):
+        self.url = url
+        self.status = 'unknown'
+        self.healthy = False
+        # Active plus queued requests at the last probe, and the replica's slots
+        self.load = 0
+        self.capacity = 1
+        # Requests sent since the last probe, which its load does not include yet
+        self.dispatched = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.probed_at = None
+        self.picked_at = 0.0
+
+    @property
+    def score(self):
+        return (self.load + self.dispatched) / self.capacity
+
+class LatencyTracker:
+    """Recent first-token latencies of an instance type, which set its hedging delay"""
+
+    def __init__(self, percentile=HEDGE_PERCENTILE, default=HEDGE_DELAY, window=200):
+        self.percentile = percentile
+        self.default = default
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def delay(self):
+        """Seconds to wait for a first token before hedging"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return self.default
+        return samples[min(len(samples) - 1, int(len(samples) * self.percentile / 100))]
+
+class ReplicaPool:
+    """
+    Least-loaded routing over the replicas of one instance type.
+
+    Replicas are probed through /health at most every `probe_interval`
+    seconds; requests go to the healthy replica with the fewest active and
+    queued requests per slot. A replica that is unreachable, unhealthy or
+    fails a request is ejected and probed again after an exponential
+    backoff. Replicas that are still loading, tuning or warming up are
+    skipped without backoff.
+    """
+
+    def __init__(self, urls, session=None, probe_interval=PROBE_INTERVAL):
+        self.replicas = [Replica(url) for url in urls]
+        self.session = session or requests.Session()
+        self.probe_interval = probe_interval
+        self.first_token = LatencyTracker()
+        # Requests sent to a second replica, and how often that copy answered first
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def _probe(self, replica):
+        try:
+            response = self.session.get(f'{replica.url}/health', timeout=PROBE_TIMEOUT)
+            data = response.json()
+        except (requests.exceptions.RequestException, ValueError):
+            self.eject(replica, 'offline')
+            return
+
+        status = data.get('status', 'unknown')
+        # Starting replicas are skipped until they are ready, but not backed off
+        if response.status_code != 200 and status not in ('loading', 'tuning', 'warming'):
+            self.eject(replica, status)
+            return
+        stats = data.get('queue') or {}
+        with self._lock:
+            replica.status = status
+            replica.healthy = response.status_code == 200
+            replica.load = stats.get('active', 0) + stats.get('queue_depth', 0)
+            replica.capacity = max(1, stats.get('max_concurrent', 1))
+            replica.dispatched = 0
+            replica.probed_at = time.monotonic()
+            if replica.healthy:
+                replica.failures = 0
+
+    def refresh(self, force=False):
+        """Probe the replicas that are due: stale ones and ejected ones whose backoff has passed"""
+        # Only the very first refresh is waited for; later ones skip while
+        # another thread is probing and the current data is used instead
+        first = any(replica.probed_at is None for replica in self.replicas)
+        if not self._refresh_lock.acquire(blocking=first or force):
+            return
+        try:
+            now = time.monotonic()
+            due = [replica for replica in self.replicas
+                   if replica.ejected_until <= now and (force or replica.probed_at is None
+                                                        or now - replica.probed_at >= self.probe_interval)]
+            if due:
+                with ThreadPoolExecutor(max_workers=len(due)) as pool:
+                    list(pool.map(self._probe, due))
+        finally:
+            self._refresh_lock.release()
+
+    def eject(self, replica, status='failed'):
+        """Take a replica out of rotation until its backoff has passed"""
+        with self._lock:
+            replica.failures += 1
+            backoff = min(BACKOFF_BASE * 2 ** (replica.failures - 1), BACKOFF_MAX)
+            replica.ejected_until = time.monotonic() + backoff
+            replica.healthy = False
+            replica.status = status
+            replica.probed_at = time.monotonic()
+
+    def pick(self, exclude=(), affinity=None):
+        """
+        The least-loaded healthy replica; raises NoReplica if there is none.
+
+        With an `affinity` key (a conversation's session ID) the same replica
+        is picked every time while it stays healthy (rendezvous hashing), so
+        each turn reaches the replica holding the conversation.
+        """
+        self.refresh()
+        with self._lock:
+            now = time.monotonic()
+            candidates = [replica for replica in self.replicas
+                          if replica.healthy and replica.ejected_until <= now and replica not in exclude]
+            if not candidates:
+                raise NoReplica(f"No healthy replica ({', '.join(r.url for r in self.replicas)})")
+            if affinity is not None:
+                replica = max(candidates, key=lambda r: hashlib.sha256(f"{affinity}@{r.url}".encode()).digest())
+            else:
+                replica = min(candidates, key=lambda r: (r.score, r.picked_at))
+            replica.dispatched += 1
+            replica.picked_at = now
+            return replica
+
+    def status(self):
+        """State of every replica, for health output"""
+        now = time.monotonic()
+        with self._lock:
+            return [{
+                'url': replica.url,
+                'status': replica.status,
+                'healthy': replica.healthy and replica.ejected_until <= now,
+                'load': replica.load + replica.dispatched,
+                'capacity': replica.capacity,
+                'failures': replica.failures,
+                'retry_in': round(max(0.0, replica.ejected_until - now), 1) or None,
+            } for replica in self.replicas]
+
+def carries_token(line):
+    """
+    Whether a streamed line is past the stream's preamble: Server-Sent
+    Events come with blank separator lines, and chat streams open with a
+    role-only chunk before the first token. Anything else, errors and the
+    end of the stream included, counts.
+    """
+    if not line.strip():
+        return False
+    if not line.startswith(b'data: ') or line == b'data: [DONE]':
+        return True
+    try:
+        event = json.loads(line[len(b'data: '):])
+    except ValueError:
+        return True
+    if not isinstance(event, dict) or not event.get('choices'):
+        return True
+    return any(choice.get('text') or (choice.get('delta') or {}).get('content') or choice.get('finish_reason')
+               for choice in event['choices'])
+
+
+def hedged_post(pool, path, body, headers=None):
+    """
+    POST a streaming request, racing a second replica if the first token is late.
+
+    The request goes to the least-loaded replica; if its first token (the
+    first line for which carries_token() holds) has not arrived after
+    pool.first_token.delay(), or it fails, the same request is sent to
+    another replica. The first attempt to produce a token wins and returns
+    (replica, response, lines), `lines` yielding every line of the response. The other attempt's connection
+    is closed, which stops its generation in the backend. When every
+    attempt fails the last failed response is returned (e.g. a 429), or
+    the error is raised.
+    """
+    results = queue.Queue()
+    lock = threading.Lock()
+    responses = {}
+    winner = []
+
+    def attempt(replica):
+        try:
+            response = pool.session.post(f'{replica.url}{path}', data=body, headers=headers,
+                                         stream=True, timeout=(5, 300))
+        except requests.exceptions.RequestException as e:
+            pool.eject(replica, 'offline')
+            results.put((replica, None, None, e))
+            return
+        with lock:
+            if winner:
+                response.close()
+                return
+            responses[replica] = response
+        if response.status_code != 200:
+            results.put((replica, response, response.iter_lines(), None))
+            return
+        try:
+            lines = response.iter_lines()
+            preamble = []
+            while not preamble or not carries_token(preamble[-1]):
+                preamble.append(next(lines))
+        except (requests.exceptions.RequestException, StopIteration, AttributeError, ValueError, OSError) as e:
+            # Also raised when the winner closes this connection under us
+            results.put((replica, None, None, e))
+            return
+        results.put((replica, response, itertools.chain(preamble, lines), None))
+
+    def launch(replica):
+        tried.append(replica)
+        threading.Thread(target=attempt, args=(replica,), daemon=True).start()
+
+    started = time.monotonic()
+    tried = []
+    launch(pool.pick())
+    hedge_at = started + pool.first_token.delay()
+    running = 1
+    failure = None
+    while running:
+        try:
+            timeout = max(0.0, hedge_at - time.monotonic()) if hedge_at else None
+            replica, response, lines, error = results.get(timeout=timeout)
+        except queue.Empty:
+            hedge_at = None
+            try:
+                launch(pool.pick(exclude=tried))
+                running += 1
+                pool.hedged += 1
+            except NoReplica:
+                pass
+            continue
+
+        running -= 1
+        # Busy or failing replicas lose; anything else, a 400 included, is the answer
+        if error is None and response.status_code not in (429, 503) and response.status_code < 500:
+            with lock:
+                winner.append(replica)
+                losers = [r for r in responses.values() if r is not response]
+            for loser in losers:
+                loser.close()
+            if response.status_code == 200:
+                pool.first_token.observe(time.monotonic() - started)
+            if replica is not tried[0]:
+                pool.hedge_wins += 1
+            return replica, response, lines
+
+        if error is not None and not isinstance(error, StopIteration):
+            pool.eject(replica, 'failed')
+        if failure is not None and failure[1] is not None:
+            failure[1].close()
+        failure = (replica, response, lines, error)
+        # Fail over right away instead of waiting for the hedging delay
+        if hedge_at:
+            hedge_at = time.monotonic()
+
+    replica, response, lines, error = failure
+    if response is None:
+        raise error if isinstance(error, requests.exceptions.RequestException) else NoReplica(str(error) or 'Empty response')
+    return replica, response, lines
+
+def agent_body(lines):
+    """The /api/agent response body for the lines of an /api/agent/stream response"""
+    for line in lines:
+        if not line:
+            continue
+        event = json.loads(line)
+        if event.get('done'):
+            event.pop('done')
+            return event
+        if 'error' in event:
+            return {"llm_response": f"Error: {event['error']}", "executed_command": None,
+                    "command_result": None, "usage": None, "cached": False}
+    return agent_body([json.dumps({'error': 'Stream ended without a result'})])
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    """
+    Forwards API requests to the least-loaded replica of an instance type.
+
+    The instance type comes from a path prefix (/coding/api/agent) or the
+    body's "model" field, as with the single-process router, and defaults
+    to the first one configured. Responses, streams included, are relayed
+    as they arrive.
+    """
+
+    pools = {}
+    hedge = GATEWAY_HEDGE
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body, status=200, replica=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if replica is not None:
+            self.send_header('X-SimpleBrain-Replica', replica.url)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def health(self):
+        models = {}
+        for name, pool in self.pools.items():
+            replicas = pool.status()
+            healthy = sum(1 for replica in replicas if replica['healthy'])
+            models[name] = {'state': 'ready' if healthy else 'unavailable', 'healthy_replicas': healthy,
+                            'replicas': replicas}
+            if self.hedge:
+                models[name]['hedging'] = {'delay_seconds': round(pool.first_token.delay(), 3),
+                                           'hedged': pool.hedged, 'won': pool.hedge_wins}
+        ready = all(model['healthy_replicas'] for model in models.values())
+        return {
+            'status': 'healthy' if ready else 'degraded',
+            'service': 'SimpleBrain gateway',
+            'backend': {'mode': 'gateway', 'models': models, 'default_model': next(iter(self.pools))},
+        }, 200 if ready else 503
+
+    def do_GET(self):
+        if self.path == '/health':
+            body, status = self.health()
+            self.send_json(body, status)
+        elif self.path == '/v1/models':
+            self.send_json({'object': 'list', 'data': [
+                {'id': name, 'object': 'model', 'created': 0, 'owned_by': 'simplebrain'} for name in self.pools]})
+        elif self.path == '/':
+            self.send_json({'status': 'healthy', 'service': 'SimpleBrain gateway', 'version': '1.0'})
+        else:
+            self.send_json({'error': 'Endpoint not found'}, 404)
+
+    def do_DELETE(self):
+        # Ending a conversation: DELETE [/<role>]/api/session/<id> goes to
+        # the replica holding it
+        name, _, path = self.path.lstrip('/').partition('/')
+        if name in self.pools:
+            path = '/' + path
+        else:
+            name, path = next(iter(self.pools)), self.path
+        if not path.startswith('/api/session/'):
+            self.send_json({'error': 'Endpoint not found'}, 404)
+            return
+        self.forward(self.pools[name], path, None, affinity=path[len('/api/session/'):])
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        name, _, path = self.path.lstrip('/').partition('/')
+        if name in self.pools:
+            path = '/' + path
+        else:
+            name, path = None, self.path
+        if path not in PROXY_PATHS:
+            self.send_json({'error': 'Endpoint not found'}, 404)
+            return
+
+        try:
+            data = json.loads(body or b'{}')
+        except ValueError:
+            data = None
+        data = data if isinstance(data, dict) else {}
+        if name is None:
+            model = data.get('model')
+            if model is not None and model not in self.pools:
+                self.send_json({'error': f"Unknown model: {model} (available: {', '.join(self.pools)})"}, 400)
+                return
+            name = model or next(iter(self.pools))
+
+        # A conversation's turns go to the replica holding it, never hedged
+        session_id = data.get('session_id')
+        if isinstance(session_id, str):
+            self.forward(self.pools[name], path, body, affinity=session_id)
+        # Only token streams are hedged; /api/agent is sent as one
+        elif self.hedge and (path in ('/api/agent', '/api/agent/stream') or (path.startswith('/v1/') and data.get('stream'))):
+            self.forward_hedged(self.pools[name], path, body)
+        else:
+            self.forward(self.pools[name], path, body)
+
+    def forward_hedged(self, pool, path, body):
+        """Send the request with hedging (see hedged_post)"""
+        # The losing copy of an /api/agent request is stopped by closing its
+        # stream, so the request runs as /api/agent/stream
+        try:
+            replica, response, lines = hedged_post(
+                pool, '/api/agent/stream' if path == '/api/agent' else path, body,
+                headers={'Content-Type': self.headers.get('Content-Type', 'application/json')}
+            )
+        except (NoReplica, requests.exceptions.RequestException) as e:
+            self.send_json({'error': str(e)}, 503)
+            return
+
+        if path == '/api/agent' and response.status_code == 200:
+            with response:
+                try:
+                    body = agent_body(lines)
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    body = agent_body([json.dumps({'error': f'Replica failed: {e}'})])
+            self.send_json(body, replica=replica)
+        else:
+            self.relay(replica, response, (line + b'\n' for line in lines))
+
+    def forward(self, pool, path, body, affinity=None):
+        """
+        Send the request to a replica, moving on to the next one if it is
+        down or busy. Requests with an `affinity` key stay on their replica
+        while it is up, even when it is busy.
+        """
+        tried = []
+        while True:
+            try:
+                replica = pool.pick(exclude=tried, affinity=affinity)
+            except NoReplica as e:
+                self.send_json({'error': str(e)}, 503)
+                return
+            tried.append(replica)
+            try:
+                response = pool.session.request(
+                    self.command, f'{replica.url}{path}', data=body,
+                    headers={'Content-Type': self.headers.get('Content-Type', 'application/json')},
+                    stream=True, timeout=(5, 300)
+                )
+            except requests.exceptions.RequestException:
+                pool.eject(replica, 'offline')
+                continue
+            # A busy replica's 429/503 is only returned when every replica is busy
+            if response.status_code in (429, 503) and affinity is None and len(tried) < len(pool.replicas):
+                response.close()
+                continue
+            break
+
+        self.relay(replica, response, response.iter_content(chunk_size=None))
+
+    def relay(self, replica, response, chunks):
+        """Pass a replica's response on to the client as it arrives"""
+        with response:
+            self.send_response(response.status_code)
+            for header in FORWARD_HEADERS:
+                if header in response.headers:
+                    self.send_header(header, response.headers[header])
+            self.send_header('X-SimpleBrain-Replica', replica.url)
+            self.end_headers()
+            try:
+                for chunk in chunks:
+                    self.wfile.write(chunk)
+                    self.wfile.flush()
+            except (requests.exceptions.RequestException, OSError):
+                # The client went away (closing the upstream stream stops the
+                # generation) or the replica failed part-way
+                pass
+
+def probe_loop(pools, interval):
+    """Keep replica health fresh so requests never wait for a probe"""
+    while True:
+        for pool in pools.values():
+            pool.refresh()
+        time.sleep(interval)
+
+def main():
+    parser = argparse.ArgumentParser(description='SimpleBrain replica gateway')
+    parser.add_argument('--replicas', default=REPLICAS,
+                        help='Replicas per instance, e.g. "general=5001;coding=5002,5012,5022" (default: $SIMPLEBRAIN_REPLICAS)')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=GATEWAY_PORT, help='Port to listen on (default: $GATEWAY_PORT or 5020)')
+    parser.add_argument('--probe-interval', type=float, default=PROBE_INTERVAL, help='Seconds between health probes')
+    parser.add_argument('--hedge', action='store_true', default=GATEWAY_HEDGE,
+                        help='Send streaming requests to a second replica when the first token is late (default: $GATEWAY_HEDGE)')
+    args = parser.parse_args()
+
+    replicas = parse_replicas(args.replicas)
+    if not replicas:
+        print('ERROR: no replicas configured (use --replicas or SIMPLEBRAIN_REPLICAS)', file=sys.stderr)
+        sys.exit(1)
+
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=64))
+    GatewayHandler.hedge = args.hedge
+    GatewayHandler.pools = {name: ReplicaPool(urls, session, args.probe_interval) for name, urls in replicas.items()}
+    threading.Thread(target=probe_loop, args=(GatewayHandler.pools, args.probe_interval), daemon=True).start()
+
+    for name, urls in replicas.items():
+        print(f"Gateway: {name} -> {', '.join(urls)}", file=sys.stderr)
+    if args.hedge:
+        print(f"Gateway: hedging after the p{HEDGE_PERCENTILE:g} first-token latency "
+              f"({HEDGE_DELAY:g}s until {HEDGE_MIN_SAMPLES} requests have been seen)", file=sys.stderr)
+    print(f"Gateway listening on http://{args.host}:{args.port}", file=sys.stderr)
+    server = ThreadingHTTPServer((args.host, args.port), GatewayHandler)
+    server.daemon_threads = True
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
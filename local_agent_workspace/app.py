@@ -1,38 +1,692 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
+import json
+import os
+import queue
+import select
+import signal
+import socket
+import sys
+import threading
+import time
 import llm_interface
-import agent_actions
+import agent_api
+import metrics
+import openai_api
+import response_cache
+import retrieval
+import scheduler
+import sessions
+import singleflight
+import warmup
 
 app = Flask(__name__)
 
+# Bounds how many generations run at once and how many may wait for a slot.
+# By default one request per llama-server slot runs; the server batches them.
+request_scheduler = agent_api.new_scheduler()
+
+# Opt-in exact-match cache of generated responses (RESPONSE_CACHE_SIZE > 0)
+responses = response_cache.ResponseCache()
+
+inflight = singleflight.SingleFlight()
+
+# Running generation requests, cancellable with DELETE /api/agent/<id>
+active_requests = agent_api.ActiveRequests()
+
+# Conversations continued by requests with a "session_id"; a session that
+# ends releases its llama-server slot and spilled KV state
+conversations = sessions.SessionStore(on_end=llm_interface.end_session)
+
+metrics.bind(request_scheduler, responses, inflight, llm_interface.get_backend_status)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.monotonic()
+
+@app.after_request
+def record_request_metrics(response):
+    """Count the request once its body has been sent (streams included)"""
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    started = g.get("request_started", time.monotonic())
+    status = response.status_code
+    response.call_on_close(lambda: metrics.observe_request(endpoint, status, time.monotonic() - started))
+    if "request_id" in g:
+        response.headers["X-Request-ID"] = g.request_id
+    return response
+
+# Add health check endpoint
+@app.route('/', methods=['GET'])
+def health_check():
+    """Health check endpoint to verify the API is running"""
+    return jsonify({
+        "status": "healthy",
+        "service": "SimpleBrain LLM API",
+        "version": "1.0"
+    })
+
+@app.route('/health', methods=['GET'])
+def detailed_health():
+    """Detailed health check including model availability"""
+    health_status, status = agent_api.health_report(request_scheduler, responses, inflight, active=active_requests,
+                                                    conversations=conversations)
+    return jsonify(health_status), status
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Request, queue, latency and backend metrics in Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/model', methods=['GET', 'POST'])
+def admin_model():
+    """
+    Show the loaded model, or hot-swap it with POST {"model": "<file>.gguf"}.
+
+    The new model is loaded and warmed up next to the current one before
+    traffic moves over; requires the X-Admin-Token header.
+    """
+    error = agent_api.admin_error(request.headers)
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+    if request.method == 'GET':
+        return jsonify(agent_api.model_status())
+
+    model_path, error = agent_api.resolve_model(request.get_json(silent=True))
+    if error:
+        return jsonify({"error": error}), 400
+    try:
+        result = llm_interface.swap_model(model_path)
+    except llm_interface.SwapInProgress as e:
+        return jsonify({"error": str(e)}), 409
+    except llm_interface.LLMError as e:
+        return jsonify({"error": str(e)}), 500
+    return jsonify(dict(status="switched", **result))
+
+@app.route('/admin/reload', methods=['POST'])
+def admin_reload():
+    """
+    Resolve the llama.cpp executables and model files again, e.g. after
+    replacing a model in place; /health serves the result from memory.
+    """
+    error = agent_api.admin_error(request.headers)
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+    llm_interface.refresh_backend("admin reload")
+    return jsonify(dict(status="reloaded", **llm_interface.descriptor_status()))
+
+def validate_prompt(data):
+    """Validate an /api/agent request body; returns an error response or None"""
+    error = agent_api.prompt_error(data)
+    return (jsonify({"error": error}), 400) if error else None
+
+def busy_response(error):
+    """429 when the queue is full, 503 when a request timed out or cannot meet its deadline"""
+    response = jsonify({"error": str(error), "retry_after": error.retry_after})
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, agent_api.busy_status(error)
+
+def run_generation(flight, full_prompt, ticket, cache_key, model=None, params=None, session_id=None):
+    """Produce a flight's tokens in the background; stops once every subscriber has left"""
+    info = {}
+    # The last subscriber leaving kills llama.cpp or breaks off the
+    # llama-server stream at once, instead of at the next token
+    flight.on_cancel = lambda: llm_interface.cancel(info)
+    tokens = llm_interface.stream_llm_response(full_prompt, info, model=model, params=params, session=session_id)
+    outcome = "error"
+    first_token_at = None
+    try:
+        # Cancelled while waiting in the queue: hand the slot straight on
+        if flight.cancelled:
+            outcome = "cancelled"
+            flight.fail(llm_interface.LLMError("Generation cancelled: all clients disconnected"))
+            return
+        for token in tokens:
+            if flight.preempted:
+                raise scheduler.Preempted()
+            if flight.cancelled:
+                outcome = "cancelled"
+                flight.fail(llm_interface.LLMError("Generation cancelled: all clients disconnected"))
+                return
+            if first_token_at is None:
+                first_token_at = time.monotonic()
+            flight.publish(token)
+
+        result = {"text": "".join(flight.tokens).strip(), "usage": info.get("usage")}
+        responses.put(cache_key, result)
+        flight.finish(result)
+        outcome = "ok"
+    except Exception as e:
+        if flight.preempted:
+            # Stopped for an interactive request; subscribers queue up again
+            outcome = "preempted"
+            e = scheduler.Preempted()
+        elif flight.cancelled:
+            # The backend failing because it was aborted
+            outcome = "cancelled"
+            e = llm_interface.LLMError("Generation cancelled: all clients disconnected")
+        elif not isinstance(e, llm_interface.LLMError):
+            app.logger.error(f"LLM streaming error: {e}")
+            e = llm_interface.LLMError(f"LLM processing failed: {str(e)}")
+        flight.fail(e)
+    finally:
+        # Closing the stream stops the backend generation if it is still running
+        tokens.close()
+        metrics.observe_generation(outcome, ticket, first_token_at, time.monotonic(),
+                                   info.get("usage"), info.get("timings"))
+        ticket.release()
+        inflight.forget(flight)
+
+def preempt_generation(flight):
+    """Ticket.preempt of a batch generation: abort it unless a subscriber could not retry it"""
+    if not flight.preemptible:
+        return False
+    flight.preempted = True
+    if flight.on_cancel is not None:
+        flight.on_cancel()
+    return True
+
+def start_generation(full_prompt, key, model=None, params=None, session=None, urgency=None, preemptible=False):
+    """
+    Subscribe to the generation for a wrapped prompt on a (routed) model.
+
+    Joins an identical generation that is already running, or schedules a
+    new one (in the slot of `session`, if given) with the priority and
+    deadline in `urgency`. A `preemptible` caller retries when the flight
+    fails with Preempted. The caller must call flight.leave() when it stops
+    listening. Raises QueueFull/QueueTimeout/DeadlineExceeded when a new
+    generation cannot be scheduled.
+    """
+    flight, leader = inflight.join(key if agent_api.DEDUPLICATE_REQUESTS else object())
+    if not preemptible:
+        flight.preemptible = False
+    if not leader:
+        return flight
+
+    try:
+        ticket = request_scheduler.acquire(**(urgency or {}))
+    except agent_api.BUSY_ERRORS as e:
+        # Requests that joined while this one was queued get the same answer
+        flight.fail(e)
+        inflight.forget(flight)
+        flight.leave()
+        raise
+
+    if preemptible:
+        ticket.preempt = lambda: preempt_generation(flight)
+    session_id = session.id if session is not None else None
+    threading.Thread(target=run_generation, args=(flight, full_prompt, ticket, key, model, params, session_id),
+                     daemon=True).start()
+    return flight
+
+def client_disconnected(sock):
+    """True once the client has closed the connection of a request whose body has been read"""
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and not sock.recv(1, socket.MSG_PEEK)
+    except ValueError:
+        # TLS sockets cannot peek; treat the client as still connected
+        return False
+    except OSError:
+        return True
+
+def register_request():
+    """
+    Register the current request for cancellation under its X-Request-ID.
+
+    Returns (cancel event, error response); the event is set by DELETE
+    /api/agent/<id>. The caller must unregister g.request_id when done.
+    """
+    g.request_id = agent_api.request_id(request.headers)
+    cancel_event = active_requests.register(g.request_id)
+    if cancel_event is None:
+        response = jsonify({"error": f"Request ID already in use: {g.request_id}"}), 409
+        del g.request_id
+        return None, response
+    return cancel_event, None
+
+def cancel_check(cancel_event):
+    """
+    Check to pass to Flight.wait()/stream(): true once the request is
+    cancelled or its client has disconnected.
+    """
+    # Only Werkzeug's server exposes the socket; elsewhere disconnects are
+    # noticed when writing a streamed token
+    sock = request.environ.get("werkzeug.socket")
+    return lambda: cancel_event.is_set() or (sock is not None and client_disconnected(sock))
+
+@app.route('/api/agent/<request_id>', methods=['DELETE'])
+def cancel_agent_request(request_id):
+    """
+    Cancel a running /api/agent, /api/agent/stream or /api/agent/batch
+    request by the ID from its X-Request-ID header. Its generation is
+    aborted in the backend unless other requests are sharing it.
+    """
+    if not active_requests.cancel(request_id):
+        return jsonify({"error": f"No running request with ID {request_id}"}), 404
+    return jsonify({"status": "cancelled", "request_id": request_id})
+
+@app.route('/api/session/<session_id>', methods=['DELETE'])
+def end_agent_session(session_id):
+    """End a conversation, freeing its llama-server slot and spilled KV state"""
+    if not conversations.end(session_id):
+        return jsonify({"error": f"No idle session with ID {session_id}"}), 404
+    return jsonify({"status": "ended", "session_id": session_id})
+
 @app.route('/api/agent', methods=['POST'])
 def handle_agent_prompt():
-    data = request.get_json()
-    if not data or 'prompt' not in data:
-        return jsonify({"error": "Prompt not provided"}), 400
-
-    prompt = data['prompt']
-
-    # Add a simple instruction wrapper for the LLM
-    full_prompt = (
-        "You are a helpful AI assistant. Your goal is to answer the user's question or "
-        "execute a command to satisfy their request. If a shell command is needed, "
-        "provide it inside [CMD]...[/CMD] tags.\n\n"
-        f"User request: {prompt}\n\nAssistant:"
+    try:
+        data = request.get_json()
+        error = validate_prompt(data)
+        if error:
+            return error
+
+        try:
+            session = agent_api.open_session(conversations, data)
+        except sessions.SessionBusy as e:
+            return jsonify({"error": str(e)}), 409
+        result = None
+        try:
+            try:
+                prompt, sources = retrieval.prompt_for(data)
+            except retrieval.ERRORS as e:
+                return jsonify({"error": str(e)}), retrieval.error_status(e)
+            params, _ = agent_api.generation_params(data)
+            full_prompt = agent_api.wrap_prompt(prompt, agent_api.session_turns(conversations, session, prompt, params))
+            model = agent_api.request_model(data)
+            key = agent_api.request_key(full_prompt, model, params)
+
+            cached = responses.get(key)
+            if cached is not None:
+                result = cached
+                return jsonify(agent_api.agent_response(cached["text"], cached["usage"], cached=True, session=session,
+                                                        sources=sources))
+
+            cancel_event, error = register_request()
+            if error:
+                return error
+            try:
+                # Get the raw response from the LLM
+                try:
+                    flight = start_generation(full_prompt, key, model, params, session, agent_api.urgency(data))
+                except agent_api.BUSY_ERRORS as e:
+                    return busy_response(e)
+
+                try:
+                    result = flight.wait(cancelled=cancel_check(cancel_event))
+                except singleflight.FlightError as e:
+                    if isinstance(e.cause, agent_api.BUSY_ERRORS):
+                        return busy_response(e.cause)
+                    return jsonify(agent_api.agent_response(f"Error: {e}", session=session))
+                finally:
+                    flight.leave()
+            finally:
+                active_requests.unregister(g.request_id)
+
+            return jsonify(agent_api.agent_response(result["text"], result["usage"], session=session, sources=sources))
+        finally:
+            # Only completed turns become part of the conversation
+            agent_api.close_session(conversations, session, data['prompt'], result)
+    
+    except Exception as e:
+        app.logger.error(f"Unexpected error in handle_agent_prompt: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+@app.route('/api/agent/stream', methods=['POST'])
+def handle_agent_stream():
+    """
+    Stream the LLM response as newline-delimited JSON.
+
+    Emits {"token": ...} events as the backend produces them, then a final
+    {"done": true, ...} event carrying the same fields as /api/agent, or an
+    {"error": ...} event if generation fails part-way.
+    """
+    data = request.get_json(silent=True)
+    error = validate_prompt(data)
+    if error:
+        return error
+
+    try:
+        session = agent_api.open_session(conversations, data)
+    except sessions.SessionBusy as e:
+        return jsonify({"error": str(e)}), 409
+    try:
+        prompt, sources = retrieval.prompt_for(data)
+    except retrieval.ERRORS as e:
+        agent_api.close_session(conversations, session, data['prompt'])
+        return jsonify({"error": str(e)}), retrieval.error_status(e)
+    params, _ = agent_api.generation_params(data)
+    full_prompt = agent_api.wrap_prompt(prompt, agent_api.session_turns(conversations, session, prompt, params))
+    model = agent_api.request_model(data)
+    key = agent_api.request_key(full_prompt, model, params)
+
+    cached = responses.get(key)
+    if cached is not None:
+        agent_api.close_session(conversations, session, data['prompt'], cached)
+        events = [{"token": cached["text"]},
+                  dict(done=True, **agent_api.agent_response(cached["text"], cached["usage"], cached=True, session=session,
+                                                             sources=sources))]
+        return Response((json.dumps(event) + "\n" for event in events), mimetype='application/x-ndjson')
+
+    cancel_event, error = register_request()
+    if error:
+        agent_api.close_session(conversations, session, data['prompt'])
+        return error
+    request_id = g.request_id
+    cancelled = cancel_check(cancel_event)
+
+    # Wait for a slot before committing to a 200 streaming response
+    try:
+        flight = start_generation(full_prompt, key, model, params, session, agent_api.urgency(data))
+    except agent_api.BUSY_ERRORS as e:
+        active_requests.unregister(request_id)
+        agent_api.close_session(conversations, session, data['prompt'])
+        return busy_response(e)
+
+    completed = []
+    def generate():
+        try:
+            for token in flight.stream(cancelled):
+                yield json.dumps({"token": token}) + "\n"
+        except singleflight.FlightError as e:
+            yield json.dumps({"error": str(e)}) + "\n"
+            return
+
+        completed.append(flight.result)
+        yield json.dumps(dict(done=True, **agent_api.agent_response(flight.result["text"], flight.result["usage"],
+                                                                    session=session, sources=sources))) + "\n"
+
+    def finish():
+        flight.leave()
+        active_requests.unregister(request_id)
+        agent_api.close_session(conversations, session, data['prompt'], completed[0] if completed else None)
+
+    # A client disconnect closes the response; once no subscriber is left
+    # the generation is stopped in the backend as well
+    response = Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
+    response.call_on_close(finish)
+    return response
 
-    # Get the raw response from the LLM
-    llm_response = llm_interface.get_llm_response(full_prompt)
+def batch_item(item, cancelled):
+    """Generate one /api/agent/batch item and return its result line"""
+    cached = responses.get(item["key"])
+    if cached is not None:
+        return agent_api.batch_line(item, cached, cached=True)
+    while True:
+        try:
+            flight = start_generation(item["prompt"], item["key"], item["model"], item["params"],
+                                      urgency=item["urgency"], preemptible=True)
+        except agent_api.BUSY_ERRORS as e:
+            return agent_api.batch_line(item, error=e)
+        try:
+            return agent_api.batch_line(item, flight.wait(cancelled=cancelled))
+        except singleflight.FlightError as e:
+            # Stopped for an interactive request: queue up again behind it
+            if isinstance(e.cause, scheduler.Preempted):
+                continue
+            return agent_api.batch_line(item, error=e.cause if isinstance(e.cause, agent_api.BUSY_ERRORS) else e)
+        finally:
+            flight.leave()
 
-    # Try to execute a command from the response
-    executed_command, command_result = agent_actions.execute_command(llm_response)
+def run_batch(pending, lines, cancelled):
+    """Batch worker: take items until none are left; once cancelled they are answered as such"""
+    while True:
+        try:
+            item = pending.get_nowait()
+        except queue.Empty:
+            return
+        if cancelled():
+            lines.put(agent_api.batch_line(item, error=singleflight.RequestCancelled()))
+        else:
+            lines.put(batch_item(item, cancelled))
 
-    return jsonify({
-        "llm_response": llm_response,
-        "executed_command": executed_command,
-        "command_result": command_result
-    })
+@app.route('/api/agent/batch', methods=['POST'])
+def handle_agent_batch():
+    """
+    Answer many prompts in one request, as newline-delimited JSON.
+
+    Runs up to one prompt per scheduler slot at a time, so the backend
+    batches them while the wait queue stays free for other clients. Emits
+    one line per prompt in completion order (with its "index" and "id"),
+    then a final {"done": true, ...} line.
+    """
+    items, error = agent_api.parse_batch(request.get_json(silent=True))
+    if error:
+        return jsonify({"error": error}), 400
+    cancel_event, error = register_request()
+    if error:
+        return error
+    request_id = g.request_id
+    cancelled = cancel_check(cancel_event)
+
+    pending = queue.Queue()
+    for item in items:
+        pending.put(item)
+    lines = queue.Queue()
+    for _ in range(min(len(items), request_scheduler.max_concurrent)):
+        threading.Thread(target=run_batch, args=(pending, lines, cancelled), daemon=True).start()
+
+    def generate():
+        done = []
+        for _ in items:
+            line = lines.get()
+            done.append(line)
+            yield json.dumps(line) + "\n"
+        yield json.dumps(agent_api.batch_summary(done)) + "\n"
+
+    def finish():
+        cancel_event.set()
+        active_requests.unregister(request_id)
+
+    # A disconnect or DELETE aborts the running prompts and answers the
+    # remaining ones as cancelled
+    response = Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    response.call_on_close(finish)
+    return response
+
+@app.route('/api/embed', methods=['POST'])
+def handle_embed():
+    """
+    Embedding vectors of {"input": "text"} or {"input": ["text", ...]},
+    computed by the resident embedding model (EMBED_MODEL_PATH).
+    """
+    texts, error = agent_api.embed_inputs(request.get_json(silent=True))
+    if error:
+        return jsonify({"error": error}), 400
+    try:
+        vectors = llm_interface.embed(texts)
+    except llm_interface.LLMError as e:
+        return jsonify({"error": str(e)}), retrieval.error_status(e)
+    return jsonify(agent_api.embed_response(vectors))
+
+@app.route('/api/index', methods=['GET', 'POST'])
+def handle_index():
+    """
+    Show the vector index, or add {"documents": [{"id": ..., "text": ...}]}
+    to it: each document is split into chunks that /api/agent requests
+    with "retrieve" can be given. A document replaces any with its ID.
+    """
+    try:
+        if request.method == 'GET':
+            return jsonify(retrieval.index().stats())
+        documents, error = agent_api.parse_documents(request.get_json(silent=True))
+        if error:
+            return jsonify({"error": error}), 400
+        counts = retrieval.add_documents(documents)
+    except retrieval.ERRORS as e:
+        return jsonify({"error": str(e)}), retrieval.error_status(e)
+    return jsonify({"status": "indexed", "chunks": counts})
+
+@app.route('/api/index/search', methods=['POST'])
+def search_index():
+    """The {"k": 5} chunks most similar to {"query": "..."}, best first"""
+    query, k, error = agent_api.search_query(request.get_json(silent=True))
+    if error:
+        return jsonify({"error": error}), 400
+    try:
+        return jsonify({"results": retrieval.search(query, k)})
+    except retrieval.ERRORS as e:
+        return jsonify({"error": str(e)}), retrieval.error_status(e)
+
+@app.route('/api/index/<doc_id>', methods=['DELETE'])
+def delete_indexed_document(doc_id):
+    """Remove a document's chunks from the vector index"""
+    try:
+        removed = retrieval.delete_document(doc_id)
+    except retrieval.ERRORS as e:
+        return jsonify({"error": str(e)}), retrieval.error_status(e)
+    if not removed:
+        return jsonify({"error": f"No indexed document with ID {doc_id}"}), 404
+    return jsonify({"status": "deleted", "id": doc_id, "chunks": removed})
+
+def start_choices(req):
+    """
+    The `n` choices of an OpenAI-style request: cached results, or flights
+    the caller must leave. Each choice is its own generation. Raises
+    QueueFull/QueueTimeout after leaving any flights already joined.
+    """
+    choices = []
+    try:
+        for index in range(req["n"]):
+            key = agent_api.request_key(req["prompt"], req["model"], req["params"], choice=index)
+            cached = responses.get(key)
+            choices.append(cached if cached is not None else
+                           start_generation(req["prompt"], key, req["model"], req["params"]))
+    except agent_api.BUSY_ERRORS:
+        leave_choices(choices)
+        raise
+    return choices
+
+def leave_choices(choices):
+    for choice in choices:
+        if isinstance(choice, singleflight.Flight):
+            choice.leave()
+
+def openai_busy_response(error):
+    response = jsonify(openai_api.busy_error_body(error))
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, agent_api.busy_status(error)
+
+def openai_stream(req, choices):
+    """Server-Sent Events for the choices, one after another; each runs concurrently in the backend"""
+    results = []
+    for index, choice in enumerate(choices):
+        if req["kind"] == "chat":
+            yield openai_api.chunk(req, index, role=True)
+        if isinstance(choice, singleflight.Flight):
+            try:
+                for token in choice.stream():
+                    yield openai_api.chunk(req, index, token)
+            except singleflight.FlightError as e:
+                yield openai_api.sse(openai_api.error_body(str(e), "server_error"))
+                return
+            choice = choice.result
+        else:
+            yield openai_api.chunk(req, index, choice["text"])
+        results.append(choice)
+        yield openai_api.chunk(req, index, finish=openai_api.finish_reason(req, choice))
+    if req["include_usage"]:
+        yield openai_api.usage_chunk(req, results)
+    yield openai_api.SSE_DONE
+
+def handle_openai_request(kind):
+    data = request.get_json(silent=True)
+    req, error = openai_api.parse_request(kind, data)
+    if error:
+        return jsonify(error), 400
+
+    try:
+        choices = start_choices(req)
+    except agent_api.BUSY_ERRORS as e:
+        return openai_busy_response(e)
+
+    if req["stream"]:
+        response = Response(
+            stream_with_context(openai_stream(req, choices)),
+            mimetype='text/event-stream',
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+        response.call_on_close(lambda: leave_choices(choices))
+        return response
+
+    results = []
+    failure = None
+    try:
+        for choice in choices:
+            if isinstance(choice, singleflight.Flight):
+                try:
+                    choice = choice.wait()
+                except singleflight.FlightError as e:
+                    failure = failure or e
+                    continue
+            results.append(choice)
+    finally:
+        leave_choices(choices)
+
+    if failure is not None:
+        if isinstance(failure.cause, agent_api.BUSY_ERRORS):
+            return openai_busy_response(failure.cause)
+        return jsonify(openai_api.error_body(str(failure), "server_error")), 500
+    return jsonify(openai_api.response_body(req, results))
+
+@app.route('/v1/completions', methods=['POST'])
+def openai_completions():
+    """OpenAI-compatible text completion (prompt, max_tokens, temperature, n, stream)"""
+    return handle_openai_request("completion")
+
+@app.route('/v1/chat/completions', methods=['POST'])
+def openai_chat_completions():
+    """OpenAI-compatible chat completion (messages, max_tokens, temperature, n, stream)"""
+    return handle_openai_request("chat")
+
+@app.route('/v1/models', methods=['GET'])
+def openai_models():
+    return jsonify(openai_api.model_list())
+
+# Error handlers
+@app.errorhandler(404)
+def not_found(error):
+    return jsonify({"error": "Endpoint not found"}), 404
+
+@app.errorhandler(500)
+def internal_error(error):
+    return jsonify({"error": "Internal server error"}), 500
 
 if __name__ == '__main__':
-    # Running with host=0.0.0.0 makes it accessible outside the container
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Check critical environment variables
+    # In router mode MODEL_PATH defaults to the first of ROUTER_MODELS
+    model_path = llm_interface.MODEL_PATH
+    if not model_path:
+        print("ERROR: MODEL_PATH (or ROUTER_MODELS) environment variable not set", file=sys.stderr)
+        sys.exit(1)
+    
+    if not os.path.exists(model_path):
+        print(f"ERROR: Model file not found at {model_path}", file=sys.stderr)
+        sys.exit(1)
+
+    # Exit cleanly on SIGTERM so the resident llama-server is stopped with us
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # SIGHUP re-resolves the executables and model files, like POST /admin/reload
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+        target=llm_interface.refresh_backend, args=("SIGHUP",), daemon=True).start())
 
+    # Load the model once, before accepting traffic
+    llm_interface.start_backend()
+    # The embedding model (EMBED_MODEL_PATH) for /api/embed and retrieval
+    llm_interface.start_embedding_backend()
+    # Optional (WARMUP=1): /health reports "warming" until the model is resident
+    warmup.start(model_path)
+    
+    # Start Flask app with production settings
+    app.run(
+        host='0.0.0.0', 
+        port=int(os.environ.get('API_PORT', 5000)), 
+        debug=False,  # Security fix: disabled debug mode
+        threaded=True  # Enable threading for better performance
+    )
\ No newline at end of file
@@ -0,0 +1,204 @@
+import os
+import sys
+import threading
+import time
+
+# Single-API mode: one process serves several models, chosen by the request's
+# "model" field, e.g. "general=/app/models/phi3-mini-4k.gguf,coding=/app/models/mistral-7b.gguf".
+# Unset (the default) keeps one model per instance.
+ROUTER_MODELS = os.environ.get("ROUTER_MODELS", "")
+
+# Model used when a request names none (default: the first one listed)
+ROUTER_DEFAULT_MODEL = os.environ.get("ROUTER_DEFAULT_MODEL")
+
+# Memory the resident models may use together, in MB
+ROUTER_MEMORY_BUDGET_MB = int(os.environ.get("ROUTER_MEMORY_BUDGET_MB", "8192"))
+
+# Which idle model to unload when a new one does not fit: "lru" or "lfu"
+ROUTER_EVICTION = os.environ.get("ROUTER_EVICTION", "lru").lower()
+
+# Seconds a request waits for busy models to finish so its own model fits
+ROUTER_WAIT_TIMEOUT = float(os.environ.get("ROUTER_WAIT_TIMEOUT", "60"))
+
+# Resident size of a model relative to its GGUF file (weights plus KV cache
+# and compute buffers)
+MEMORY_OVERHEAD = 1.2
+
+
+def parse_models(spec):
+    """Parse a ROUTER_MODELS value into an ordered {name: path} dict"""
+    models = {}
+    for item in spec.split(","):
+        name, sep, path = item.partition("=")
+        if sep and name.strip() and path.strip():
+            models[name.strip()] = path.strip()
+    return models
+
+
+class RouterBusy(Exception):
+    """Raised when a model does not fit in the budget while the resident ones are in use"""
+
+
+class _Resident:
+    def __init__(self, server, size):
+        self.server = server
+        self.size = size
+        self.last_used = time.monotonic()
+        self.uses = 0
+
+
+class ModelRouter:
+    """
+    Keeps a memory-budgeted set of llama-server backends resident.
+
+    A model's server is started on its first request. When a model does
+    not fit in the budget, idle servers (no request holding them) are
+    stopped first: least recently used ("lru") or least used ("lfu").
+    `new_server(name, path)` returns an unstarted LlamaServer and
+    `wait_loaded(server)` returns an error message or None.
+    """
+
+    def __init__(self, models, new_server, wait_loaded, budget_mb=ROUTER_MEMORY_BUDGET_MB,
+                 policy=ROUTER_EVICTION, default=ROUTER_DEFAULT_MODEL, wait_timeout=ROUTER_WAIT_TIMEOUT):
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"Unknown ROUTER_EVICTION policy '{policy}' (use lru or lfu)")
+        self.models = dict(models)
+        self.budget = budget_mb * 1024 * 1024
+        self.policy = policy
+        self.default = default if default in self.models else next(iter(self.models))
+        self.wait_timeout = wait_timeout
+        self._new_server = new_server
+        self._wait_loaded = wait_loaded
+        self._resident = {}
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+
+    def footprint(self, name):
+        """Estimated resident memory of a model in bytes"""
+        try:
+            return int(os.path.getsize(self.models[name]) * MEMORY_OVERHEAD)
+        except OSError:
+            return 0
+
+    def _used(self):
+        return sum(entry.size for entry in self._resident.values())
+
+    def _victims(self, size):
+        """Idle models to unload so `size` more bytes fit; called with the lock held"""
+        idle = [name for name, entry in self._resident.items() if entry.server.active_requests == 0]
+        if self.policy == "lfu":
+            idle.sort(key=lambda name: (self._resident[name].uses, self._resident[name].last_used))
+        else:
+            idle.sort(key=lambda name: self._resident[name].last_used)
+
+        victims = []
+        free = self.budget - self._used()
+        for name in idle:
+            if free >= size:
+                break
+            victims.append(name)
+            free += self._resident[name].size
+        # A model larger than the whole budget may still run on its own
+        if free < size and len(victims) < len(self._resident):
+            busy = len(self._resident) - len(victims)
+            raise RouterBusy(f"Model does not fit in the {self.budget // (1024 * 1024)} MB budget "
+                             f"while {busy} other model(s) are in use")
+        return victims
+
+    def _admit(self, name, use=True):
+        """Resident entry for a model, evicting others to make room; called with the lock held"""
+        entry = self._resident.get(name)
+        if entry is None:
+            size = self.footprint(name)
+            for victim in self._victims(size):
+                # Stopped under the lock so the port is free before the model can be loaded again
+                print(f"Router: unloading '{victim}' to make room for '{name}'", file=sys.stderr)
+                self._resident.pop(victim).server.stop()
+                self.evictions += 1
+            server = self._new_server(name, self.models[name])
+            server.start()
+            entry = self._resident[name] = _Resident(server, size)
+            self.loads += 1
+        if use:
+            entry.uses += 1
+            entry.last_used = time.monotonic()
+        entry.server.hold()
+        return entry
+
+    def load(self, name=None):
+        """Start loading a model without waiting for it, e.g. the default one at startup"""
+        with self._lock:
+            self._admit(name or self.default, use=False).server.unhold()
+
+    def checkout(self, name=None):
+        """
+        The loaded backend for a model, started on demand.
+
+        The server is held for the caller, who must call server.unhold()
+        when done. Raises KeyError for an unknown model, RouterBusy if it
+        still does not fit after ROUTER_WAIT_TIMEOUT, or RuntimeError if
+        its server fails to load.
+        """
+        name = name or self.default
+        if name not in self.models:
+            raise KeyError(name)
+
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            try:
+                with self._lock:
+                    entry = self._admit(name)
+                break
+            except RouterBusy:
+                if time.monotonic() > deadline:
+                    raise
+            time.sleep(0.2)
+
+        error = self._wait_loaded(entry.server)
+        if error:
+            entry.server.unhold()
+            with self._lock:
+                if self._resident.get(name) is entry:
+                    del self._resident[name]
+                    entry.server.stop()
+            raise RuntimeError(f"Model '{name}' failed to load: {error}")
+        return entry.server
+
+    def servers(self):
+        """The servers of the resident models"""
+        with self._lock:
+            return [entry.server for entry in self._resident.values()]
+
+    def stop(self):
+        with self._lock:
+            for entry in self._resident.values():
+                entry.server.stop()
+            self._resident.clear()
+
+    def status(self):
+        """Resident models and budget use for the /health endpoint"""
+        now = time.monotonic()
+        with self._lock:
+            models = {}
+            for name, path in self.models.items():
+                entry = self._resident.get(name)
+                models[name] = {
+                    "model_path": path,
+                    "state": entry.server.state if entry else "unloaded",
+                    "port": entry.server.port if entry else None,
+                    "estimated_mb": round((entry.size if entry else self.footprint(name)) / (1024 * 1024)),
+                    "active_requests": entry.server.active_requests if entry else 0,
+                    "uses": entry.uses if entry else 0,
+                    "idle_seconds": round(now - entry.last_used, 1) if entry else None,
+                }
+            return {
+                "models": models,
+                "default_model": self.default,
+                "resident": list(self._resident),
+                "eviction_policy": self.policy,
+                "budget_mb": self.budget // (1024 * 1024),
+                "used_mb": round(self._used() / (1024 * 1024)),
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
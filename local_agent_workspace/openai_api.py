@@ -0,0 +1,204 @@
+import json
+import os
+import time
+import uuid
+
+import agent_api
+import llm_interface
+import model_router
+
+# OpenAI-compatible /v1/completions and /v1/chat/completions on top of the
+# same scheduler, cache and request coalescing as /api/agent. Shared by the
+# Flask and asyncio servers; nothing here depends on the web framework.
+
+# Upper bound on `n` (completions per request); each one is a separate generation
+MAX_CHOICES = int(os.environ.get("OPENAI_MAX_CHOICES", "4"))
+
+# Used when a chat request has no system message
+CHAT_SYSTEM_PROMPT = "You are a helpful AI assistant. Your goal is to answer the user's question clearly and concisely."
+
+CHAT_ROLES = {"system", "user", "assistant"}
+
+# Turn markers of chat_prompt(); generation stops before the model starts a new turn
+CHAT_STOP = ["\nUser:"]
+
+SSE_DONE = "data: [DONE]\n\n"
+
+def served_model(model=None):
+    """Model name reported in responses and by /v1/models"""
+    names = llm_interface.model_names()
+    if names:
+        default = model_router.ROUTER_DEFAULT_MODEL
+        return model or (default if default in names else names[0])
+    instance = os.environ.get("INSTANCE_NAME")
+    if instance and instance != "unknown":
+        return instance
+    return os.path.splitext(os.path.basename(llm_interface.MODEL_PATH or "local-model"))[0]
+
+def model_list():
+    """Body of GET /v1/models"""
+    names = llm_interface.model_names() or [served_model()]
+    return {
+        "object": "list",
+        "data": [{"id": name, "object": "model", "created": 0, "owned_by": "simplebrain"} for name in names],
+    }
+
+def error_body(message, error_type="invalid_request_error", param=None):
+    return {"error": {"message": message, "type": error_type, "param": param, "code": None}}
+
+def busy_error_body(error):
+    """Error body for QueueFull (429) and QueueTimeout (503)"""
+    error_type = "rate_limit_exceeded" if agent_api.busy_status(error) == 429 else "server_error"
+    return error_body(str(error), error_type)
+
+def _message_text(content):
+    """Text of a chat message; content may be a string or a list of text parts"""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list) and all(isinstance(part, dict) and part.get("type") == "text" for part in content):
+        return "".join(str(part.get("text", "")) for part in content)
+    return None
+
+def chat_prompt(messages):
+    """Render chat messages as a plain prompt that ends where the assistant's reply begins"""
+    system = [m["content"] for m in messages if m["role"] == "system"]
+    lines = ["\n".join(system) if system else CHAT_SYSTEM_PROMPT, ""]
+    for message in messages:
+        if message["role"] != "system":
+            lines.append(f"{message['role'].title()}: {message['content']}")
+    lines.append("Assistant:")
+    return "\n".join(lines)
+
+def _parse_messages(messages):
+    """Validated [{"role", "content"}] list, or an error message"""
+    if not isinstance(messages, list) or not messages:
+        return None, "'messages' must be a non-empty list"
+    parsed = []
+    for message in messages:
+        if not isinstance(message, dict) or message.get("role") not in CHAT_ROLES:
+            return None, f"Each message needs a role ({', '.join(sorted(CHAT_ROLES))}) and content"
+        content = _message_text(message.get("content"))
+        if content is None:
+            return None, "Message content must be a string or a list of text parts"
+        parsed.append({"role": message["role"], "content": content})
+    if not any(m["role"] == "user" and m["content"].strip() for m in parsed):
+        return None, "'messages' must contain a non-empty user message"
+    return parsed, None
+
+def parse_request(kind, data):
+    """
+    Validate a /v1/completions ("completion") or /v1/chat/completions
+    ("chat") request body; returns (request, error body).
+
+    max_tokens and temperature are clamped to the instance's LLM_MAX_*
+    limits, so a response may end with finish_reason "length" earlier
+    than asked.
+    """
+    if not isinstance(data, dict):
+        return None, error_body("Request body must be a JSON object")
+
+    if kind == "chat":
+        messages, error = _parse_messages(data.get("messages"))
+        if error:
+            return None, error_body(error, param="messages")
+        prompt = chat_prompt(messages)
+    else:
+        prompt = data.get("prompt")
+        if isinstance(prompt, list) and len(prompt) == 1:
+            prompt = prompt[0]
+        if not isinstance(prompt, str) or not prompt.strip():
+            return None, error_body("'prompt' must be a non-empty string (one prompt per request)", param="prompt")
+    if len(prompt) > agent_api.MAX_PROMPT_LENGTH:
+        return None, error_body(f"Prompt too long (max {agent_api.MAX_PROMPT_LENGTH} characters)",
+                                param="messages" if kind == "chat" else "prompt")
+
+    params, error = agent_api.generation_params({
+        "max_tokens": data.get("max_tokens", data.get("max_completion_tokens")),
+        "temperature": data.get("temperature"),
+        "stop": data.get("stop"),
+    })
+    if error:
+        return None, error_body(error)
+    if kind == "chat":
+        # Keep the model from writing the user's next turn
+        stops = params["stop"] or []
+        params["stop"] = stops + [stop for stop in CHAT_STOP if stop not in stops]
+
+    n = data.get("n", 1)
+    if not isinstance(n, int) or isinstance(n, bool) or not 1 <= n <= MAX_CHOICES:
+        return None, error_body(f"'n' must be an integer between 1 and {MAX_CHOICES}", param="n")
+
+    stream = data.get("stream", False)
+    if not isinstance(stream, bool):
+        return None, error_body("'stream' must be a boolean", param="stream")
+
+    # In router mode "model" picks one of ROUTER_MODELS; otherwise any name is accepted
+    model = data.get("model")
+    models = llm_interface.model_names()
+    if models and model is not None and model not in models:
+        return None, error_body(f"Unknown model: {model} (available: {', '.join(models)})", param="model")
+
+    stream_options = data.get("stream_options")
+    return {
+        "kind": kind,
+        "prompt": prompt,
+        "model": model if models else None,
+        "params": params,
+        "n": n,
+        "stream": stream,
+        "include_usage": stream and isinstance(stream_options, dict) and stream_options.get("include_usage") is True,
+        "id": f"{'chatcmpl' if kind == 'chat' else 'cmpl'}-{uuid.uuid4().hex[:24]}",
+        "created": int(time.time()),
+    }, None
+
+def finish_reason(req, result):
+    """'length' when the generation used its whole token budget, else 'stop'"""
+    completion_tokens = (result.get("usage") or {}).get("completion_tokens")
+    limit = llm_interface.sampling_params(req["params"])["n_predict"]
+    return "length" if completion_tokens and completion_tokens >= limit else "stop"
+
+def usage(results):
+    """OpenAI usage block summed over a request's choices"""
+    counts = [result.get("usage") or {} for result in results]
+    prompt_tokens = next((c.get("prompt_tokens") for c in counts if c.get("prompt_tokens")), 0) or 0
+    completion_tokens = sum(c.get("completion_tokens") or 0 for c in counts)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+def _envelope(req, chunk=False):
+    if req["kind"] == "chat":
+        obj = "chat.completion.chunk" if chunk else "chat.completion"
+    else:
+        obj = "text_completion"
+    return {"id": req["id"], "object": obj, "created": req["created"], "model": served_model(req["model"])}
+
+def response_body(req, results):
+    """Body of a non-streaming response; `results` are the choices' {"text", "usage"} dicts"""
+    body = _envelope(req)
+    choices = []
+    for index, result in enumerate(results):
+        choice = {"index": index, "finish_reason": finish_reason(req, result)}
+        if req["kind"] == "chat":
+            choice["message"] = {"role": "assistant", "content": result["text"]}
+        else:
+            choice.update(text=result["text"], logprobs=None)
+        choices.append(choice)
+    body["choices"] = choices
+    body["usage"] = usage(results)
+    return body
+
+def chunk(req, index, text=None, finish=None, role=False):
+    """One streamed choice delta as a Server-Sent Event"""
+    if req["kind"] == "chat":
+        delta = {"role": "assistant", "content": ""} if role else ({"content": text} if text is not None else {})
+        choice = {"index": index, "delta": delta, "finish_reason": finish}
+    else:
+        choice = {"index": index, "text": text or "", "logprobs": None, "finish_reason": finish}
+    return sse(dict(_envelope(req, chunk=True), choices=[choice]))
+
+def usage_chunk(req, results):
+    """Final event with token counts, sent when the client asked for stream_options.include_usage"""
+    return sse(dict(_envelope(req, chunk=True), choices=[], usage=usage(results)))
+
+def sse(payload):
+    return f"data: {json.dumps(payload)}\n\n"
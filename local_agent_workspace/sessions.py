@@ -0,0 +1,178 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# Conversations kept server-side for requests that carry a "session_id"
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", "1000"))
+
+# Seconds of inactivity after which a session is forgotten
+SESSION_TTL = float(os.environ.get("SESSION_TTL", "3600"))
+
+# Earlier turns a session's prompt repeats; older ones are dropped
+SESSION_MAX_TURNS = int(os.environ.get("SESSION_MAX_TURNS", "16"))
+
+# Characters per token assumed when fitting a session's history into the
+# context window; 3 errs on the safe side for English text (about 4) and
+# code. Lower it for languages that take more tokens per character.
+CHARS_PER_TOKEN = float(os.environ.get("SESSION_CHARS_PER_TOKEN", "3"))
+
+# Characters the prompt wrapper adds around each earlier turn
+TURN_OVERHEAD = 24
+
+# When a history has to be cut, it is cut to this share of its limit in one
+# go, so the prompt prefix (and the KV cache of the session's slot) then
+# stays the same for the next few turns instead of changing on every turn
+TRIM_TO = 0.5
+
+
+class SessionBusy(Exception):
+    """Raised when a session is sent a turn while its previous one is still running"""
+
+    def __init__(self, session_id):
+        super().__init__(f"Session {session_id} is busy with another request")
+        self.session_id = session_id
+
+
+class Session:
+    """A conversation: its earlier (prompt, answer) turns"""
+
+    def __init__(self, session_id):
+        self.id = session_id
+        self.turns = []
+        self.busy = False
+        self.last_used = time.time()
+
+
+class SessionStore:
+    """
+    Transcripts of the conversations an instance is holding, LRU-bounded
+    with a time-to-live.
+
+    A session runs one turn at a time: begin() claims it and finish() or
+    release() gives it back. `on_end(session_id)` is called (outside the
+    lock) for every session that expires, is evicted or is ended, so the
+    backend can drop its KV state.
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS, ttl=SESSION_TTL, max_turns=SESSION_MAX_TURNS, on_end=None):
+        self.max_sessions = max(1, max_sessions)
+        self.ttl = ttl
+        self.max_turns = max(0, max_turns)
+        self.on_end = on_end
+
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.started = 0
+        self.expired = 0
+        self.trimmed = 0
+
+    def begin(self, session_id=None):
+        """
+        Claim a session for a new turn, creating it if needed (with a random
+        ID when none is given). Raises SessionBusy if it is already running one.
+        """
+        with self._lock:
+            ended = self._expire()
+            session = self._sessions.get(session_id) if session_id else None
+            if session is None:
+                session = Session(session_id or uuid.uuid4().hex)
+                self._sessions[session.id] = session
+                self.started += 1
+                # Evict idle sessions beyond the cap, least recently used first
+                for old in list(self._sessions.values()):
+                    if len(self._sessions) <= self.max_sessions:
+                        break
+                    if not old.busy and old is not session:
+                        del self._sessions[old.id]
+                        ended.append(old.id)
+            elif session.busy:
+                raise SessionBusy(session.id)
+            session.busy = True
+            session.last_used = time.time()
+            self._sessions.move_to_end(session.id)
+        self._ended(ended)
+        return session
+
+    def fit(self, session, tokens, reserved_chars=0):
+        """
+        Drop a claimed session's oldest turns if its history would not fit
+        in `tokens` (the context left after the answer) next to
+        `reserved_chars` of new prompt; sizes are estimated at
+        CHARS_PER_TOKEN. Whole turns are dropped, down to TRIM_TO of the
+        room, so the next turns keep the same prefix.
+        """
+        room = tokens * CHARS_PER_TOKEN - reserved_chars
+        sizes = [len(prompt) + len(answer) + TURN_OVERHEAD for prompt, answer in session.turns]
+        if sum(sizes) <= room:
+            return
+        kept = sum(sizes)
+        drop = 0
+        while drop < len(sizes) and kept > room * TRIM_TO:
+            kept -= sizes[drop]
+            drop += 1
+        with self._lock:
+            del session.turns[:drop]
+            self.trimmed += drop
+
+    def finish(self, session, prompt, answer):
+        """Record a completed turn and give the session back"""
+        with self._lock:
+            session.turns.append((prompt, answer))
+            if len(session.turns) > self.max_turns:
+                # Cut to TRIM_TO of the limit, like fit(), rather than one turn per turn
+                drop = len(session.turns) - int(self.max_turns * TRIM_TO)
+                del session.turns[:drop]
+                self.trimmed += drop
+            session.busy = False
+            session.last_used = time.time()
+
+    def release(self, session):
+        """Give a session back without recording a turn (the turn failed)"""
+        with self._lock:
+            session.busy = False
+            session.last_used = time.time()
+
+    def end(self, session_id):
+        """Forget a session; returns False if it is unknown or busy"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or session.busy:
+                return False
+            del self._sessions[session_id]
+        self._ended([session_id])
+        return True
+
+    def get(self, session_id):
+        """The session with this ID, or None"""
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def _expire(self):
+        """Drop idle sessions past their TTL (lock held); returns their IDs"""
+        cutoff = time.time() - self.ttl
+        expired = [s.id for s in self._sessions.values() if not s.busy and s.last_used < cutoff]
+        for session_id in expired:
+            del self._sessions[session_id]
+        self.expired += len(expired)
+        return expired
+
+    def _ended(self, session_ids):
+        if self.on_end is not None:
+            for session_id in session_ids:
+                self.on_end(session_id)
+
+    def stats(self):
+        """Session counts for the /health endpoint"""
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "busy": sum(1 for s in self._sessions.values() if s.busy),
+                "max_sessions": self.max_sessions,
+                "ttl_seconds": self.ttl,
+                "max_turns": self.max_turns,
+                "started": self.started,
+                "expired": self.expired,
+                "turns_trimmed": self.trimmed,
+            }
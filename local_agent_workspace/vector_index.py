@@ -0,0 +1,365 @@
+import json
+import math
+import os
+import sqlite3
+import sys
+import threading
+
+# Only needed for retrieval (/api/embed stores, /api/index, "retrieve")
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Approximate nearest-neighbour index over embedding vectors, kept in a
+# directory: the vectors in a memory-mapped file (only the rows a search
+# touches are paged in, so a million 4096-dim vectors fit on one box), the
+# chunk texts in SQLite, and an inverted-file (IVF) layout over k-means
+# centroids so a search scores a few lists instead of every vector.
+
+# Directory the index lives in; the workspace mount survives container restarts
+VECTOR_INDEX_DIR = os.environ.get("VECTOR_INDEX_DIR") or (
+    "/app/workspace/cache/vectors" if os.path.isdir("/app/workspace")
+    else os.path.expanduser("~/.cache/simplebrain/vectors"))
+
+# On-disk precision: float16 halves disk and page cache (1M x 4096 dims is
+# 8 GB instead of 16); scores are computed in float32 either way
+VECTOR_DTYPE = os.environ.get("VECTOR_DTYPE", "float16")
+
+# Vectors stored before the index is clustered; until then every search is
+# an exact scan. It is clustered again each time it has grown 4x since.
+IVF_TRAIN_SIZE = int(os.environ.get("VECTOR_IVF_TRAIN_SIZE", "20000"))
+RETRAIN_GROWTH = 4
+
+# Inverted lists a search scores: more finds more of the true nearest
+# neighbours, at the cost of scoring more vectors
+IVF_NPROBE = int(os.environ.get("VECTOR_NPROBE", "16"))
+
+# Lists are about sqrt(vectors) in number, within these bounds; k-means
+# runs on a sample of SAMPLE_PER_LIST vectors per list
+MIN_LISTS = 16
+MAX_LISTS = 1024
+SAMPLE_PER_LIST = 32
+KMEANS_ITERATIONS = 10
+
+# Rows converted to float32 and scored at a time
+SCAN_BLOCK = 16384
+
+INITIAL_CAPACITY = 1024
+
+
+def normalize(vectors):
+    """Scale float32 rows to unit length, so inner product is cosine similarity"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _nearest(vectors, centroids):
+    """Index of the most similar centroid for each row"""
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), SCAN_BLOCK):
+        block = vectors[start:start + SCAN_BLOCK].astype(np.float32)
+        labels[start:start + SCAN_BLOCK] = np.argmax(block @ centroids.T, axis=1)
+    return labels
+
+
+def kmeans(data, n_lists, seed=0):
+    """Spherical k-means: unit-length centroids of `data` (unit-length float32 rows)"""
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), n_lists, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        labels = _nearest(data, centroids)
+        order = np.argsort(labels, kind="stable")
+        used, starts = np.unique(labels[order], return_index=True)
+        # Lists that lost every member keep their previous centroid
+        centroids[used] = normalize(np.add.reduceat(data[order], starts, axis=0))
+    return centroids
+
+
+class VectorIndex:
+    """
+    Chunks of documents with their unit-length embeddings, searchable by
+    cosine similarity.
+
+    Rows are appended to `vectors.bin`, which grows by doubling; deleting a
+    document marks its rows dead in `alive.bin` and later adds reuse them.
+    Each row's inverted list is kept in `assign.bin`; the lists themselves
+    are rebuilt in memory when the index is opened. Chunk texts, their
+    document and row live in `chunks.db`, which is committed last, so rows
+    written by an interrupted add are ignored on the next open.
+
+    All methods are thread-safe. Clustering (on reaching `train_size`
+    vectors and each RETRAIN_GROWTH-fold growth after) runs in a background
+    thread on a snapshot of the rows; adds and searches go on with the
+    previous lists meanwhile and only wait for the new ones to be swapped in.
+    """
+
+    def __init__(self, path=VECTOR_INDEX_DIR, dtype=VECTOR_DTYPE, train_size=IVF_TRAIN_SIZE, nprobe=IVF_NPROBE):
+        if np is None:
+            raise RuntimeError("The vector index needs numpy (pip install numpy)")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.train_size = max(MIN_LISTS, train_size)
+        self.nprobe = max(1, nprobe)
+
+        self._lock = threading.Lock()
+        # Set while a clustering runs, with the rows added since its snapshot
+        self._training = False
+        self._dirty = None
+        self._db = sqlite3.connect(os.path.join(path, "chunks.db"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "row INTEGER PRIMARY KEY, doc TEXT NOT NULL, chunk INTEGER NOT NULL, text TEXT NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS chunks_doc ON chunks (doc)")
+        self._db.commit()
+
+        meta = self._read_meta()
+        self.dim = meta.get("dim")
+        self.model = meta.get("model")
+        self.dtype = np.dtype(meta.get("dtype", dtype))
+        self.capacity = meta.get("capacity", 0)
+        self.trained_on = meta.get("trained_on", 0)
+        (last_row,) = self._db.execute("SELECT MAX(row) FROM chunks").fetchone()
+        self.count = last_row + 1 if last_row is not None else 0
+
+        self._vectors = self._alive = self._assign = None
+        self.centroids = None
+        self._lists = None
+        if self.dim:
+            self._open_arrays()
+            # Rows past the last committed one belong to an add that did not finish
+            self._alive[self.count:] = 0
+            centroids_path = os.path.join(path, "centroids.npy")
+            if os.path.exists(centroids_path):
+                self.centroids = np.load(centroids_path)
+                self._build_lists()
+        self._free = list(np.flatnonzero(self._alive[:self.count] == 0)) if self.dim else []
+        self.live = self.count - len(self._free)
+
+    def _read_meta(self):
+        try:
+            with open(os.path.join(self.path, "meta.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_meta(self):
+        meta = {"dim": self.dim, "model": self.model, "dtype": self.dtype.name,
+                "capacity": self.capacity, "trained_on": self.trained_on}
+        temp = os.path.join(self.path, "meta.json.tmp")
+        with open(temp, "w") as f:
+            json.dump(meta, f)
+        os.replace(temp, os.path.join(self.path, "meta.json"))
+
+    def _memmap(self, name, dtype, shape):
+        """Map a file of exactly `shape`, creating or extending it with zeros"""
+        path = os.path.join(self.path, name)
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with open(path, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        return np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+
+    def _open_arrays(self):
+        self._vectors = self._memmap("vectors.bin", self.dtype, (self.capacity, self.dim))
+        self._alive = self._memmap("alive.bin", np.uint8, (self.capacity,))
+        self._assign = self._memmap("assign.bin", np.int32, (self.capacity,))
+
+    def _grow(self, needed):
+        """Make room for at least `needed` rows"""
+        if needed <= self.capacity:
+            return
+        self.capacity = max(INITIAL_CAPACITY, self.capacity * 2, needed)
+        if self._vectors is not None:
+            for array in (self._vectors, self._alive, self._assign):
+                array.flush()
+            self._vectors = self._alive = self._assign = None
+        self._open_arrays()
+        self._write_meta()
+
+    def _build_lists(self):
+        """Group the live rows by inverted list"""
+        rows = np.flatnonzero(self._alive[:self.count])
+        labels = self._assign[rows]
+        order = np.argsort(labels, kind="stable")
+        rows, labels = rows[order], labels[order]
+        bounds = np.searchsorted(labels, np.arange(len(self.centroids) + 1))
+        self._lists = [rows[bounds[i]:bounds[i + 1]] for i in range(len(self.centroids))]
+
+    def _train(self):
+        """
+        Cluster the live vectors into about sqrt(n) lists and assign every
+        row to one. Runs without the lock on the rows there were when it
+        started; rows added since are assigned when the result is swapped in.
+        """
+        try:
+            with self._lock:
+                count, vectors = self.count, self._vectors
+                rows = np.flatnonzero(self._alive[:count])
+                self._dirty = []
+            n_lists = min(MAX_LISTS, max(MIN_LISTS, int(math.sqrt(len(rows)))))
+            rng = np.random.default_rng(len(rows))
+            sample = np.sort(rng.choice(rows, min(len(rows), n_lists * SAMPLE_PER_LIST), replace=False))
+            centroids = kmeans(vectors[sample].astype(np.float32), n_lists)
+            labels = _nearest(vectors[:count], centroids)
+
+            with self._lock:
+                changed = np.concatenate([np.arange(count, self.count)] + self._dirty).astype(np.int64)
+                self._assign[:count] = labels
+                if len(changed):
+                    self._assign[changed] = _nearest(self._vectors[changed], centroids)
+                self._assign.flush()
+                np.save(os.path.join(self.path, "centroids.npy"), centroids)
+                self.centroids = centroids
+                self.trained_on = len(rows)
+                self._write_meta()
+                self._build_lists()
+            print(f"Vector index clustered: {len(rows)} vectors in {n_lists} lists", file=sys.stderr)
+        except Exception as e:
+            print(f"Vector index clustering failed: {e}", file=sys.stderr)
+        finally:
+            with self._lock:
+                self._training = False
+                self._dirty = None
+
+    def _check(self, dim, model):
+        if self.dim is not None and dim != self.dim:
+            raise ValueError(f"The index holds {self.dim}-dim vectors, got {dim}-dim ones")
+        if self.model is not None and model is not None and model != self.model:
+            raise ValueError(f"The index was built with embedding model {self.model}, not {model}; "
+                             f"delete {self.path} to rebuild it")
+
+    def add(self, doc, texts, vectors, model=None):
+        """
+        Store a document's chunks with their embeddings, replacing any
+        chunks it had. `model` identifies the embedding model; an index
+        only accepts and answers vectors of the model it was built with.
+        Returns the number of chunks stored.
+        """
+        if not texts:
+            self.delete(doc)
+            return 0
+        vectors = normalize(vectors)
+        if vectors.ndim != 2 or len(vectors) != len(texts):
+            raise ValueError("Expected one vector per chunk")
+        with self._lock:
+            self._check(vectors.shape[1], model)
+            self._delete(doc)
+            if self.dim is None:
+                self.dim, self.model = vectors.shape[1], model
+                self._write_meta()
+
+            reused = [self._free.pop() for _ in range(min(len(self._free), len(texts)))]
+            appended = list(range(self.count, self.count + len(texts) - len(reused)))
+            rows = np.array(reused + appended, dtype=np.int64)
+            self._grow(self.count + len(appended))
+
+            self._vectors[rows] = vectors.astype(self.dtype)
+            if self._dirty is not None:
+                self._dirty.append(rows)
+            if self.centroids is not None:
+                labels = _nearest(vectors, self.centroids)
+                self._assign[rows] = labels
+                for label in np.unique(labels):
+                    self._lists[label] = np.concatenate([self._lists[label], rows[labels == label]])
+            self._alive[rows] = 1
+            self._vectors.flush()
+            self._alive.flush()
+            self._assign.flush()
+            self._db.executemany("INSERT INTO chunks (row, doc, chunk, text) VALUES (?, ?, ?, ?)",
+                                 [(int(row), doc, i, text) for i, (row, text) in enumerate(zip(rows, texts))])
+            self._db.commit()
+            self.count += len(appended)
+            self.live += len(texts)
+
+            if not self._training and self.live >= self.train_size and (
+                    self.centroids is None or self.live >= self.trained_on * RETRAIN_GROWTH):
+                self._training = True
+                threading.Thread(target=self._train, name="vector-index-train", daemon=True).start()
+        return len(texts)
+
+    def delete(self, doc):
+        """Remove a document's chunks; returns how many there were"""
+        with self._lock:
+            return self._delete(doc)
+
+    def _delete(self, doc):
+        rows = [row for (row,) in self._db.execute("SELECT row FROM chunks WHERE doc = ?", (doc,))]
+        if not rows:
+            return 0
+        self._db.execute("DELETE FROM chunks WHERE doc = ?", (doc,))
+        self._db.commit()
+        self._alive[rows] = 0
+        self._alive.flush()
+        if self._lists is not None:
+            # Take the rows out of their lists, so a list only ever holds live rows
+            gone = np.array(rows, dtype=np.int64)
+            labels = self._assign[gone]
+            for label in np.unique(labels):
+                members = self._lists[label]
+                self._lists[label] = members[~np.isin(members, gone[labels == label])]
+        self._free.extend(rows)
+        self.live -= len(rows)
+        return len(rows)
+
+    def search(self, vector, k=5, nprobe=None, model=None):
+        """
+        The `k` chunks most similar to `vector`, best first, as dicts with
+        "doc", "chunk", "text" and cosine "score". Scans every vector until
+        the index is clustered, then only the `nprobe` closest lists.
+        """
+        query = normalize(vector).reshape(-1)
+        with self._lock:
+            if not self.live:
+                return []
+            self._check(len(query), model)
+            if self._lists is None:
+                candidates, scores = self._scan(query)
+            else:
+                probe = np.argsort(self.centroids @ query)[::-1][:nprobe or self.nprobe]
+                candidates = np.concatenate([self._lists[i] for i in probe])
+                scores = np.concatenate([self._vectors[candidates[start:start + SCAN_BLOCK]].astype(np.float32) @ query
+                                         for start in range(0, len(candidates), SCAN_BLOCK)] or [np.empty(0)])
+
+            if len(candidates) > k:
+                top = np.argpartition(scores, -k)[-k:]
+                candidates, scores = candidates[top], scores[top]
+            order = np.argsort(scores)[::-1]
+            best = {int(row): float(score) for row, score in zip(candidates[order], scores[order])}
+            if not best:
+                return []
+
+            placeholders = ",".join("?" * len(best))
+            chunks = {row: (doc, chunk, text) for row, doc, chunk, text in self._db.execute(
+                f"SELECT row, doc, chunk, text FROM chunks WHERE row IN ({placeholders})", list(best))}
+        return [{"doc": chunks[row][0], "chunk": chunks[row][1], "text": chunks[row][2], "score": round(score, 4)}
+                for row, score in best.items() if row in chunks]
+
+    def _scan(self, query):
+        """Exact search: score every live row"""
+        candidates, scores = [], []
+        for start in range(0, self.count, SCAN_BLOCK):
+            end = min(start + SCAN_BLOCK, self.count)
+            rows = np.flatnonzero(self._alive[start:end]) + start
+            candidates.append(rows)
+            scores.append(self._vectors[start:end].astype(np.float32)[rows - start] @ query)
+        return np.concatenate(candidates), np.concatenate(scores)
+
+    def stats(self):
+        with self._lock:
+            (documents,) = self._db.execute("SELECT COUNT(DISTINCT doc) FROM chunks").fetchone()
+            return {
+                "path": self.path,
+                "documents": documents,
+                "chunks": self.live,
+                "dim": self.dim,
+                "dtype": self.dtype.name,
+                "model": self.model,
+                "capacity": self.capacity,
+                "lists": len(self.centroids) if self.centroids is not None else 0,
+                "nprobe": self.nprobe,
+                "clustering": self._training,
+            }
@@ -161,10 +161,13 @@ start_environment() {
         make -j2
     "
     
-    # Create symlink for the main binary
+    # Create symlinks for the main binary, the resident inference server and
+    # the benchmark tool used by LLM_TUNE
     docker-compose -f docker-compose.local-llm.yml exec -T local-llm bash -c "
         mkdir -p /app/workspace/projects/llama.cpp && 
-        ln -sf /app/workspace/llama.cpp/build/bin/llama-cli /app/workspace/projects/llama.cpp/main
+        ln -sf /app/workspace/llama.cpp/build/bin/llama-cli /app/workspace/projects/llama.cpp/main &&
+        ln -sf /app/workspace/llama.cpp/build/bin/llama-server /app/workspace/projects/llama.cpp/server &&
+        ln -sf /app/workspace/llama.cpp/build/bin/llama-bench /app/workspace/projects/llama.cpp/llama-bench
     "
     
     # Start Flask app
@@ -69,11 +69,12 @@ setup_llama_cpp() {
     
     # Configure and build
     cmake .. -DCMAKE_BUILD_TYPE=Release
-    make -j$(nproc) main
+    make -j$(nproc) main llama-server
     
     # Create projects directory and symlink for backward compatibility
     mkdir -p "${workspace_dir}/projects/llama.cpp"
     ln -sf "$llama_executable" "${workspace_dir}/projects/llama.cpp/main"
+    ln -sf "${llama_dir}/build/bin/llama-server" "${workspace_dir}/projects/llama.cpp/server"
     
     if [[ -x "$llama_executable" ]]; then
         log_success "llama.cpp built successfully!"
@@ -161,6 +162,10 @@ start_flask() {
     # Set Flask environment
     export FLASK_APP=app.py
     export FLASK_ENV=production
+
+    # Pre-read the model and run a test generation before /health reports
+    # ready (set WARMUP=0 to skip, WARMUP_MLOCK=1 to also pin it in memory)
+    export WARMUP="${WARMUP:-1}"
     
     # Start Flask with better error handling
     log_success "Starting Flask server on port ${API_PORT:-5000}..."
@@ -81,6 +81,10 @@ start_flask() {
     # Set Flask environment
     export FLASK_APP=app.py
     export FLASK_ENV=production
+
+    # Pre-read the model and run a test generation before /health reports
+    # ready (set WARMUP=0 to skip, WARMUP_MLOCK=1 to also pin it in memory)
+    export WARMUP="${WARMUP:-1}"
     
     # Start Flask with better error handling
     log_success "Starting Flask server on port ${API_PORT:-5000}..."
@@ -6,6 +6,10 @@ set -euo pipefail
 MODELS_DIR="./models"
 CURRENT_MODEL="model.gguf"
 
+# Admin API of the running instance (needs ADMIN_TOKEN set in the container too)
+API_URL="${SIMPLEBRAIN_URL:-http://localhost:5001}"
+ADMIN_TOKEN="${ADMIN_TOKEN:-}"
+
 show_models() {
     echo "📋 Available models:"
     ls -lh "$MODELS_DIR"/*.gguf | grep -v "$CURRENT_MODEL" | awk '{print "  " $9 " (" $5 ")"}'
@@ -18,6 +22,14 @@ show_models() {
     fi
 }
 
+point_symlink() {
+    # Re-point the symlink so the container also uses the new model after a restart
+    cd "$MODELS_DIR"
+    rm -f "$CURRENT_MODEL"
+    ln -s "$1" "$CURRENT_MODEL"
+    cd ..
+}
+
 switch_model() {
     local new_model="$1"
     
@@ -28,16 +40,32 @@ switch_model() {
     
     echo "🔄 Switching from $(readlink "$MODELS_DIR/$CURRENT_MODEL" 2>/dev/null || echo "current") to $new_model"
     
-    # Stop container
-    ./automate_local_llm.sh stop
-    
-    # Switch model
-    cd "$MODELS_DIR"
-    rm -f "$CURRENT_MODEL"
-    ln -s "$new_model" "$CURRENT_MODEL"
-    cd ..
+    # Hot-swap in the running instance: the new model is loaded and warmed up
+    # next to the current one, so the API stays available throughout
+    if [ -n "$ADMIN_TOKEN" ]; then
+        echo "⏳ Loading $new_model in the running instance ($API_URL)..."
+        local response status
+        response=$(curl -s --max-time 900 -w '\n%{http_code}' -X POST \
+            -H "Content-Type: application/json" -H "X-Admin-Token: $ADMIN_TOKEN" \
+            -d "{\"model\": \"$new_model\"}" "$API_URL/admin/model" || true)
+        status=$(echo "$response" | tail -n 1)
+        if [ "$status" = "200" ]; then
+            point_symlink "$new_model"
+            echo "✅ Model switched to $new_model without downtime!"
+            return
+        fi
+        echo "⚠️  Hot-swap failed (HTTP ${status:-none}): $(echo "$response" | sed '$d')"
+        if [ "$status" = "409" ] || [ "$status" = "500" ]; then
+            # The instance is up and still serving the previous model
+            exit 1
+        fi
+    else
+        echo "ℹ️  ADMIN_TOKEN not set; falling back to a container restart"
+    fi
     
-    # Start container with new model
+    # Fallback: restart the container with the new model
+    ./automate_local_llm.sh stop
+    point_symlink "$new_model"
     ./automate_local_llm.sh start
     
     echo "✅ Model switched to $new_model successfully!"
@@ -62,6 +90,9 @@ case "${1:-}" in
         echo "  $0 list          # Show available models"
         echo "  $0 switch <model> # Switch to specified model"
         echo
+        echo "With ADMIN_TOKEN set, the running instance is hot-swapped through"
+        echo "POST \$SIMPLEBRAIN_URL/admin/model (default $API_URL) instead of restarted."
+        echo
         show_models
         ;;
 esac
\ No newline at end of file
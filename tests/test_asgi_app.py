@@ -0,0 +1,47 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "local_agent_workspace"))
+
+import pytest
+
+asgi_app = pytest.importorskip("asgi_app")
+
+
+@pytest.fixture
+def fake_backend(monkeypatch):
+    """A backend streaming three tokens"""
+
+    async def astream_llm_response(prompt, info=None, **kwargs):
+        for token in ("a", "b", "c"):
+            await asyncio.sleep(0)
+            yield token
+
+    monkeypatch.setattr(asgi_app.llm_interface, "astream_llm_response", astream_llm_response)
+    monkeypatch.setattr(asgi_app, "request_scheduler", asgi_app.scheduler.RequestScheduler(max_concurrent=1))
+
+
+def test_disconnect_while_queued_frees_the_slot(fake_backend):
+    """A subscriber leaving as soon as its slot is granted must not leave the generation behind"""
+
+    async def run():
+        # Queue behind a running request that finishes shortly
+        running = asgi_app.request_scheduler.acquire()
+        asyncio.get_running_loop().call_later(0.05, running.release)
+        flight = await asgi_app.start_generation("prompt", "key")
+        # The handler sees its client gone before the task has run a step
+        flight.leave()
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+        assert flight.done and flight.error is not None
+        assert asgi_app.request_scheduler.stats()["active"] == 0
+        assert asgi_app.inflight.stats()["in_flight"] == 0
+
+        # The next identical request gets a generation of its own
+        flight = await asgi_app.start_generation("prompt", "key")
+        assert (await flight.wait(timeout=5))["text"] == "abc"
+        flight.leave()
+
+    asyncio.run(run())